@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Benchmark the memory used by the spotify discography cache.
+
+Builds the same synthetic cache with albums stored as plain dictionaries (the
+old format) and compacted into Album records, and reports the bytes used per
+cached track for each one. Some track names are repeated across albums of the
+same artist, like they are in live albums and compilations.
+
+Usage: python benchmarks/bench_discography_memory.py [ARTISTS]
+"""
+import os
+import sys
+import random
+import tracemalloc
+from datetime import date
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from spotify import compact_discography
+
+ALBUMS = 10
+TRACKS = 12
+# Fraction of the tracks in an album that already appeared in an earlier one
+# (live albums, compilations, remasters...)
+REPEATED = 0.4
+WORDS = ['the', 'of', 'blood', 'night', 'fire', 'war', 'black', 'death']
+
+
+def build(artists, compact):
+    rand = random.Random(0)
+    cache = {}
+    for artist in range(artists):
+        discog = {}
+        seen = []
+        for album in range(ALBUMS):
+            tracks = []
+            for _ in range(TRACKS):
+                if seen and rand.random() < REPEATED:
+                    name = rand.choice(seen)
+                else:
+                    name = ' '.join(rand.choices(WORDS, k=3))
+                    name += f' {rand.randrange(10 ** 6)}'
+                    seen.append(name)
+                # Build a new string object, like the ones decoded from an API
+                # response or unpickled from the cache file
+                tracks.append(''.join(name))
+            fields = dict(
+                id=f'{artist:011d}{album:011d}',
+                release_date=date(1970 + album, 1, 1),
+                tracks=tracks,
+            )
+            name = f'album {artist} {album}'
+            discog[name] = fields
+        if compact:
+            discog = compact_discography(discog)
+        cache[f'artist {artist}'] = discog
+    return cache
+
+
+def measure(artists, compact):
+    tracemalloc.start()
+    cache = build(artists, compact)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del cache
+    return size / (artists * ALBUMS * TRACKS)
+
+
+def main():
+    artists = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    before = measure(artists, compact=False)
+    after = measure(artists, compact=True)
+    print(f'dict albums:   {before:6.1f} bytes per track')
+    print(f'Album records: {after:6.1f} bytes per track')
+    print(f'saved:         {100 * (1 - after / before):6.1f}%')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Benchmark searching for songs by a snippet of their lyrics.
+
+Fills a temporary database with synthetic lyrics (words drawn from a Zipf
+distribution, like in natural language), and times `DB.search_lyrics` for
+snippets taken from random songs and for single common words, which are the
+worst case since they match most of the corpus.
+
+Usage: python benchmarks/bench_lyrics_search.py [SONGS] [QUERIES]
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+import statistics
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(ROOT)
+from db import DB
+
+VOCABULARY = 20000
+WORDS_PER_SONG = 200
+BATCH = 10000
+
+
+def make_words(rand):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = set()
+    while len(words) < VOCABULARY:
+        words.add(''.join(rand.choices(letters, k=rand.randint(2, 9))))
+    words = sorted(words, key=len)
+    weights = [1 / rank for rank in range(1, VOCABULARY + 1)]
+    return words, weights
+
+
+def fill(database, songs, rand):
+    words, weights = make_words(rand)
+    connection = database._connection
+    with database._lock:
+        for start in range(0, songs, BATCH):
+            for number in range(start, min(start + BATCH, songs)):
+                lyrics = ' '.join(
+                    rand.choices(words, weights, k=WORDS_PER_SONG)
+                )
+                digest = database._add_text(lyrics)
+                connection.execute(
+                    'INSERT INTO song_lyrics (artist, title, source, hash) '
+                    "VALUES (?, ?, 'genius', ?)",
+                    [f'artist {number // 10}', f'song {number}', digest],
+                )
+            connection.commit()
+        # Merge the index segments created by the bulk insert
+        connection.execute(
+            "INSERT INTO lyrics_fts (lyrics_fts) VALUES ('optimize')"
+        )
+        connection.commit()
+    return words
+
+
+def snippet(database, songs, rand):
+    row = database._execute(
+        'SELECT dictionary, data FROM lyrics_text WHERE rowid=?',
+        [rand.randint(1, songs)],
+    )
+    words = database._decompress(row).split()
+    start = rand.randrange(len(words) - 6)
+    return ' '.join(words[start : start + rand.randint(3, 6)])
+
+
+def timed(database, queries):
+    times = []
+    for query in queries:
+        start = time.perf_counter()
+        database.search_lyrics(query, 10)
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return (
+        statistics.median(times),
+        times[int(len(times) * 0.95) - 1],
+        times[-1],
+    )
+
+
+def main():
+    songs = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    queries = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    rand = random.Random(0)
+    os.chdir(ROOT)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        database = DB(os.path.join(tmpdir, 'bench.db'))
+        database.config()
+        start = time.perf_counter()
+        words = fill(database, songs, rand)
+        elapsed = time.perf_counter() - start
+        print(f'Indexed {songs} songs in {elapsed:.1f}s')
+
+        snippets = [snippet(database, songs, rand) for _ in range(queries)]
+        common = words[:20]
+        for name, batch in (('snippets', snippets), ('common words', common)):
+            median, p95, worst = timed(database, batch)
+            print(
+                f'{name:>12}: median {median:6.2f}ms  p95 {p95:6.2f}ms  '
+                f'max {worst:6.2f}ms'
+            )
+        database.close()
+
+
+if __name__ == '__main__':
+    main()
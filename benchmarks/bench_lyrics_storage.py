@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Report the bytes on disk per saved song of the lyrics store.
+
+Fills two databases with the same synthetic lyrics: one with a naive layout,
+where the lyrics are stored uncompressed once for every song and source and
+indexed once per copy, and one through `DB.save_lyrics`, which stores them
+compressed and content-addressed. The size of the tables of both is compared.
+
+The synthetic songs have a repeated chorus, lines made of common phrases
+and some filler lines ("oh oh oh"), all drawn from Zipf distributions. Every
+song is found by one to three sources, with small whitespace differences, and
+some of them are saved again under a different version of the title.
+
+Usage: python benchmarks/bench_lyrics_storage.py [SONGS]
+"""
+import os
+import sys
+import time
+import itertools
+import random
+import sqlite3
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(ROOT)
+from db import DB, word_pairs
+
+VOCABULARY = 20000
+PHRASES = 5000
+FILLERS = 200
+SOURCES = ['azlyrics', 'genius', 'musixmatch']
+VERSIONS = ['remastered', 'live', 'demo']
+BATCH = 10000
+
+NAIVE_SCHEMA = """
+CREATE TABLE lyrics(
+    artist VARCHAR(64) NOT NULL,
+    title VARCHAR(128) NOT NULL,
+    source VARCHAR(64) NOT NULL,
+    lyrics BLOB,
+    CONSTRAINT PK_lyrics PRIMARY KEY (artist, title, source)
+);
+CREATE VIRTUAL TABLE lyrics_fts USING fts5(
+    lyrics,
+    pairs,
+    content='',
+    tokenize='unicode61 remove_diacritics 1 tokenchars _'
+);
+"""
+
+
+class Generator:
+    def __init__(self, rand):
+        self.rand = rand
+        letters = 'abcdefghijklmnopqrstuvwxyz'
+        words = set()
+        while len(words) < VOCABULARY:
+            words.add(''.join(rand.choices(letters, k=rand.randint(2, 9))))
+        self.words = sorted(words, key=len)
+        self.weights = list(
+            itertools.accumulate(1 / rank for rank in range(1, VOCABULARY + 1))
+        )
+        self.phrases = [
+            ' '.join(
+                rand.choices(
+                    self.words, cum_weights=self.weights, k=rand.randint(2, 4)
+                )
+            )
+            for _ in range(PHRASES)
+        ]
+        self.phrase_weights = list(
+            itertools.accumulate(1 / rank for rank in range(1, PHRASES + 1))
+        )
+        self.fillers = []
+        for _ in range(FILLERS):
+            word = rand.choice(['oh', 'yeah', 'la', 'na', 'hey'])
+            end = rand.choice(['', '!', '...'])
+            self.fillers.append(f'{word} {word} {word}{end}')
+        self.filler_weights = list(
+            itertools.accumulate(1 / rank for rank in range(1, FILLERS + 1))
+        )
+
+    def line(self):
+        count = self.rand.randint(2, 3)
+        phrases = self.rand.choices(
+            self.phrases, cum_weights=self.phrase_weights, k=count
+        )
+        return ' '.join(phrases).capitalize()
+
+    def stanza(self, lines=4):
+        return [self.line() for _ in range(lines)]
+
+    def lyrics(self):
+        chorus = self.stanza()
+        if self.rand.random() < 0.5:
+            filler = self.rand.choices(
+                self.fillers, cum_weights=self.filler_weights
+            )
+            chorus.extend(filler)
+        stanzas = []
+        for _ in range(self.rand.randint(2, 3)):
+            stanzas.append(self.stanza())
+            stanzas.append(chorus)
+        return '\n\n'.join('\n'.join(stanza) for stanza in stanzas)
+
+    def copies(self, number):
+        """
+        Return the rows of the lyrics table for a single song.
+        """
+        artist = f'artist {number // 10}'
+        titles = [f'song {number}']
+        if self.rand.random() < 0.2:
+            titles.append(f'song {number} {self.rand.choice(VERSIONS)}')
+        text = self.lyrics()
+        sources = self.rand.sample(SOURCES, self.rand.randint(1, 3))
+        rows = []
+        for title in titles:
+            for source in sources:
+                if source == 'azlyrics':
+                    copy = text.replace('\n', '\r\n') + '\r\n'
+                elif source == 'musixmatch':
+                    copy = '\n' + text.replace('\n', ' \n')
+                else:
+                    copy = text
+                rows.append((artist, title, source, copy))
+        return rows
+
+
+def sizes(filename):
+    """
+    Return the bytes used by the lyrics tables and the full text index.
+    """
+    conn = sqlite3.connect(filename)
+    conn.execute('VACUUM')
+    pages = conn.execute(
+        'SELECT name, SUM(pgsize) FROM dbstat GROUP BY name'
+    ).fetchall()
+    conn.close()
+    store = index = 0
+    for name, size in pages:
+        if name.startswith('lyrics_fts'):
+            index += size
+        elif 'lyrics' in name:
+            store += size
+    return store, index
+
+
+def rows(songs, rand):
+    """
+    Generate the (artist, title, source, lyrics) rows for every saved song,
+    in batches.
+    """
+    generator = Generator(rand)
+    for start in range(0, songs, BATCH):
+        batch = []
+        for number in range(start, min(start + BATCH, songs)):
+            batch.extend(generator.copies(number))
+        yield batch
+
+
+def fill_naive(filename, batches):
+    """
+    Fill a database with a full copy of the lyrics for every row, indexing
+    every one of them.
+    """
+    conn = sqlite3.connect(filename)
+    conn.executescript(NAIVE_SCHEMA)
+    for batch in batches:
+        for row in batch:
+            cursor = conn.execute(
+                'INSERT INTO lyrics VALUES (?, ?, ?, ?)',
+                [*row[:3], row[3].encode()],
+            )
+            conn.execute(
+                'INSERT INTO lyrics_fts (rowid, lyrics, pairs) '
+                'VALUES (?, ?, ?)',
+                [cursor.lastrowid, row[3], word_pairs(row[3])],
+            )
+        conn.commit()
+    conn.execute("INSERT INTO lyrics_fts (lyrics_fts) VALUES ('optimize')")
+    conn.commit()
+    conn.close()
+
+
+def fill_store(filename, batches):
+    """
+    Save every row with `DB.save_lyrics`. Returns the number of different
+    texts in the store.
+    """
+    database = DB(filename)
+    database.config()
+    # Every save is committed, which doesn't need to be durable here
+    database._connection.execute('PRAGMA synchronous=OFF')
+    for batch in batches:
+        for row in batch:
+            database.save_lyrics(*row)
+    database._execute(
+        "INSERT INTO lyrics_fts (lyrics_fts) VALUES ('optimize')"
+    )
+    texts = database._execute('SELECT COUNT(*) AS n FROM lyrics_text')['n']
+    database.close()
+    return texts
+
+
+def main():
+    songs = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    batches = list(rows(songs, random.Random(0)))
+    saved = sum(len(batch) for batch in batches)
+    os.chdir(ROOT)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        naive = os.path.join(tmpdir, 'naive.db')
+        fill_naive(naive, batches)
+        before = sizes(naive)
+
+        store = os.path.join(tmpdir, 'store.db')
+        start = time.perf_counter()
+        texts = fill_store(store, batches)
+        elapsed = time.perf_counter() - start
+        after = sizes(store)
+
+    print(
+        f'{saved} saved songs with {songs} different lyrics, stored as '
+        f'{texts} texts. Saved in {elapsed:.1f}s'
+    )
+    print(f'{"bytes per song":>14}  {"lyrics":>8}  {"index":>8}  {"total":>8}')
+    for name, (store, index) in (('naive', before), ('store', after)):
+        print(
+            f'{name:>14}  {store / saved:8.0f}  {index / saved:8.0f}  '
+            f'{(store + index) / saved:8.0f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
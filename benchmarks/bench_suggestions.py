@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Benchmark the prefix index used to answer inline queries.
+
+Builds a `PrefixIndex` of synthetic songs, indexed by "artist - title" and
+by title like the bot does, with Zipf distributed weights, and times searches
+for prefixes of random lengths of random songs, like the ones sent while the
+user is typing.
+
+Usage: python benchmarks/bench_suggestions.py [SONGS] [QUERIES]
+"""
+import os
+import sys
+import time
+import random
+import statistics
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from index import PrefixIndex
+
+
+def make_name(rand, words):
+    return ' '.join(rand.choices(words, k=rand.randint(1, 4))).title()
+
+
+def main():
+    songs = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    queries = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    rand = random.Random(0)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = [
+        ''.join(rand.choices(letters, k=rand.randint(2, 8)))
+        for _ in range(5000)
+    ]
+    artists = [make_name(rand, words) for _ in range(songs // 10)]
+    names = []
+    entries = []
+    for rank in range(1, songs + 1):
+        title = make_name(rand, words)
+        name = f'{rand.choice(artists)} - {title}'
+        weight = int(1000 / rank)
+        names.append(name)
+        entries.append((name, name, weight))
+        entries.append((title, name, weight))
+
+    start = time.perf_counter()
+    index = PrefixIndex(entries)
+    elapsed = time.perf_counter() - start
+    print(f'Indexed {songs} songs in {elapsed:.2f}s')
+
+    times = []
+    for _ in range(queries):
+        name = rand.choice(names)
+        if rand.random() < 0.5:
+            name = name.partition(' - ')[2]
+        prefix = name[: rand.randint(0, len(name))]
+        start = time.perf_counter()
+        index.search(prefix, 10)
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    print(
+        f'median {statistics.median(times):.3f}ms  '
+        f'p95 {times[int(len(times) * 0.95) - 1]:.3f}ms  '
+        f'p99 {times[int(len(times) * 0.99) - 1]:.3f}ms  '
+        f'max {times[-1]:.3f}ms'
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Benchmark the multi-process deployment mode.
+
+Every simulated update processes a synthetic album catalog with
+`util.process`, which is the CPU-bound part of building a discography. The
+same batch of updates is dispatched to pools of increasing size and the
+throughput of each one is reported.
+
+Usage: python benchmarks/bench_workers.py [UPDATES] [MAX_WORKERS]
+"""
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from util import process
+from workers import Worker, WorkerPool
+
+
+CATALOG = [
+    f'Track {i} - {year} Remastered Version (Live at Wacken {year})'
+    for i, year in enumerate(range(1970, 2020))
+] * 4
+
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+
+class FakeUpdate:
+    def __init__(self, chat_id):
+        self.effective_chat = FakeChat(chat_id)
+        self.effective_user = None
+
+    def to_dict(self):
+        return {'chat_id': self.effective_chat.id}
+
+
+class BenchWorker(Worker):
+    def setup(self):
+        pass
+
+    def handle(self, data):
+        for name in CATALOG:
+            process(name, key='name')
+            process(name, key='album')
+
+    def teardown(self):
+        pass
+
+
+def run(workers, updates):
+    pool = WorkerPool({}, workers, worker_class=BenchWorker)
+    pool.start()
+    start = time.perf_counter()
+    for chat_id in range(updates):
+        pool.dispatch(FakeUpdate(chat_id))
+    pool.terminate()
+    return updates / (time.perf_counter() - start)
+
+
+def main():
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    base = None
+    workers = 1
+    while workers <= max_workers:
+        throughput = run(workers, updates)
+        base = base or throughput
+        print(
+            f'{workers:>3} workers: {throughput:8.1f} updates/s '
+            f'(speedup x{throughput / base:.2f})'
+        )
+        workers *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -5,36 +5,104 @@ import logging
 import json
 import sqlite3
 import time
+import threading
 from functools import partial
-from collections import defaultdict
+from functools import wraps
+from urllib.error import HTTPError
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
 
 import telegram
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
 import lyricfetch as lyrics
 from lyricfetch import Song
 from lyricfetch import scraping
 from lyricfetch.run import get_lyrics_threaded
+from lyricfetch.run import Result
 from lyricfetch.scraping import get_lastfm
 from lyricfetch.scraping import id_source
 
+from cache import LRUCache
+from conversation import ConversationStore
 from db import DB as Database
+from index import track_index
+from index import PrefixIndex
 from spotify import Spotify
 from util import capwords
+from util import process
+from util import song_key
+from util import split_message
+from util import Reply
 from logger import logger
-from server import Server
+from metrics import METRICS
+from breaker import Breakers
+from breaker import CircuitOpen
+from scheduler import ChatScheduler
+from sender import Sender
+from supersede import Supersession
+from supersede import Token
 
 
 HELPFILE = './help.txt'
+LASTFM_TTL = 7 * 24 * 60 * 60
+ALBUM_DEADLINE = 10
+NOW_TTL = 30
+LOGIN_WAIT = 30
+SEARCH_RESULTS = 10
+INLINE_RESULTS = 10
+SUGGEST_TTL = 10 * 60
+PREFETCH_BUDGET = 4
+LYRICS_JOBS = 4
+BATCH_SIZE = 20
+PLACEHOLDER_DELAY = 0.5
 CONFFILE = './config.json'
 MSG_TEMPLATE = """\
 FROM: {source}
 *{artist} - {title}*
 
 {lyrics}"""
+PLACEHOLDER_MSG = 'Looking for the lyrics, just a moment...'
+BUSY_MSG = (
+    "I'm a bit busy right now, please try again in a moment. "
+    "I'm still working on your previous requests."
+)
 
 DB = Database()
 SP = Spotify()
-HANDLERS = defaultdict(list)
+HANDLERS = ConversationStore()
+SCHEDULER = ChatScheduler()
+SENDER = Sender()
+ALBUM_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix='album')
+# Shared by all chats, to bound the number of songs scraped at the same time
+LYRICS_POOL = ThreadPoolExecutor(LYRICS_JOBS, thread_name_prefix='lyrics')
+
+# Circuit breakers for lastfm and every lyrics source, by name. Spotify has
+# its own. See is_unavailable and guard_sources
+BREAKERS = Breakers(is_failure=lambda error: is_unavailable(error))
+
+# Speculative prefetching of the next song in the album. See prefetch_next
+PREFETCH = False
+PREFETCH_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix='pref')
+PREFETCH_SLOTS = threading.BoundedSemaphore(PREFETCH_BUDGET)
+
+# Acknowledge slow searches with a placeholder. See send_progressively
+PROGRESSIVE = False
+
+# Rendered replies for the latest songs found, indexed by song and sources
+REPLIES = LRUCache(maxsize=1000)
+# Spotify user tokens by chat id, written through to the database
+TOKENS = LRUCache(maxsize=10000)
+# Last reply to /now by chat id, as (track id, result, reply, expiration)
+# tuples
+NOW_PLAYING = LRUCache(maxsize=10000, ttl=60 * 60)
+
+# Latest search of every chat, and the one running in each thread. See queued
+SEARCHES = Supersession()
+CURRENT = threading.local()
+
+# Prefix index of known songs for inline queries. See get_suggestions
+SUGGESTIONS = PrefixIndex(())
+SUGGESTIONS_BUILT = 0
+SUGGESTIONS_LOCK = threading.Lock()
 
 
 def start(update, context):
@@ -59,13 +127,50 @@ def get_album_tracks_spotify(song):
     return SP.get_album_tracks(song)
 
 
-def get_album_tracks_lastfm(song):
+def cached_lastfm(key, fetch):
     """
-    Search lastfm for list of tracks in the album this song belongs to.
+    Get the result of a lastfm lookup from the persistent cache, or call
+    'fetch' to get it and cache it for LASTFM_TTL seconds.
+
+    The key is a tuple of normalized strings. Empty results are not cached.
+    """
+    key = 'lastfm:' + ':'.join(key)
+    try:
+        value = DB.get_cached(key)
+        if value is not None:
+            logger.debug('found %s in cache', key)
+            return value
+    except sqlite3.Error as error:
+        logger.exception(error)
+
+    try:
+        value = BREAKERS['lastfm'].call(fetch)
+    except CircuitOpen:
+        logger.info('lastfm is unavailable, %s not fetched', key)
+        return None
+    if value:
+        try:
+            DB.save_cached(key, value, LASTFM_TTL)
+        except sqlite3.Error as error:
+            logger.exception(error)
+    return value
+
+
+def fetch_album_name_lastfm(song):
+    """
+    Request the name of the song's album from lastfm. Returns None if lastfm
+    doesn't know it, instead of the album the song already had.
+    """
+    copy = Song(song.artist, song.title)
+    copy.album = None
+    copy.fetch_album_name()
+    return copy.album
+
+
+def fetch_album_tracks_lastfm(song):
+    """
+    Request the list of tracks of the song's album from lastfm.
     """
-    song.fetch_album_name()
-    if not song.album:
-        return []
     tracks = get_lastfm('album.getInfo', artist=song.artist, album=song.album)
     if not tracks:
         return []
@@ -74,16 +179,99 @@ def get_album_tracks_lastfm(song):
     return tracks
 
 
+def get_album_tracks_lastfm(song):
+    """
+    Search lastfm for list of tracks in the album this song belongs to.
+    """
+    artist, title = song_key(song)
+    album = cached_lastfm(
+        ('album', artist, title), partial(fetch_album_name_lastfm, song)
+    )
+    song.album = album or song.album
+    if not song.album:
+        return []
+
+    album = process(song.album, key='album', invalid=False)
+    return cached_lastfm(
+        ('tracks', artist, album), partial(fetch_album_tracks_lastfm, song)
+    )
+
+
+def _album_result(future, deadline):
+    """
+    Wait for an album lookup until the deadline. Returns None if it failed or
+    didn't finish in time.
+    """
+    try:
+        return future.result(timeout=max(deadline - time.monotonic(), 0))
+    except FutureTimeout:
+        logger.info('album lookup timed out')
+    except Exception as error:
+        logger.exception(error)
+    return None
+
+
 def get_album_tracks(song):
     """
     Get the list of tracks in the album this song belongs to.
+
+    Spotify and lastfm are searched at the same time, and the spotify result
+    is preferred if it arrives before the deadline. The song's album is
+    updated with the one from the provider whose result was used.
     """
-    tracks = get_album_tracks_spotify(song)
-    if tracks:
-        logger.debug('found track list from spotify')
-        return tracks
-    logger.debug('no track list from spotify, searching lastfm')
-    return get_album_tracks_lastfm(song)
+    deadline = time.monotonic() + ALBUM_DEADLINE
+    lookups = []
+    for lookup in (get_album_tracks_spotify, get_album_tracks_lastfm):
+        copy = Song(song.artist, song.title, song.album)
+        lookups.append((ALBUM_POOL.submit(lookup, copy), copy))
+
+    for (future, copy), provider in zip(lookups, ('spotify', 'lastfm')):
+        tracks = _album_result(future, deadline)
+        if tracks:
+            logger.debug('found track list from %s', provider)
+            song.album = copy.album
+            return tracks
+        logger.debug('no track list from %s', provider)
+    return []
+
+
+def find_next_song(song):
+    """
+    Find the song that comes after this one in its album. If the title is not
+    exactly in the track list, the most similar track is used instead.
+
+    Returns a Song object, or an error message if there is no next song.
+    """
+    tracks = get_album_tracks(song)
+    if not tracks:
+        logger.info('no track list found')
+        return 'Could not find the album this song belongs to'
+
+    title = song.title.lower()
+    if title not in tracks:
+        title = process(title, key='name', invalid=False)
+        title = track_index(tracks).best(title)
+        if not title:
+            logger.info('title not found in track list')
+            return 'Could not find the album this song belongs to'
+        logger.debug('matched title to %s', title)
+    if title == tracks[-1]:
+        return 'That was the last song on the album'
+    new_title = tracks[tracks.index(title) + 1]
+    return Song(artist=song.artist, title=new_title, album=song.album)
+
+
+def last_song(chat_id):
+    """
+    Get the last song that was searched for in a chat, or None if there
+    isn't any.
+    """
+    last_res = DB.get_last_res(chat_id)
+    if not last_res:
+        return None
+    album = last_res['album']
+    album = album if album != 'Unknown' else None
+    return Song(last_res['artist'], last_res['title'], album)
 
 
 def _get_next_song(chat_id):
@@ -92,26 +280,13 @@ def _get_next_song(chat_id):
     """
     msg = 'OOPS'
     try:
-        last_res = DB.get_last_res(chat_id)
-        if not last_res:
+        song = last_song(chat_id)
+        if not song:
             return "You haven't searched for anything yet"
 
-        album = last_res['album']
-        album = album if album != 'Unknown' else None
-        song = Song(last_res['artist'], last_res['title'], album)
-        tracks = get_album_tracks(song)
-        if not tracks:
-            logger.info('no track list found')
-            return 'Could not find the album this song belongs to'
-
-        title = song.title.lower()
-        if title not in tracks:
-            logger.info('title not found in track list')
-            return 'Could not find the album this song belongs to'
-        if title == tracks[-1]:
-            return 'That was the last song on the album'
-        new_title = tracks[tracks.index(title) + 1]
-        new_song = Song(artist=song.artist, title=new_title, album=song.album)
+        new_song = find_next_song(song)
+        if isinstance(new_song, str):
+            return new_song
         msg = get_lyrics(new_song, chat_id)
     except sqlite3.Error:
         msg = (
@@ -125,25 +300,101 @@ def next_song(update, context):
     """
     Get lyrics for the next song in the album.
     """
-    msg = _get_next_song(update.message.chat_id)
-    send_message(msg, context.bot, update.message.chat_id)
+    chat_id = update.message.chat_id
+    if PROGRESSIVE:
+        search = partial(_get_next_song, chat_id)
+        send_progressively(search, context.bot, chat_id)
+        return
+    msg = _get_next_song(chat_id)
+    send_message(msg, context.bot, chat_id)
+
+
+def fetch_replies(songs, sources):
+    """
+    Find the lyrics for a list of songs, LYRICS_JOBS songs at a time, and
+    yield (result, reply) tuples like the ones from `fetch_reply()` in the same
+    order, as soon as each one and all the ones before it are ready.
+
+    If the search is superseded, the songs that didn't start yet are
+    cancelled and nothing else is yielded.
+    """
+    futures = [
+        LYRICS_POOL.submit(fetch_reply, song, sources) for song in songs
+    ]
+    for position, (song, future) in enumerate(zip(songs, futures)):
+        if superseded():
+            cancelled = sum(future.cancel() for future in futures[position:])
+            logger.info('Cancelled %d superseded songs', cancelled)
+            METRICS.incr('searches.cancelled_songs', cancelled)
+            return
+        try:
+            yield future.result()
+        except Exception as error:
+            logger.exception(error)
+            artist = capwords(song.artist)
+            title = capwords(song.title)
+            yield None, f'Lyrics for {artist} - {title} could not be found'
+
+
+def album(update, context):
+    """
+    Get lyrics for every song in an album. The album is the one of the song
+    passed as an argument, or of the last song searched for.
+    """
+    chat_id = update.message.chat_id
+    send = partial(send_message, bot=context.bot, chat_id=chat_id)
+    context.bot.send_chat_action(
+        chat_id=chat_id, action=telegram.ChatAction.TYPING
+    )
+    try:
+        if context.args:
+            song = get_song_from_string(' '.join(context.args), chat_id)
+            if not song:
+                send('Invalid format!')
+                return
+        else:
+            song = last_song(chat_id)
+            if not song:
+                send("You haven't searched for anything yet")
+                return
+    except sqlite3.Error:
+        send(
+            "There was an error while looking through the conversation's "
+            "history. This command is unavailable for now."
+        )
+        return
+
+    tracks = get_album_tracks(song)
+    if not tracks:
+        send('Could not find the album this song belongs to')
+        return
+    name = capwords(song.album) if song.album else 'the album'
+    send(f'Looking for the lyrics of the {len(tracks)} songs in {name}')
+    songs = [Song(song.artist, track, song.album) for track in tracks]
+    for res, reply in fetch_replies(songs, lyrics.sources):
+        if res:
+            log_result(chat_id, res)
+        send(reply)
 
 
 def get_sp_token(chat_id):
     """
     Get a saved Spotify user token. Refresh it if it expired.
     """
-    token = DB.get_sp_token(chat_id)
-    if not token:
-        return None
+    token = TOKENS.get(chat_id)
+    if token is None:
+        token = DB.get_sp_token(chat_id)
+        if not token:
+            return None
+        TOKENS.set(chat_id, token)
 
     if token['expires'] and int(token['expires']) < time.time():
         logger.info('Refreshing access token')
         token = SP.refresh_access_token(token['refresh'])
         logger.debug(token)
-        DB.save_sp_token(
+        save_sp_token(
+            chat_id,
             token['access_token'],
-            chat_id=chat_id,
             refresh=token['refresh_token'],
             expires=token['expires_at'],
         )
@@ -151,37 +402,101 @@ def get_sp_token(chat_id):
     return token['token']
 
 
+def save_sp_token(chat_id, token, refresh=None, expires=None):
+    """
+    Save a Spotify user token in the database and the in-memory cache.
+    """
+    DB.save_sp_token(token, chat_id=chat_id, refresh=refresh, expires=expires)
+    TOKENS.set(
+        chat_id, {'token': token, 'refresh': refresh, 'expires': expires}
+    )
+
+
+def invalidate_sp_token(chat_id):
+    """
+    Drop the cached token for a chat, so that it's read again from the
+    database next time. Called when the user logs in to Spotify again.
+    """
+    TOKENS.pop(chat_id)
+
+
+def watch_auth(events, invalidate=invalidate_sp_token):
+    """
+    Invalidate the cached token of every chat id received from the auth
+    server, until a None is received.
+    """
+    for chat_id in iter(events.get, None):
+        invalidate(chat_id)
+
+
 def now(update, context):
     """
     Search for the lyrics of the song that the user is playing on Spotify.
+
+    If the user isn't logged in to Spotify, the login link is sent and the
+    login is waited for up to LOGIN_WAIT seconds.
+
+    The reply is reused without asking Spotify again for up to NOW_TTL
+    seconds, as long as the track would still be playing, and without
+    searching for the lyrics again while the track doesn't change.
     """
     chat_id = update.message.chat_id
     send = partial(send_message, bot=context.bot, chat_id=chat_id)
+    last = NOW_PLAYING.get(chat_id)
+    if last and last[3] > time.monotonic():
+        logger.debug('Reusing the last reply to /now')
+        # Log it again, since other searches may have been logged since then
+        log_result(chat_id, last[1])
+        send(last[2])
+        return
+
     token = get_sp_token(chat_id)
     if not token:
         auth_url = SP.get_auth_url(chat_id)
         send('Please open this link to log in to Spotify')
         send(auth_url, raw=True)
+        # Don't hold a scheduler worker for longer than LOGIN_WAIT seconds
+        deadline = time.monotonic() + LOGIN_WAIT
         while True:
             token = DB.get_sp_token(chat_id)
             if token and token['token']:
                 break
+            if superseded():
+                return
+            if time.monotonic() >= deadline:
+                send('Send /now again once you have logged in')
+                return
             time.sleep(1)
 
         token = SP.get_access_token(token['token'])
-        DB.save_sp_token(
-            token['access_token'],
+        save_sp_token(
             chat_id,
+            token['access_token'],
             expires=token['expires_at'],
             refresh=token['refresh_token'],
         )
         token = token['access_token']
-    current = SP.currently_playing(token)
+    try:
+        current = SP.currently_playing(token)
+    except CircuitOpen:
+        send('Spotify is not responding right now, try again in a while')
+        return
     if not current:
         send('There is nothing playing!')
+        return
+
+    track_id = getattr(current, 'track_id', None)
+    if last and track_id and last[0] == track_id:
+        logger.debug('Track has not changed since the last /now')
+        res, lyrics_str = last[1], last[2]
+        log_result(chat_id, res)
     else:
-        lyrics_str = get_lyrics(current, chat_id)
-        send(lyrics_str)
+        res, lyrics_str = find_lyrics(current, chat_id)
+    if track_id and res and isinstance(lyrics_str, Reply):
+        ttl = min(getattr(current, 'remaining', 0), NOW_TTL)
+        expires = time.monotonic() + ttl
+        NOW_PLAYING.set(chat_id, (track_id, res, lyrics_str, expires))
+    send(lyrics_str)
 
 
 def other(update, context):
@@ -211,6 +526,34 @@ def other(update, context):
     send_message(msg, context.bot, update.message.chat_id)
 
 
+def search(update, context):
+    """
+    Find songs by a snippet of their lyrics. Only the lyrics that the bot has
+    already found are searched.
+    """
+    text = ' '.join(context.args or [])
+    if not text:
+        msg = (
+            'Tell me some of the lyrics to look for, like: '
+            '/search is this the real life'
+        )
+    else:
+        try:
+            songs = DB.search_lyrics(text, SEARCH_RESULTS)
+        except sqlite3.Error as error:
+            logger.exception(error)
+            songs = None
+            msg = 'Search is unavailable for now'
+        if songs:
+            msg = 'These songs match your search:\n' + '\n'.join(
+                f'{i}. {capwords(song["artist"])} - {capwords(song["title"])}'
+                for i, song in enumerate(songs, 1)
+            )
+        elif songs is not None:
+            msg = "I don't know any songs with those lyrics"
+    send_message(msg, context.bot, update.message.chat_id)
+
+
 def get_song_from_string(song, chat_id):
     """
     Parse the user's input and return a song object from it.
@@ -241,39 +584,187 @@ def log_result(chat_id, result):
         logger.exception(err)
 
 
+def log_results(chat_id, results):
+    """
+    Log a list of search results to the database at once.
+    """
+    try:
+        DB.log_results(chat_id, results)
+    except sqlite3.Error as err:
+        logger.exception(err)
+
+
 def get_lyrics(song, chat_id, sources=None):
     """
     Get lyrics for a song. The 'song' parameter can be either an unparsed
     string directly from the user or a full Song object.
     """
-    msg = ''
+    return find_lyrics(song, chat_id, sources)[1]
+
+
+def find_lyrics(song, chat_id, sources=None):
+    """
+    Like `get_lyrics()`, but returns a (result, reply) tuple, where the result
+    is None if the lyrics were not found.
+    """
+    res, msg = None, ''
     try:
         song = get_song_from_string(song, chat_id)
         if not song:
-            return 'Invalid format!'
+            return None, 'Invalid format!'
         logger.info('Searching for song %s', song)
 
         if sources is None:
             sources = lyrics.sources
-        res = get_lyrics_threaded(song, sources)
+        if superseded():
+            return None, msg
+        res, msg = fetch_reply(song, sources)
+        # Superseded searches are not replied to, so they're not logged
+        if res and not superseded():
+            log_result(chat_id, res)
+            prefetch_next(res.song)
+    except Exception as error:
+        logger.exception(error)
+        res, msg = None, 'Unknown error'
+
+    return res, msg
+
+
+def get_saved_lyrics(song, sources):
+    """
+    Get lyrics for a song from the database, if they were found by any of the
+    sources in this list of names.
 
-        artist = capwords(song.artist)
-        title = capwords(song.title)
-        if res.source is None or song.lyrics == '':
-            msg = f'Lyrics for {artist} - {title} could not be found'
+    Returns a Result object like the one returned by `get_lyrics_threaded`, or
+    None if the lyrics are not saved.
+    """
+    try:
+        saved = DB.get_lyrics(*song_key(song), sources)
+    except sqlite3.Error as error:
+        logger.exception(error)
+        return None
+    if not saved:
+        return None
+    logger.debug('Found saved lyrics for %s', song)
+    song.lyrics = saved['lyrics']
+    return Result(song, getattr(scraping, saved['source']))
+
+
+def save_lyrics(result):
+    """
+    Save the lyrics in a result to the database.
+    """
+    try:
+        DB.save_lyrics(
+            *song_key(result.song),
+            result.source.__name__,
+            result.song.lyrics,
+        )
+    except sqlite3.Error as error:
+        logger.exception(error)
+
+
+def is_unavailable(error):
+    """
+    Tell if an error from a lyrics website or lastfm means that it's
+    unavailable, and not just that it doesn't have the page we asked for.
+    """
+    if isinstance(error, HTTPError):
+        return error.code == 429 or error.code >= 500
+    return True
+
+
+def guard_sources(sources):
+    """
+    Get the sources in a list that can be searched right now, leaving out the
+    ones whose circuit breaker is open. The returned functions record the
+    outcome of every search in the source's breaker.
+    """
+    guarded = []
+    for source in sources:
+        breaker = BREAKERS[source.__name__]
+        if breaker.allow():
+            guarded.append(wraps(source)(partial(breaker.measure, source)))
         else:
-            msg = MSG_TEMPLATE.format(
-                source=id_source(res.source, True).lower(),
-                artist=artist,
-                title=title,
-                lyrics=song.lyrics,
+            logger.debug('Skipping %s, it is unavailable', source.__name__)
+    return guarded
+
+
+def fetch_reply(song, sources):
+    """
+    Search for the lyrics of a song and render the reply for the user.
+
+    Returns a (result, reply) tuple, where the result is None if the lyrics
+    were not found. Replies for songs that were found are cached.
+    """
+    names = [source.__name__ for source in sources]
+    key = (*song_key(song), *names)
+    cached = REPLIES.get(key)
+    if cached:
+        logger.debug('Found rendered reply in cache')
+        return cached
+
+    artist = capwords(song.artist)
+    title = capwords(song.title)
+    res = get_saved_lyrics(song, names)
+    if res is None:
+        guarded = guard_sources(sources)
+        if sources and not guarded:
+            METRICS.incr('searches.unavailable')
+            return None, (
+                f'Lyrics for {artist} - {title} could not be found, because '
+                'the lyrics websites are not responding right now. Please '
+                'try again in a while'
             )
-            log_result(chat_id, res)
+        res = get_lyrics_threaded(song, guarded)
+        # Results point to the guarded version of the source
+        res.source = getattr(res.source, '__wrapped__', res.source)
+        if res.source is not None and song.lyrics != '':
+            save_lyrics(res)
+
+    if res.source is None or song.lyrics == '':
+        return None, f'Lyrics for {artist} - {title} could not be found'
+
+    msg = MSG_TEMPLATE.format(
+        source=id_source(res.source, True).lower(),
+        artist=artist,
+        title=title,
+        lyrics=song.lyrics,
+    )
+    msg = Reply.render(msg, telegram.constants.MAX_MESSAGE_LENGTH)
+    REPLIES.set(key, (res, msg))
+    return res, msg
+
+
+def prefetch_next(song):
+    """
+    Find the lyrics for the song after this one in its album in the
+    background, so that they are already cached if the user asks for them.
+
+    Only done if PREFETCH is enabled and the song's album is known. At most
+    PREFETCH_BUDGET songs are prefetched at the same time, and any extra
+    requests are simply ignored.
+    """
+    if not PREFETCH or not song.album or song.album == 'Unknown':
+        return
+    if not PREFETCH_SLOTS.acquire(blocking=False):
+        logger.debug('prefetch budget exhausted, skipping %s', song)
+        return
+
+    song = Song(song.artist, song.title, song.album)
+    future = PREFETCH_POOL.submit(_prefetch_next, song)
+    future.add_done_callback(lambda _: PREFETCH_SLOTS.release())
+
+
+def _prefetch_next(song):
+    try:
+        new_song = find_next_song(song)
+        if isinstance(new_song, str):
+            return
+        logger.debug('prefetching %s', new_song)
+        fetch_reply(new_song, lyrics.sources)
     except Exception as error:
         logger.exception(error)
-        msg = 'Unknown error'
-
-    return msg
 
 
 def text(update, context):
@@ -281,8 +772,8 @@ def text(update, context):
     Generic text input handler.
     """
     chat_id = update.message.chat_id
-    if HANDLERS[chat_id]:
-        handler = HANDLERS[chat_id].pop()
+    handler = HANDLERS.pop(chat_id)
+    if handler:
         handler(update, context)
         return
 
@@ -292,42 +783,156 @@ def text(update, context):
 
 def find(update, context):
     """
-    Find lyrics for a song.
+    Find lyrics for a song, or for several of them if the message has more
+    than one line.
     """
     chat_id = update.message.chat_id
     bot = context.bot
     bot.send_chat_action(chat_id=chat_id, action=telegram.ChatAction.TYPING)
+    lines = [line for line in update.message.text.splitlines() if line.strip()]
+    if len(lines) > 1:
+        send = partial(send_message, bot=bot, chat_id=chat_id)
+        find_batch(lines, chat_id, send)
+        return
+    if PROGRESSIVE:
+        search = partial(get_lyrics, update.message.text, chat_id)
+        send_progressively(search, bot, chat_id)
+        return
     lyrics_str = get_lyrics(update.message.text, chat_id)
     send_message(lyrics_str, context.bot, chat_id)
 
 
+def find_batch(lines, chat_id, send):
+    """
+    Find lyrics for a song in every line of a message. Repeated songs are only
+    searched for once, and only the first BATCH_SIZE songs are searched for.
+    They are looked up LYRICS_JOBS at a time (see `fetch_replies()`), and
+    replies are sent in order as they are ready.
+    """
+    songs = {}
+    invalid = []
+    for line in lines:
+        try:
+            song = get_song_from_string(line.strip(), chat_id)
+        except sqlite3.Error as error:
+            logger.exception(error)
+            song = None
+        if song:
+            songs.setdefault(song_key(song), song)
+        else:
+            invalid.append(line.strip())
+    if invalid:
+        send('Invalid format:\n' + '\n'.join(invalid))
+    songs = list(songs.values())
+    if len(songs) > BATCH_SIZE:
+        send(
+            f'I can only look for {BATCH_SIZE} songs at a time, '
+            'so I will skip the rest'
+        )
+        songs = songs[:BATCH_SIZE]
+
+    logger.info('Searching for %d songs', len(songs))
+    results = []
+    for res, reply in fetch_replies(songs, lyrics.sources):
+        if res:
+            results.append(res)
+        send(reply)
+    log_results(chat_id, results)
+
+
 def send_message(msg, bot, chat_id, raw=False):
     """
-    Splits a string into MAX_LENGTH chunks and sends them as messages.
+    Splits a string into MAX_LENGTH chunks and sends them as messages
+    through the rate limited sender.
+
+    The message can also be a `Reply` or a sequence of chunks that were
+    already split with `split_message()`.
+
+    Nothing is sent from a search that has been superseded.
     """
+    if superseded():
+        logger.debug('Not replying to a superseded search')
+        return
     parse_mode = 'Markdown' if not raw else None
-    send = partial(bot.send_message, chat_id=chat_id, parse_mode=parse_mode)
+    send = partial(SENDER.send, bot, chat_id, parse_mode=parse_mode)
     try:
-        last_section = 0
-        chunksize = telegram.constants.MAX_MESSAGE_LENGTH
-        for section in range(chunksize, len(msg), chunksize):
-            section = msg.rfind('\n\n', last_section, section)
+        send(message_chunks(msg))
+    except telegram.TelegramError as error:
+        logger.exception(error)
+        msg = 'Unknown error'
+        send([msg])
 
-            # If we moved so far back that we got to the starting point, ignore
-            # the 'avoid splitting' thing and just cut where you can
-            if section == -1 or section <= last_section:
-                section = last_section + chunksize
 
-            send(text=msg[last_section:section])
-            last_section = section
+def message_chunks(msg):
+    """
+    Get the list of chunks a message is sent as. See `send_message()`.
+    """
+    if isinstance(msg, Reply):
+        return msg.chunks
+    if isinstance(msg, str):
+        return split_message(msg, telegram.constants.MAX_MESSAGE_LENGTH)
+    return msg
 
-        if last_section < len(msg):
-            send(text=msg[last_section : len(msg)])
 
+def send_placeholder(bot, chat_id, token=None):
+    """
+    Send the placeholder message for a search that is taking a while. Returns
+    the sent message, or None if it couldn't be sent or the search was already
+    superseded.
+    """
+    if token is not None and token.cancelled:
+        return None
+    try:
+        return SENDER.send(bot, chat_id, [PLACEHOLDER_MSG])[0]
     except telegram.TelegramError as error:
         logger.exception(error)
-        msg = 'Unknown error'
-        send(text=msg)
+        return None
+
+
+def send_progressively(search, bot, chat_id):
+    """
+    Run a search and send its reply, acknowledging it with a placeholder
+    message if the reply is not ready after PLACEHOLDER_DELAY seconds. The
+    placeholder is then edited to become the first chunk of the reply, and
+    the rest of the chunks are sent after it.
+
+    Cached replies are usually ready before the delay, and are sent as usual
+    without any placeholder.
+    """
+    token = getattr(CURRENT, 'token', None)
+    placeholder = []
+    timer = threading.Timer(
+        PLACEHOLDER_DELAY,
+        lambda: placeholder.append(send_placeholder(bot, chat_id, token)),
+    )
+    timer.start()
+    try:
+        msg = search()
+    finally:
+        # Wait for the placeholder in case it is being sent right now
+        timer.cancel()
+        timer.join()
+
+    message = placeholder[0] if placeholder else None
+    if message is None:
+        send_message(msg, bot, chat_id)
+        return
+    if superseded():
+        logger.debug('Removing the placeholder of a superseded search')
+        try:
+            bot.delete_message(chat_id=chat_id, message_id=message.message_id)
+        except telegram.TelegramError as error:
+            logger.warning('Could not remove placeholder: %s', error)
+        return
+
+    chunks = message_chunks(msg)
+    try:
+        SENDER.edit(bot, message, chunks[0], parse_mode='Markdown')
+    except telegram.TelegramError as error:
+        # The placeholder may have been deleted, send the chunk anyway
+        logger.warning('Could not edit placeholder: %s', error)
+        send_message(chunks[:1], bot, chat_id)
+    send_message(chunks[1:], bot, chat_id)
 
 
 def unknown(update, context):
@@ -354,33 +959,234 @@ def parse_config():
         return data
 
 
-def main():
-    config = parse_config()
-    if not config:
-        return 1
+def build_suggestions():
+    """
+    Build a prefix index of the songs in the log, weighted by the number of
+    chats that searched for them, and the tracks in the cached discographies.
+    Songs can be found by their artist and title, or by their title only.
+    """
+    songs = {}
+    try:
+        for row in DB.get_song_counts():
+            name = f'{capwords(row["artist"])} - {capwords(row["title"])}'
+            # The same song can be logged with different capitalization
+            _, _, chats = songs.get(name.lower(), (None, None, 0))
+            songs[name.lower()] = (name, row['title'], chats + row['chats'])
+    except sqlite3.Error as error:
+        logger.exception(error)
+    for key, discog in list(SP.discography_cache.items()):
+        # The cache keys are normalized, so use spotify's name if it's known
+        artist = getattr(discog, 'artist', None) or capwords(key)
+        for album in discog.values():
+            for track in album['tracks']:
+                name = f'{artist} - {capwords(track)}'
+                songs.setdefault(name.lower(), (name, track, 0))
+
+    entries = []
+    for name, title, weight in songs.values():
+        entries.append((name, name, weight))
+        entries.append((title, name, weight))
+    return PrefixIndex(entries)
+
+
+def refresh_suggestions():
+    """
+    Replace the prefix index for inline queries with an up to date one.
+    """
+    global SUGGESTIONS
+    try:
+        start = time.monotonic()
+        SUGGESTIONS = build_suggestions()
+        elapsed = time.monotonic() - start
+        logger.info('Built suggestions index in %.2fs', elapsed)
+    except Exception as error:
+        logger.exception(error)
+    finally:
+        SUGGESTIONS_LOCK.release()
 
-    updater = Updater(config['token'], use_context=True)
-    updater.dispatcher.add_handler(CommandHandler('start', start))
-    updater.dispatcher.add_handler(CommandHandler('other', other))
-    updater.dispatcher.add_handler(CommandHandler('next', next_song))
-    updater.dispatcher.add_handler(CommandHandler('now', now))
-    updater.dispatcher.add_handler(MessageHandler(Filters.text, text))
-    updater.dispatcher.add_handler(MessageHandler(Filters.command, unknown))
 
+def get_suggestions():
+    """
+    Get the prefix index for inline queries. If it's older than SUGGEST_TTL, a
+    new one is built in the background, and the old one is returned meanwhile.
+    """
+    global SUGGESTIONS_BUILT
+    now = time.monotonic()
+    if now - SUGGESTIONS_BUILT > SUGGEST_TTL:
+        if SUGGESTIONS_LOCK.acquire(blocking=False):
+            SUGGESTIONS_BUILT = now
+            thread = threading.Thread(target=refresh_suggestions, daemon=True)
+            thread.start()
+    return SUGGESTIONS
+
+
+def inline_query(update, context):
+    """
+    Function to be called on inline queries. Suggests known songs that start
+    with what the user has typed so far, straight from the local index.
+    """
+    query = update.inline_query.query
+    songs = get_suggestions().search(query, INLINE_RESULTS)
+    results = [
+        telegram.InlineQueryResultArticle(
+            id=str(position),
+            title=song,
+            input_message_content=telegram.InputTextMessageContent(song),
+        )
+        for position, song in enumerate(songs)
+    ]
+    update.inline_query.answer(results, cache_time=SUGGEST_TTL)
+
+
+def superseded():
+    """
+    Check if the search running in this thread has been superseded by a newer
+    one in the same chat.
+    """
+    token = getattr(CURRENT, 'token', None)
+    return token is not None and token.cancelled
+
+
+def run_search(handler, token, update, context):
+    """
+    Run a search handler with its cancellation token, unless it was already
+    superseded before it could start.
+    """
+    chat_id = update.message.chat_id
+    if token.cancelled:
+        logger.info('Skipping superseded search in chat %s', chat_id)
+        METRICS.incr('searches.skipped')
+        SEARCHES.finish(chat_id, token)
+        return
+    CURRENT.token = token
+    try:
+        handler(update, context)
+    finally:
+        CURRENT.token = None
+        SEARCHES.finish(chat_id, token)
+        if token.cancelled:
+            METRICS.incr('searches.discarded')
+
+
+def queued(handler, supersedes=False):
+    """
+    Wrap a handler so that it runs in the chat's queue in the scheduler,
+    instead of directly in the dispatcher's thread.
+
+    If 'supersedes' is set, the handler is a search that supersedes any other
+    search of the chat that is still queued or running. Queued ones are
+    skipped, and running ones don't reply or start any more work once they
+    check `superseded()`.
+
+    If the queue is full, the user is asked to try again later.
+    """
+
+    def submit(update, context):
+        chat_id = update.message.chat_id
+        work = handler
+        if supersedes:
+            token = Token()
+            work = partial(run_search, handler, token)
+            # Registered before it's queued, so that a search that finishes
+            # right away is never left behind as the chat's current one
+            if SEARCHES.start(chat_id, token):
+                logger.info('Superseding the last search in chat %s', chat_id)
+                METRICS.incr('searches.superseded')
+        if not SCHEDULER.submit(chat_id, work, update, context):
+            if supersedes:
+                SEARCHES.finish(chat_id, token)
+            send_message(BUSY_MSG, context.bot, chat_id)
+
+    return submit
+
+
+def add_handlers(dispatcher):
+    """
+    Register all the bot's command and message handlers in a dispatcher.
+    """
+    from telegram.ext import CommandHandler, MessageHandler, Filters
+    from telegram.ext import InlineQueryHandler
+
+    dispatcher.add_handler(CommandHandler('start', start))
+    dispatcher.add_handler(CommandHandler('other', queued(other, True)))
+    dispatcher.add_handler(CommandHandler('next', queued(next_song, True)))
+    dispatcher.add_handler(CommandHandler('album', queued(album, True)))
+    dispatcher.add_handler(CommandHandler('now', queued(now, True)))
+    dispatcher.add_handler(CommandHandler('search', queued(search)))
+    dispatcher.add_handler(MessageHandler(Filters.text, queued(text, True)))
+    dispatcher.add_handler(MessageHandler(Filters.command, unknown))
+    dispatcher.add_handler(InlineQueryHandler(inline_query))
+
+
+def configure(config):
+    """
+    Set up the global spotify client and database connection, and any other
+    optional features.
+
+    Returns False if the database could not be configured.
+    """
+    global PREFETCH, PROGRESSIVE
+    PREFETCH = config.get('prefetch', False)
+    PROGRESSIVE = config.get('progressive', False)
+    # Every worker process has its own rate limiters, so the global limits
+    # are split between them
+    workers = int(config.get('workers', 1))
+    SENDER.share(workers)
+    SP.share(workers)
     SP.configure(config['SPOTIFY_CLIENT_ID'], config['SPOTIFY_CLIENT_SECRET'])
+    SP.store = DB
+    if config.get('persist_handlers', False):
+        HANDLERS.store = DB
 
     try:
         DB.config(config['db_filename'])
     except Exception as error:
         logger.critical(type(error))
         logger.critical(str(error))
+        return False
+
+    # Start building the index for inline queries
+    get_suggestions()
+    return True
+
+
+def main():
+    # Only needed to run the bot, and slow to import
+    from multiprocessing import SimpleQueue
+    from telegram.ext import Updater, TypeHandler
+    from server import Server
+    from workers import WorkerPool
+
+    config = parse_config()
+    if not config:
+        return 1
+
+    updater = Updater(config['token'], use_context=True)
+    workers = int(config.get('workers', 1))
+    if workers > 1:
+        pool = WorkerPool(config, workers)
+        pool.start()
+        handler = TypeHandler(telegram.Update, pool.dispatch)
+        updater.dispatcher.add_handler(handler)
+    else:
+        pool = None
+        add_handlers(updater.dispatcher)
+
+    if not configure(config):
         return 2
 
+    auth_events = SimpleQueue()
     server = Server(
         db_config=dict(filename=config['db_filename']),
         port=config['flask_port'],
+        on_auth=auth_events.put,
     )
     server.start()
+    invalidate = pool.invalidate_sp_token if pool else invalidate_sp_token
+    watcher = threading.Thread(
+        target=watch_auth, args=(auth_events, invalidate), daemon=True
+    )
+    watcher.start()
 
     updater.bot.logger.setLevel(logging.CRITICAL)
     updater.start_polling()
@@ -388,8 +1194,13 @@ def main():
     logger.info('Started')
     updater.idle()
     logger.info('Closing')
+    if pool:
+        pool.terminate()
+    SCHEDULER.stop()
     SP.save_cache()
+    logger.info('Metrics: %s', METRICS.snapshot())
     server.terminate()
+    auth_events.put(None)
     try:
         DB.close()
     except sqlite3.Error:
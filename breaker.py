@@ -0,0 +1,201 @@
+"""
+Circuit breakers for external services.
+
+A breaker keeps track of the outcome of the latest calls to a service, like a
+lyrics source or the Spotify API. When too many of them fail, the breaker
+opens and calls are rejected straight away for a while, instead of making
+users wait for a service that is down to time out again. After that, a single
+trial call is let through (the breaker is half open). If it works, the breaker
+closes again, and if it doesn't it stays open for another while.
+
+The state of every breaker is reported in the 'breaker.<name>.state' metric
+(see STATES), and the number of times it opened and of rejected calls in
+'breaker.<name>.opened' and 'breaker.<name>.rejected'.
+"""
+import time
+import threading
+from collections import deque
+
+from logger import logger
+from metrics import METRICS
+
+CLOSED = 'closed'
+HALF_OPEN = 'half-open'
+OPEN = 'open'
+# Value of the state metric for every state
+STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of calling a service whose breaker is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Thread-safe circuit breaker for a single service.
+
+    The breaker opens when at least 'min_calls' calls finished in the last
+    'window' seconds and 'failure_rate' of them or more failed, and stays open
+    for 'cooldown' seconds. Calls that take more than 'slow' seconds count as
+    failures even if they work.
+
+    Exceptions raised by a call are failures only if 'is_failure' returns True
+    for them, so errors that don't mean the service is down (like a page that
+    doesn't exist) can be told apart.
+    """
+
+    def __init__(
+        self,
+        name,
+        failure_rate=0.5,
+        min_calls=5,
+        window=60,
+        cooldown=30,
+        slow=10,
+        is_failure=None,
+        clock=time.monotonic,
+        metrics=METRICS,
+    ):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self.slow = slow
+        self.is_failure = is_failure or (lambda error: True)
+        self.clock = clock
+        self.metrics = metrics
+        # (time, failed) for every call finished in the window
+        self._calls = deque()
+        self._failures = 0
+        self._state = CLOSED
+        self._opened = 0
+        self._probe = None
+        self._lock = threading.Lock()
+        self._report()
+
+    @property
+    def state(self):
+        with self._lock:
+            self._expire(self.clock())
+            return self._state
+
+    def _report(self):
+        self.metrics.set(f'breaker.{self.name}.state', STATES[self._state])
+
+    def _expire(self, now):
+        """
+        Move an open breaker to half open after the cooldown.
+        """
+        if self._state == OPEN and now - self._opened >= self.cooldown:
+            logger.info('Circuit breaker for %s is half open', self.name)
+            self._state = HALF_OPEN
+            self._probe = None
+            self._report()
+
+    def allow(self):
+        """
+        Check if a call can be made now. A half open breaker only allows one
+        trial call, or another one if the last trial didn't report back in a
+        whole cooldown period.
+
+        Every allowed call must be reported with `record()`.
+        """
+        with self._lock:
+            now = self.clock()
+            self._expire(now)
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN and (
+                self._probe is None or now - self._probe >= self.cooldown
+            ):
+                self._probe = now
+                return True
+        self.metrics.incr(f'breaker.{self.name}.rejected')
+        return False
+
+    def record(self, failed, duration=0):
+        """
+        Record the outcome of a call and how many seconds it took.
+        """
+        failed = failed or duration > self.slow
+        with self._lock:
+            now = self.clock()
+            if self._state == HALF_OPEN:
+                if failed:
+                    self._open(now)
+                else:
+                    self._close()
+                return
+            if self._state == OPEN:
+                # A call that started before the breaker opened
+                return
+            self._calls.append((now, failed))
+            self._failures += failed
+            while self._calls and now - self._calls[0][0] > self.window:
+                self._failures -= self._calls.popleft()[1]
+            calls = len(self._calls)
+            if calls < self.min_calls:
+                return
+            if self._failures >= self.failure_rate * calls:
+                self._open(now)
+
+    def _open(self, now):
+        logger.warning(
+            'Circuit breaker for %s is open for %ss', self.name, self.cooldown
+        )
+        self._state = OPEN
+        self._opened = now
+        self._calls.clear()
+        self._failures = 0
+        self.metrics.incr(f'breaker.{self.name}.opened')
+        self._report()
+
+    def _close(self):
+        logger.info('Circuit breaker for %s is closed', self.name)
+        self._state = CLOSED
+        self._calls.clear()
+        self._failures = 0
+        self._report()
+
+    def measure(self, func, *args, **kwargs):
+        """
+        Make a call that was already allowed and record its outcome.
+        """
+        start = self.clock()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as error:
+            self.record(self.is_failure(error), self.clock() - start)
+            raise
+        self.record(False, self.clock() - start)
+        return result
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call a function through the breaker. Raises `CircuitOpen` if the
+        breaker doesn't allow it.
+        """
+        if not self.allow():
+            raise CircuitOpen(self.name)
+        return self.measure(func, *args, **kwargs)
+
+
+class Breakers:
+    """
+    Circuit breakers by service name, all with the same settings. They are
+    created the first time they are used.
+    """
+
+    def __init__(self, **settings):
+        self.settings = settings
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._breakers:
+                self._breakers[name] = CircuitBreaker(name, **self.settings)
+            return self._breakers[name]
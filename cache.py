@@ -0,0 +1,73 @@
+"""
+In-memory caches.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe dictionary-like cache with a maximum size and optional
+    expiration times. When the cache is full, the least recently used item is
+    evicted.
+
+    The 'ttl' parameter sets the default number of seconds an item is valid
+    for, which can also be overridden for every single item. A ttl of None
+    means that items never expire.
+    """
+
+    def __init__(self, maxsize=1000, ttl=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Return the value for a key, or 'default' if it's missing or expired.
+        """
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                return default
+            if expires is not None and expires <= self.clock():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Insert an item in the cache, evicting the oldest ones if necessary.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires = self.clock() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """
+        Remove an item from the cache and return its value.
+        """
+        with self._lock:
+            value, expires = self._data.pop(key, (default, None))
+        if expires is not None and expires <= self.clock():
+            return default
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        sentinel = object()
+        return self.get(key, sentinel) is not sentinel
+
+    def __len__(self):
+        return len(self._data)
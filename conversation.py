@@ -0,0 +1,123 @@
+"""
+Per-chat conversation state.
+
+Some commands need to handle the next message from a chat differently (for
+example, to read the answer to a question the bot just asked). Those commands
+push a priority handler for the chat, which will be called with the next text
+message instead of the default one.
+"""
+import time
+import threading
+
+from cache import LRUCache
+from logger import logger
+
+
+class ConversationStore:
+    """
+    Bounded store for the stacks of priority handlers of every chat.
+
+    Only chats with pending handlers are kept, up to 'maxsize' of them. The
+    least recently used chats are dropped when the store is full, and any
+    handlers that are not used in 'ttl' seconds expire.
+
+    If a persistent 'store' is set (like the bot's database), the handler
+    stacks are also saved there, so that they survive restarts and evictions
+    from memory. Only handlers added with `register()` can be persisted. Chats
+    that are known to have nothing in the store are remembered too, so most
+    messages, which come from chats without any pending handlers, don't have
+    to look for them in the store every time.
+    """
+
+    def __init__(
+        self, maxsize=10000, ttl=24 * 60 * 60, store=None, clock=time.monotonic
+    ):
+        self.ttl = ttl
+        self.store = store
+        self._cache = LRUCache(maxsize=maxsize, ttl=ttl, clock=clock)
+        # Chats with no handlers in the persistent store
+        self._missing = LRUCache(maxsize=maxsize, ttl=ttl, clock=clock)
+        self._registry = {}
+        self._lock = threading.Lock()
+
+    def register(self, handler):
+        """
+        Make a handler available to be restored from the persistent store.
+        Can be used as a decorator.
+        """
+        self._registry[handler.__name__] = handler
+        return handler
+
+    def push(self, chat_id, handler):
+        """
+        Add a priority handler for a chat.
+        """
+        if self.store is not None and handler.__name__ not in self._registry:
+            raise ValueError(f'Handler {handler.__name__} is not registered')
+        with self._lock:
+            stack = self._load(chat_id) + (handler,)
+            self._save(chat_id, stack)
+
+    def pop(self, chat_id):
+        """
+        Remove and return the last priority handler for a chat, or None if
+        there isn't any.
+        """
+        with self._lock:
+            stack = self._load(chat_id)
+            if not stack:
+                return None
+            self._save(chat_id, stack[:-1])
+        return stack[-1]
+
+    def clear(self):
+        """
+        Remove the handlers of every chat from memory.
+        """
+        self._cache.clear()
+        self._missing.clear()
+
+    def _key(self, chat_id):
+        return f'handlers:{chat_id}'
+
+    def _load(self, chat_id):
+        stack = self._cache.get(chat_id)
+        if stack is not None or self.store is None:
+            return stack or ()
+        if self._missing.get(chat_id):
+            return ()
+        try:
+            names = self.store.get_cached(self._key(chat_id)) or []
+        except Exception as error:
+            logger.exception(error)
+            return ()
+        if not names:
+            self._missing.set(chat_id, True)
+        return tuple(self._registry[n] for n in names if n in self._registry)
+
+    def _save(self, chat_id, stack):
+        if stack:
+            self._cache.set(chat_id, stack)
+        else:
+            self._cache.pop(chat_id)
+        if self.store is None:
+            return
+        if stack:
+            self._missing.pop(chat_id)
+        else:
+            self._missing.set(chat_id, True)
+        try:
+            if stack:
+                names = [handler.__name__ for handler in stack]
+                self.store.save_cached(self._key(chat_id), names, self.ttl)
+            else:
+                self.store.delete_cached(self._key(chat_id))
+        except Exception as error:
+            logger.exception(error)
+
+    def __contains__(self, chat_id):
+        with self._lock:
+            return bool(self._load(chat_id))
+
+    def __len__(self):
+        return len(self._cache)
@@ -3,10 +3,109 @@ Database management and utilities
 """
 import time
 import re
+import json
+import zlib
+import pickle
 import sqlite3
+import hashlib
+import threading
+from collections import Counter
 
 from logger import logger
 
+# Maximum number of full text search results to rank by relevance
+RANK_LIMIT = 2000
+# Number of saved lyrics to train the compression dictionary with
+DICT_SAMPLES = 500
+# Maximum size of the compression dictionary, which is as far back as zlib
+# can look for matches anyway
+DICT_SIZE = 32 * 1024
+# Train a new dictionary when there are this many times more lyrics saved
+# than the last one was trained with
+DICT_RETRAIN = 4
+
+
+def words(text):
+    """
+    Split a text into lowercase words for the full text index.
+    """
+    return re.findall(r'[^\W_]+', text.lower())
+
+
+def word_pairs(text):
+    """
+    Return every pair of consecutive words in a text joined by an underscore,
+    as they are stored in the 'pairs' column of the full text index.
+    """
+    split = words(text)
+    return ' '.join(f'{a}_{b}' for a, b in zip(split, split[1:]))
+
+
+def normalize_lyrics(text):
+    """
+    Normalize the whitespace in a lyrics body, which is all that usually
+    differs between copies of the same lyrics found in different sources.
+    """
+    lines = [line.rstrip() for line in text.strip().splitlines()]
+    return re.sub(r'\n{3,}', '\n\n', '\n'.join(lines))
+
+
+def train_dictionary(texts, size=DICT_SIZE):
+    """
+    Build a zlib preset dictionary from a sample of lyrics.
+
+    The dictionary is made of the lines and runs of two to four words that
+    appear in more than one of the texts, picking the ones that would save the
+    most bytes first. The best ones go at the end, where zlib can refer to
+    them with the shortest distances.
+    """
+    counts = Counter()
+    for text in texts:
+        pieces = set()
+        for line in text.splitlines():
+            split = line.split()
+            pieces.add(' '.join(split))
+            for length in range(2, 5):
+                for start in range(len(split) - length + 1):
+                    pieces.add(' '.join(split[start : start + length]))
+        counts.update(piece for piece in pieces if len(piece) >= 6)
+    pieces = sorted(
+        (piece for piece, count in counts.items() if count > 1),
+        key=lambda piece: (counts[piece] * (len(piece) - 3), piece),
+        reverse=True,
+    )
+    chosen = []
+    total = 0
+    for piece in pieces:
+        data = piece.encode() + b'\n'
+        if total + len(data) <= size:
+            chosen.append(data)
+            total += len(data)
+    return b''.join(reversed(chosen))
+
+
+def compress(text, dictionary=None):
+    """
+    Compress a text with raw deflate, which saves the zlib header and
+    checksum, using a preset dictionary if there is one.
+    """
+    if dictionary:
+        comp = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=dictionary)
+    else:
+        comp = zlib.compressobj(9, zlib.DEFLATED, -15)
+    return comp.compress(text.encode()) + comp.flush()
+
+
+def decompress(data, dictionary=None):
+    """
+    Decompress a text compressed with `compress()` and the same dictionary.
+    """
+    if dictionary:
+        decomp = zlib.decompressobj(-15, zdict=dictionary)
+    else:
+        decomp = zlib.decompressobj(-15)
+    return (decomp.decompress(data) + decomp.flush()).decode()
+
 
 def row_factory(c, r):
     "Row factory to make our db connection return dictionaries."
@@ -24,6 +123,23 @@ class DB:
         self._retries = retries
         self._filename = filename
         self._closed = True
+        self._lock = threading.RLock()
+        # Id, contents and training size of the latest compression dictionary
+        self._dictionary = None
+        self._dictionaries = {}
+        self._texts = 0
+        # Date of the latest log entry written by this connection
+        self._last_date = 0
+
+    def _connect(self):
+        """
+        Open a new connection to the database. The connection is shared by
+        all threads, which is safe as long as `_lock` is held while using it.
+        """
+        self._connection = sqlite3.connect(
+            self._filename, check_same_thread=False
+        )
+        self._connection.row_factory = row_factory
 
     def config(self, filename=None):
         """
@@ -31,15 +147,167 @@ class DB:
         """
         if filename:
             self._filename = filename
-        self._connection = sqlite3.connect(self._filename)
-        self._connection.row_factory = row_factory
+        self._connect()
         cursor = self._connection.cursor()
         with open('schema.sql') as schema:
             cursor.executescript(schema.read())
         self._connection.commit()
         self._closed = False
+        self._load_dictionary()
+        self._index_lyrics()
+
+    def _load_dictionary(self):
+        """
+        Load the latest compression dictionary and count the saved lyrics,
+        training a new dictionary if it's time to.
+        """
+        res = self._execute(
+            'SELECT id, data, texts FROM lyrics_dict ORDER BY id DESC LIMIT 1'
+        )
+        if res:
+            self._dictionary = (res['id'], res['data'], res['texts'])
+            self._dictionaries[res['id']] = res['data']
+        res = self._execute('SELECT COUNT(*) AS texts FROM lyrics_text')
+        self._texts = res['texts']
+        with self._lock:
+            self._maybe_train()
+            self._connection.commit()
+
+    def _maybe_train(self):
+        """
+        Train a new compression dictionary from a sample of the saved lyrics if
+        there are enough of them, and DICT_RETRAIN times more than the last
+        dictionary was trained with. Must be called with the lock held.
+        """
+        trained = self._dictionary[2] if self._dictionary else 0
+        if self._texts < max(DICT_SAMPLES, trained * DICT_RETRAIN):
+            return
+        sample = self._connection.execute(
+            'SELECT dictionary, data FROM lyrics_text WHERE rowid IN '
+            '(SELECT rowid FROM lyrics_text ORDER BY RANDOM() LIMIT ?)',
+            [DICT_SAMPLES],
+        )
+        texts = [self._decompress(row) for row in sample]
+        dictionary = train_dictionary(texts)
+        if not dictionary:
+            return
+        cursor = self._connection.execute(
+            'INSERT INTO lyrics_dict (data, texts) VALUES (?, ?)',
+            [dictionary, self._texts],
+        )
+        logger.info('Trained a %d byte lyrics dictionary', len(dictionary))
+        self._dictionary = (cursor.lastrowid, dictionary, self._texts)
+        self._dictionaries[cursor.lastrowid] = dictionary
+
+    def _decompress(self, row):
+        """
+        Decompress the lyrics in a row of the lyrics_text table.
+        """
+        dict_id = row['dictionary']
+        if dict_id is not None and dict_id not in self._dictionaries:
+            res = self._execute(
+                'SELECT data FROM lyrics_dict WHERE id=?', [dict_id]
+            )
+            self._dictionaries[dict_id] = res['data']
+        return decompress(row['data'], self._dictionaries.get(dict_id))
+
+    def _index_lyrics(self):
+        """
+        Add all the saved lyrics to the full text index if it's empty, like
+        when it has just been created.
+        """
+        if self._execute('SELECT rowid FROM lyrics_fts LIMIT 1'):
+            return
+        with self._lock:
+            insert = self._connection.cursor()
+            rows = self._connection.execute(
+                'SELECT rowid, dictionary, data FROM lyrics_text'
+            )
+            for row in rows:
+                self._index_text(insert, row['rowid'], self._decompress(row))
+            # Merge the index segments created by the bulk insert
+            insert.execute(
+                "INSERT INTO lyrics_fts (lyrics_fts) VALUES ('optimize')"
+            )
+            self._connection.commit()
 
-    def _execute(self, query, params=''):
+    @staticmethod
+    def _index_text(cursor, rowid, text, command=None):
+        """
+        Add a text to the full text index, or run another command on it like
+        'delete'.
+        """
+        params = [rowid, text.encode(), word_pairs(text)]
+        if command:
+            cursor.execute(
+                'INSERT INTO lyrics_fts (lyrics_fts, rowid, lyrics, pairs) '
+                'VALUES (?, ?, CAST(? AS TEXT), ?)',
+                [command, *params],
+            )
+        else:
+            cursor.execute(
+                'INSERT INTO lyrics_fts (rowid, lyrics, pairs) '
+                'VALUES (?, CAST(? AS TEXT), ?)',
+                params,
+            )
+
+    def _add_text(self, text):
+        """
+        Add a reference to a lyrics text in the store, saving and indexing it
+        if it's new. Returns the hash of the normalized text.
+
+        Must be called with the lock held, and the changes committed after.
+        """
+        text = normalize_lyrics(text)
+        digest = hashlib.sha1(text.encode()).digest()
+        cursor = self._connection.execute(
+            'UPDATE lyrics_text SET refs=refs+1 WHERE hash=?', [digest]
+        )
+        if cursor.rowcount:
+            return digest
+
+        dict_id, dictionary = None, None
+        if self._dictionary:
+            dict_id, dictionary, _ = self._dictionary
+        cursor.execute(
+            'INSERT INTO lyrics_text (hash, dictionary, data, refs) '
+            'VALUES (?, ?, ?, 1)',
+            [digest, dict_id, compress(text, dictionary)],
+        )
+        self._index_text(cursor, cursor.lastrowid, text)
+        self._texts += 1
+        return digest
+
+    def _release_text(self, digest):
+        """
+        Remove a reference to a lyrics text from the store, deleting it and
+        its index entry if it was the last one.
+
+        Must be called with the lock held, and the changes committed after.
+        """
+        cursor = self._connection.execute(
+            'UPDATE lyrics_text SET refs=refs-1 WHERE hash=?', [digest]
+        )
+        row = cursor.execute(
+            'SELECT rowid, dictionary, data FROM lyrics_text '
+            'WHERE hash=? AND refs<=0',
+            [digest],
+        ).fetchone()
+        if not row:
+            return
+        # The index is contentless, so old values have to be removed by
+        # passing them again with the special 'delete' command
+        self._index_text(
+            cursor, row['rowid'], self._decompress(row), command='delete'
+        )
+        cursor.execute('DELETE FROM lyrics_text WHERE hash=?', [digest])
+        self._texts -= 1
+
+    def _execute(self, query, params='', fetchall=False):
+        with self._lock:
+            return self._execute_locked(query, params, fetchall)
+
+    def _execute_locked(self, query, params, fetchall):
         res = None
         error_msg = ''
         select = query.lstrip().partition(' ')[0].lower() == 'select'
@@ -51,7 +319,7 @@ class DB:
                 cur = self._connection.cursor()
                 cur.execute(query, params)
                 if select:
-                    res = cur.fetchone()
+                    res = cur.fetchall() if fetchall else cur.fetchone()
                 else:
                     self._connection.commit()
                 break
@@ -65,8 +333,7 @@ class DB:
                 time.sleep(1)
 
                 # Intentionally not catching exceptions here
-                self._connection = sqlite3.connect(self._filename)
-                self._connection.row_factory = row_factory
+                self._connect()
         else:
             raise sqlite3.Error(error_msg)
 
@@ -76,6 +343,10 @@ class DB:
         """
         Insert a search result into the database.
         """
+        with self._lock:
+            self._log_result(chat_id, result)
+
+    def _log_result(self, chat_id, result):
         title = result.song.title
         artist = result.song.artist
         album = result.song.album or 'Unknown'
@@ -84,25 +355,71 @@ class DB:
             [chat_id, artist, title],
         )
 
+        date = self._next_date()
         if res:
             logger.debug('Updating')
-            update = 'UPDATE log SET source=?, date=strftime("%s", "now")'
-            values = [result.source.__name__, chat_id, artist, title]
+            update = 'UPDATE log SET source=?, date=?'
+            values = [result.source.__name__, date, chat_id, artist, title]
             if res['album'] == 'Unknown':
                 update += ', album=?'
-                values.insert(1, album)
+                values.insert(2, album)
             update += ' WHERE chat_id=? AND artist=? AND title=?'
             self._execute(update, values)
         else:
             logger.debug('Inserting')
             self._execute(
                 'INSERT INTO log (chat_id,source,artist,title,album,date) '
-                'VALUES (?, ?, ?, ?, ?, strftime("%s", "now"))',
-                [chat_id, result.source.__name__, artist, title, album],
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [chat_id, result.source.__name__, artist, title, album, date],
             )
 
         self._connection.commit()
 
+    def _next_date(self):
+        """
+        Get the date for a new log entry. Entries logged by this connection
+        always have increasing dates, even in the same microsecond, so the
+        latest one in a chat is always well defined.
+
+        Must be called with the lock held.
+        """
+        self._last_date = max(time.time(), self._last_date + 1e-6)
+        return self._last_date
+
+    def log_results(self, chat_id, results):
+        """
+        Insert a list of search results into the database in a single
+        transaction. They are logged as searched for in the same order, so the
+        last one becomes the chat's last result.
+        """
+        rows = []
+        for result in results:
+            values = [
+                chat_id,
+                result.source.__name__,
+                result.song.artist,
+                result.song.title,
+                result.song.album or 'Unknown',
+            ]
+            rows.append(list(map(self.sanitize, values)))
+        with self._lock:
+            for row in rows:
+                row.append(self._next_date())
+            try:
+                self._connection.executemany(
+                    'INSERT INTO log (chat_id, source, artist, title, album, '
+                    'date) VALUES (?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (chat_id, artist, title) DO UPDATE SET '
+                    'source=excluded.source, date=excluded.date, '
+                    "album=CASE WHEN album='Unknown' THEN excluded.album "
+                    'ELSE album END',
+                    rows,
+                )
+                self._connection.commit()
+            except sqlite3.Error:
+                self._connection.rollback()
+                raise
+
     def get_last_res(self, chat_id):
         """
         Return the last logged result of a specific chat.
@@ -123,6 +440,152 @@ class DB:
         }
         return res
 
+    def get_top_songs(self, count):
+        """
+        Return the artist and title of the songs that have been searched for
+        in the most chats.
+        """
+        res = self._execute(
+            'SELECT artist, title, COUNT(*) AS chats FROM log '
+            'GROUP BY artist, title ORDER BY chats DESC LIMIT ?',
+            [count],
+            fetchall=True,
+        )
+        return [
+            {k: v.replace("''", "'") for k, v in row.items() if k != 'chats'}
+            for row in res
+        ]
+
+    def get_song_counts(self):
+        """
+        Return the artist and title of every song in the log, along with the
+        number of chats that have searched for it.
+        """
+        res = self._execute(
+            'SELECT artist, title, COUNT(*) AS chats FROM log '
+            'GROUP BY artist, title',
+            fetchall=True,
+        )
+        return [
+            {
+                k: v.replace("''", "'") if isinstance(v, str) else v
+                for k, v in row.items()
+            }
+            for row in res
+        ]
+
+    def get_lyrics(self, artist, title, sources):
+        """
+        Get the saved lyrics for a song from any of the given sources.
+
+        The artist and title should be normalized with `song_key()`. Returns a
+        dictionary with the source and the lyrics, or None if they're not
+        stored.
+        """
+        if not sources:
+            return None
+        placeholders = ', '.join('?' * len(sources))
+        res = self._execute(
+            'SELECT source, dictionary, data FROM song_lyrics '
+            'JOIN lyrics_text USING (hash) WHERE artist=? AND title=? '
+            f'AND source IN ({placeholders})',
+            [artist, title, *sources],
+        )
+        if not res:
+            return None
+        return {'source': res['source'], 'lyrics': self._decompress(res)}
+
+    def save_lyrics(self, artist, title, source, lyrics):
+        """
+        Save the lyrics for a song found in a specific source.
+
+        Songs with the same lyrics (like the same song from different sources,
+        or different versions of it) share a single compressed copy of them in
+        the store, which is also the only one added to the full text index.
+        """
+        key = [self.sanitize(value) for value in (artist, title, source)]
+        with self._lock:
+            conn = self._connection
+            try:
+                old = conn.execute(
+                    'SELECT hash FROM song_lyrics '
+                    'WHERE artist=? AND title=? AND source=?',
+                    key,
+                ).fetchone()
+                digest = self._add_text(lyrics)
+                conn.execute(
+                    'INSERT OR REPLACE INTO song_lyrics '
+                    '(artist, title, source, hash) VALUES (?, ?, ?, ?)',
+                    [*key, digest],
+                )
+                if old:
+                    self._release_text(old['hash'])
+                self._maybe_train()
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+
+    def search_lyrics(self, text, count):
+        """
+        Find songs whose lyrics contain every pair of consecutive words in a
+        text (which is almost always the text itself), or all of its words if
+        there aren't any.
+
+        Returns a list of up to 'count' dictionaries with the artist and title
+        of each song, best matches first. Queries that match more than
+        RANK_LIMIT songs are too vague to be worth ranking (which needs a scan
+        of every match), so their results are returned in no particular order.
+        """
+        split = words(text)
+        if not split:
+            return []
+        queries = []
+        if len(split) > 1:
+            pairs = ' '.join(f'"{pair}"' for pair in word_pairs(text).split())
+            queries.append(f'pairs : ({pairs})')
+        every_word = ' '.join(f'"{word}"' for word in split)
+        queries.append(f'lyrics : ({every_word})')
+        # Fetch some extra results, since the same song can be saved with
+        # slightly different lyrics from more than one source
+        limit = count * 3
+        for query in queries:
+            found = self._execute(
+                'SELECT rowid FROM lyrics_fts WHERE lyrics_fts MATCH ? '
+                'LIMIT ?',
+                [query, max(RANK_LIMIT + 1, limit)],
+                fetchall=True,
+            )
+            if found:
+                break
+        else:
+            return []
+
+        if len(found) <= RANK_LIMIT:
+            found = self._execute(
+                'SELECT rowid FROM lyrics_fts WHERE lyrics_fts MATCH ? '
+                'ORDER BY rank LIMIT ?',
+                [query, limit],
+                fetchall=True,
+            )
+        rowids = [row['rowid'] for row in found[:limit]]
+        res = self._execute(
+            'SELECT lyrics_text.rowid, artist, title FROM lyrics_text '
+            'JOIN song_lyrics USING (hash) WHERE lyrics_text.rowid IN '
+            f'({", ".join("?" * len(rowids))})',
+            rowids,
+            fetchall=True,
+        )
+        by_rowid = {}
+        for row in res:
+            by_rowid.setdefault(row.pop('rowid'), []).append(row)
+        songs = {}
+        for rowid in rowids:
+            for row in by_rowid.get(rowid, []):
+                row = {k: v.replace("''", "'") for k, v in row.items()}
+                songs.setdefault((row['artist'], row['title']), row)
+        return list(songs.values())[:count]
+
     def get_sp_token(self, chat_id):
         """
         Get the saved token for this chat id.
@@ -152,14 +615,66 @@ class DB:
             """
         self._execute(update, (token, refresh, expires, chat_id))
 
+    def get_discography(self, artist):
+        """
+        Get the cached discography for an artist.
+
+        Returns None if it has not been stored yet.
+        """
+        select = 'SELECT data FROM discography WHERE artist=?'
+        res = self._execute(select, [artist])
+        if not res:
+            return None
+        return pickle.loads(res['data'])
+
+    def save_discography(self, artist, discography):
+        """
+        Store an artist's discography so that other processes can use it.
+        """
+        self._execute(
+            'INSERT OR REPLACE INTO discography (artist, data) VALUES (?, ?)',
+            [artist, pickle.dumps(discography)],
+        )
+
+    def get_cached(self, key):
+        """
+        Get a value from the persistent cache.
+
+        Returns None if the key is missing or has expired.
+        """
+        select = 'SELECT value FROM cache WHERE key=? AND expires>?'
+        res = self._execute(select, [key, int(time.time())])
+        if not res:
+            return None
+        return json.loads(res['value'])
+
+    def save_cached(self, key, value, ttl):
+        """
+        Store a JSON serializable value in the persistent cache for 'ttl'
+        seconds. Expired values are purged from the cache too.
+        """
+        now = int(time.time())
+        self._execute('DELETE FROM cache WHERE expires<=?', [now])
+        self._execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires) '
+            'VALUES (?, ?, ?)',
+            [key, json.dumps(value).encode(), now + ttl],
+        )
+
+    def delete_cached(self, key):
+        """
+        Remove a value from the persistent cache.
+        """
+        self._execute('DELETE FROM cache WHERE key=?', [key])
+
     @staticmethod
     def sanitize(string):
         """
         Remove special characters from a string to make it suitable for SQL
         queries.
         """
-        if string is None:
-            return None
+        if string is None or isinstance(string, bytes):
+            return string
         if not isinstance(string, str):
             string = str(string)
         newstr = re.sub("'", "''", string)
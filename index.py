@@ -0,0 +1,188 @@
+"""
+Fuzzy and prefix string matching.
+"""
+import heapq
+from bisect import bisect_left
+from collections import Counter
+from collections import defaultdict
+
+from cache import LRUCache
+
+
+def trigrams(text):
+    """
+    Return the set of 3 character sequences in a string, padded so that the
+    beginning of every word counts too.
+    """
+    text = f'  {text.lower()} '
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+class TrigramIndex:
+    """
+    Read-only index of strings that can be searched for the ones that are the
+    most similar to a query.
+
+    Similarity is measured as the Dice coefficient of the trigrams of both
+    strings, from 0 (nothing in common) to 1 (the same trigrams).
+    """
+
+    def __init__(self, values, threshold=0.6):
+        self.values = tuple(values)
+        self.threshold = threshold
+        self._sizes = []
+        self._postings = defaultdict(list)
+        for position, value in enumerate(self.values):
+            grams = trigrams(value)
+            self._sizes.append(len(grams))
+            for gram in grams:
+                self._postings[gram].append(position)
+
+    def search(self, query, k=5, threshold=None):
+        """
+        Return up to 'k' (value, score) tuples for the values most similar to
+        the query, best first. Values with a score under the threshold are not
+        included.
+        """
+        threshold = self.threshold if threshold is None else threshold
+        grams = trigrams(query)
+        common = Counter()
+        for gram in grams:
+            common.update(self._postings.get(gram, ()))
+
+        scores = []
+        for position, count in common.items():
+            score = 2 * count / (len(grams) + self._sizes[position])
+            if score >= threshold:
+                scores.append((score, -position))
+        best = heapq.nlargest(k, scores)
+        return [(self.values[-position], score) for score, position in best]
+
+    def best(self, query, threshold=None):
+        """
+        Return the value most similar to the query, or None if there isn't any
+        above the threshold.
+        """
+        match = self.search(query, k=1, threshold=threshold)
+        return match[0][0] if match else None
+
+    def __len__(self):
+        return len(self.values)
+
+
+def fold(text):
+    """
+    Normalize a string for prefix matching, by lowercasing it and collapsing
+    all whitespace into single spaces.
+    """
+    return ' '.join(text.lower().split())
+
+
+class PrefixIndex:
+    """
+    Read-only index of values that can be searched by a prefix of any of their
+    keys, kept as a sorted array of keys.
+
+    Entries are (key, value, weight) tuples, and the same value can be added
+    with several keys. Values with a higher weight are returned first, up to
+    'top' of them.
+
+    Prefixes that match more than 'scan' keys, which are too many to rank on
+    every search, have their best values computed when the index is built.
+    """
+
+    def __init__(self, entries, scan=1000, top=50):
+        entries = sorted(
+            (fold(key), -weight, value) for key, value, weight in entries
+        )
+        self.scan = scan
+        self.top = top
+        self._keys = [key for key, _, _ in entries]
+        self._weights = [-weight for _, weight, _ in entries]
+        self._values = [value for _, _, value in entries]
+        self._best = {}
+        self._build(0, len(self._keys), '')
+
+    def _rank(self, position):
+        return -self._weights[position], position
+
+    def _first(self, positions):
+        """
+        Return the first 'top' positions of different values in a list.
+        """
+        first = []
+        seen = set()
+        for position in positions:
+            value = self._values[position]
+            if value not in seen:
+                seen.add(value)
+                first.append(position)
+                if len(first) == self.top:
+                    break
+        return first
+
+    def _range(self, prefix, start=0, end=None):
+        """
+        Return the range of positions of the keys that start with a prefix.
+        """
+        end = len(self._keys) if end is None else end
+        start = bisect_left(self._keys, prefix, start, end)
+        end = bisect_left(self._keys, prefix + '\U0010ffff', start, end)
+        return start, end
+
+    def _build(self, start, end, prefix):
+        """
+        Return the positions of the best values with a key in a range, which
+        all start with the prefix, and save them if the range is longer than
+        'scan'. The best values of a prefix are the best of the ones of every
+        prefix with one more character.
+        """
+        if end - start <= self.scan:
+            return self._first(sorted(range(start, end), key=self._rank))
+        depth = len(prefix)
+        children = []
+        position = start
+        while position < end:
+            key = self._keys[position]
+            if len(key) == depth:
+                children.append([position])
+                position += 1
+                continue
+            child = prefix + key[depth]
+            _, child_end = self._range(child, position, end)
+            children.append(self._build(position, child_end, child))
+            position = child_end
+        best = self._first(heapq.merge(*children, key=self._rank))
+        self._best[prefix] = best
+        return best
+
+    def search(self, prefix, k=10):
+        """
+        Return up to 'k' different values with a key that starts with the
+        prefix, highest weight first.
+        """
+        prefix = fold(prefix)
+        best = self._best.get(prefix)
+        if best is None:
+            start, end = self._range(prefix)
+            best = self._first(sorted(range(start, end), key=self._rank))
+        return [self._values[position] for position in best[:k]]
+
+    def __len__(self):
+        return len(self._keys)
+
+
+INDEXES = LRUCache(maxsize=1000)
+
+
+def track_index(tracks):
+    """
+    Get the index for the list of tracks of an album. Indexes are cached, so
+    they are only built once for every album.
+    """
+    tracks = tuple(tracks)
+    index = INDEXES.get(tracks)
+    if index is None:
+        index = TrigramIndex(tracks)
+        INDEXES.set(tracks, index)
+    return index
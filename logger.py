@@ -5,7 +5,8 @@ formatter = logging.Formatter(fmt)
 logger = logging.getLogger('bot')
 logger.setLevel(logging.INFO)
 
-file_handler = logging.FileHandler('lyrics-bot.log', mode='a')
+# Don't create the log file until there is something to write to it
+file_handler = logging.FileHandler('lyrics-bot.log', mode='a', delay=True)
 file_handler.setFormatter(formatter)
 logger.addHandler(file_handler)
 
@@ -0,0 +1,58 @@
+"""
+Simple in-process metrics.
+"""
+import threading
+from collections import Counter
+
+
+class Metrics:
+    """
+    Thread-safe set of named counters, gauges and timers.
+
+    Timers keep the number of observations and their total, which are
+    reported as the '<name>.count' and '<name>.total' counters.
+    """
+
+    def __init__(self):
+        self._counters = Counter()
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        """
+        Increment a counter.
+        """
+        with self._lock:
+            self._counters[name] += value
+
+    def set(self, name, value):
+        """
+        Set a gauge (a counter that can go up and down) to a value.
+        """
+        with self._lock:
+            self._counters[name] = value
+
+    def observe(self, name, value):
+        """
+        Record a measurement (like a number of seconds) for a timer.
+        """
+        with self._lock:
+            self._counters[f'{name}.count'] += 1
+            self._counters[f'{name}.total'] += value
+
+    def get(self, name):
+        with self._lock:
+            return self._counters[name]
+
+    def snapshot(self):
+        """
+        Return a copy of all the counters as a dictionary.
+        """
+        with self._lock:
+            return dict(self._counters)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+
+
+METRICS = Metrics()
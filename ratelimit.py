@@ -0,0 +1,112 @@
+"""
+Rate limiting utilities.
+"""
+import time
+import random
+import threading
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket.
+
+    Tokens are refilled continuously at 'rate' tokens per second, up to a
+    maximum of 'capacity'. Callers that take more tokens than are available
+    are told how long they have to wait, and their reservation is kept, so
+    concurrent callers are served in the order they arrived.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = max(now - self.updated, 0)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def reserve(self, tokens=1):
+        """
+        Take tokens from the bucket and return the number of seconds the
+        caller has to wait before using them.
+        """
+        with self._lock:
+            now = self.clock()
+            self._refill(now)
+            self.tokens -= tokens
+            wait = max(-self.tokens / self.rate, self.paused_until - now)
+            return max(wait, 0)
+
+    def acquire(self, tokens=1, sleep=None):
+        """
+        Take tokens from the bucket, blocking until they are available.
+        Returns the time spent waiting.
+        """
+        wait = self.reserve(tokens)
+        if wait:
+            (sleep or time.sleep)(wait)
+        return wait
+
+    def pause(self, seconds):
+        """
+        Don't hand out any tokens for the next few seconds, regardless of how
+        many are available. Used to honor server side throttling.
+        """
+        with self._lock:
+            until = self.clock() + seconds
+            self.paused_until = max(self.paused_until, until)
+
+    def full(self):
+        """
+        Return True if the bucket has been idle long enough to be refilled.
+        """
+        with self._lock:
+            self._refill(self.clock())
+            return self.tokens >= self.capacity
+
+
+class RetryBudget:
+    """
+    Thread-safe limit on the number of retries, relative to the number of
+    requests.
+
+    Every request adds 'ratio' tokens to the budget, up to 'capacity', and
+    every retry takes a whole token. When the budget runs out no more retries
+    are allowed, so a failing service can't multiply the load on itself.
+    """
+
+    def __init__(self, ratio=0.1, capacity=10):
+        self.ratio = ratio
+        self.capacity = capacity
+        self.tokens = capacity
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        """
+        Account for a new request.
+        """
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + self.ratio)
+
+    def withdraw(self):
+        """
+        Take a token for a retry. Returns False if the budget is exhausted.
+        """
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+def backoff(attempt, base=0.5, cap=30, random=random.random):
+    """
+    Return the number of seconds to wait before a retry, using exponential
+    backoff with full jitter.
+    """
+    return random() * min(cap, base * 2 ** attempt)
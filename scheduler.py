@@ -0,0 +1,155 @@
+"""
+Per-chat work scheduler.
+
+Work items are queued per chat and run on a shared pool of threads. Items from
+the same chat are run in the order they were submitted, with a cap on how many
+of them can be running at the same time, and chats take turns to get their
+work scheduled so that a single busy chat can't starve the rest.
+"""
+import threading
+from collections import deque
+
+from logger import logger
+
+
+class ChatScheduler:
+    """
+    Fair, per-chat ordered work queue backed by a pool of worker threads.
+
+    The 'max_pending' parameter caps the number of queued items for a single
+    chat and 'max_total' the number of queued items across all chats. Any
+    submission beyond those limits is rejected.
+    """
+
+    def __init__(
+        self, workers=4, max_inflight=1, max_pending=5, max_total=500
+    ):
+        self.workers = workers
+        self.max_inflight = max_inflight
+        self.max_pending = max_pending
+        self.max_total = max_total
+
+        self._queues = {}
+        self._inflight = {}
+        self._ready = deque()
+        self._ready_set = set()
+        self._total = 0
+        self._threads = []
+        self._running = False
+        self._cond = threading.Condition()
+
+    def start(self):
+        """
+        Start the worker threads.
+        """
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._threads = [
+                threading.Thread(
+                    target=self._work, name=f'chat-worker-{i}', daemon=True
+                )
+                for i in range(self.workers)
+            ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """
+        Stop the worker threads once the queued work has been processed.
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, chat_id, func, *args, **kwargs):
+        """
+        Queue a function call for a chat.
+
+        Returns False if the work was rejected because the queues are full.
+        """
+        if not self._running:
+            self.start()
+
+        with self._cond:
+            queue = self._queues.setdefault(chat_id, deque())
+            full = self._total >= self.max_total
+            if full or len(queue) >= self.max_pending:
+                logger.info('Queue full for chat %s, rejecting', chat_id)
+                if not queue and not self._inflight.get(chat_id):
+                    del self._queues[chat_id]
+                return False
+            queue.append((func, args, kwargs))
+            self._total += 1
+            self._mark_ready(chat_id)
+            self._cond.notify()
+        return True
+
+    def pending(self, chat_id=None):
+        """
+        Return the number of queued items for a chat, or for all of them.
+        """
+        with self._cond:
+            if chat_id is None:
+                return self._total
+            return len(self._queues.get(chat_id, ()))
+
+    def _mark_ready(self, chat_id):
+        """
+        Put a chat at the back of the ready list if it has queued work and
+        room for more items in flight. Must be called with the lock held.
+        """
+        if chat_id in self._ready_set:
+            return
+        if not self._queues.get(chat_id):
+            return
+        if self._inflight.get(chat_id, 0) >= self.max_inflight:
+            return
+        self._ready.append(chat_id)
+        self._ready_set.add(chat_id)
+
+    def _next(self):
+        """
+        Block until there is some work to do and return it. Returns None if
+        the scheduler was stopped and there is nothing else left to do.
+        """
+        with self._cond:
+            while not self._ready:
+                if not self._running:
+                    return None
+                self._cond.wait()
+            chat_id = self._ready.popleft()
+            self._ready_set.discard(chat_id)
+            func, args, kwargs = self._queues[chat_id].popleft()
+            self._total -= 1
+            self._inflight[chat_id] = self._inflight.get(chat_id, 0) + 1
+            self._mark_ready(chat_id)
+            return chat_id, func, args, kwargs
+
+    def _done(self, chat_id):
+        with self._cond:
+            self._inflight[chat_id] -= 1
+            if not self._inflight[chat_id]:
+                del self._inflight[chat_id]
+                if not self._queues[chat_id]:
+                    del self._queues[chat_id]
+                    return
+            self._mark_ready(chat_id)
+            self._cond.notify()
+
+    def _work(self):
+        while True:
+            work = self._next()
+            if work is None:
+                return
+            chat_id, func, args, kwargs = work
+            try:
+                func(*args, **kwargs)
+            except Exception as error:
+                logger.exception(error)
+            finally:
+                self._done(chat_id)
@@ -15,3 +15,55 @@ CREATE TABLE IF NOT EXISTS sp_tokens(
     expires INT,
     CONSTRAINT PK_sp_tokens PRIMARY KEY (chat_id)
 );
+
+CREATE TABLE IF NOT EXISTS discography(
+    artist VARCHAR(64) NOT NULL,
+    data BLOB,
+    CONSTRAINT PK_discography PRIMARY KEY (artist)
+);
+
+CREATE TABLE IF NOT EXISTS cache(
+    key VARCHAR(256) NOT NULL,
+    value BLOB,
+    expires INT,
+    CONSTRAINT PK_cache PRIMARY KEY (key)
+);
+
+-- Lyrics are stored once per distinct text, compressed with zlib and
+-- addressed by the SHA-1 hash of the text. 'dictionary' is the id of the preset
+-- dictionary used to compress them, if any, and 'refs' is the number of
+-- songs in song_lyrics that point to them.
+CREATE TABLE IF NOT EXISTS lyrics_text(
+    hash BLOB NOT NULL,
+    dictionary INT,
+    data BLOB,
+    refs INT NOT NULL,
+    CONSTRAINT PK_lyrics_text PRIMARY KEY (hash)
+);
+
+CREATE TABLE IF NOT EXISTS lyrics_dict(
+    id INTEGER PRIMARY KEY,
+    data BLOB,
+    texts INT
+);
+
+CREATE TABLE IF NOT EXISTS song_lyrics(
+    artist VARCHAR(64) NOT NULL,
+    title VARCHAR(128) NOT NULL,
+    source VARCHAR(64) NOT NULL,
+    hash BLOB NOT NULL,
+    CONSTRAINT PK_song_lyrics PRIMARY KEY (artist, title, source)
+);
+
+CREATE INDEX IF NOT EXISTS IX_song_lyrics_hash ON song_lyrics (hash);
+
+-- Full text index of the lyrics_text table, by rowid. The lyrics are not
+-- stored twice, since the index is contentless. The 'pairs' column has every
+-- pair of consecutive words in the lyrics joined by an underscore, which is
+-- much faster to search for snippets than a phrase query on the words.
+CREATE VIRTUAL TABLE IF NOT EXISTS lyrics_fts USING fts5(
+    lyrics,
+    pairs,
+    content='',
+    tokenize='unicode61 remove_diacritics 1 tokenchars _'
+);
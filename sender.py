@@ -0,0 +1,131 @@
+"""
+Outbound message pipeline with rate limiting.
+
+Telegram allows bots around 30 messages per second overall and about one
+message per second in a single chat, and replies to anything above that with
+a `RetryAfter` error. Every message goes through a global and a per-chat token
+bucket, and flood control errors are retried after the requested delay.
+"""
+import time
+import threading
+
+import telegram
+
+from logger import logger
+from ratelimit import TokenBucket
+
+
+class Sender:
+    """
+    Rate limited message sender.
+
+    All the chunks of a single message are sent in a row, so they never get
+    interleaved with other messages to the same chat.
+    """
+
+    def __init__(
+        self,
+        rate=30,
+        chat_rate=1,
+        chat_burst=5,
+        retries=3,
+        max_chats=10000,
+        clock=time.monotonic,
+    ):
+        self.clock = clock
+        self.rate = rate
+        self.bucket = TokenBucket(rate, clock=clock)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.retries = retries
+        self.max_chats = max_chats
+        self._chats = {}
+        self._lock = threading.Lock()
+
+    def share(self, processes):
+        """
+        Split the global rate limit evenly between a number of processes, each
+        with its own sender. Per chat limits are not split, since every chat
+        is only served by one process.
+        """
+        self.bucket = TokenBucket(self.rate / processes, clock=self.clock)
+
+    def _chat(self, chat_id):
+        """
+        Get the token bucket and lock for a chat.
+        """
+        with self._lock:
+            if chat_id not in self._chats:
+                if len(self._chats) >= self.max_chats:
+                    self._prune()
+                bucket = TokenBucket(
+                    self.chat_rate, self.chat_burst, clock=self.clock
+                )
+                self._chats[chat_id] = (bucket, threading.Lock())
+            return self._chats[chat_id]
+
+    def _prune(self):
+        """
+        Forget about chats that haven't received any messages recently.
+        """
+        for chat_id, (bucket, lock) in list(self._chats.items()):
+            if bucket.full() and not lock.locked():
+                del self._chats[chat_id]
+
+    def send(self, bot, chat_id, chunks, parse_mode=None):
+        """
+        Send a list of message chunks to a chat. Returns the list of sent
+        messages.
+        """
+        bucket, lock = self._chat(chat_id)
+        with lock:
+            return [
+                self._send(bot, chat_id, bucket, chunk, parse_mode)
+                for chunk in chunks
+            ]
+
+    def edit(self, bot, message, text, parse_mode=None):
+        """
+        Replace the text of a message that was sent before. Edits count
+        towards the same rate limits as new messages.
+        """
+        chat_id = message.chat_id
+        bucket, lock = self._chat(chat_id)
+        with lock:
+            return self._call(
+                bot.edit_message_text,
+                chat_id,
+                bucket,
+                message_id=message.message_id,
+                text=text,
+                parse_mode=parse_mode,
+            )
+
+    def _send(self, bot, chat_id, bucket, chunk, parse_mode):
+        return self._call(
+            bot.send_message,
+            chat_id,
+            bucket,
+            text=chunk,
+            parse_mode=parse_mode,
+        )
+
+    def _call(self, method, chat_id, bucket, **kwargs):
+        """
+        Call a bot method for a chat once there are tokens available in both
+        buckets, retrying after any flood control errors.
+        """
+        for attempt in range(self.retries + 1):
+            self.bucket.acquire()
+            bucket.acquire()
+            try:
+                return method(chat_id=chat_id, **kwargs)
+            except telegram.error.RetryAfter as error:
+                if attempt == self.retries:
+                    raise
+                logger.warning(
+                    'Flood control in chat %s, retrying in %ss',
+                    chat_id,
+                    error.retry_after,
+                )
+                bucket.pause(error.retry_after)
@@ -8,9 +8,15 @@ from db import DB
 
 
 class Server(Process):
-    def __init__(self, db_config, port=7000, *args, **kwargs):
+    """
+    Authentication server process. Saves the authorization code received for
+    every chat id and then calls 'on_auth' with the (integer) chat id, if set.
+    """
+
+    def __init__(self, db_config, port=7000, on_auth=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.port = port
+        self.on_auth = on_auth
         self.db = DB()
         self.db.config(**db_config)
         self.app = Flask(__name__)
@@ -31,9 +37,24 @@ class Server(Process):
             self.db.save_sp_token(
                 request.args['code'], chat_id=request.args['state']
             )
+            if self.on_auth:
+                self.auth_done(request.args['state'])
         elif 'error' in request.args:
             response = [
                 "Couldn't log you in to Spotify",
                 'The error was: %s' % request.args['error'],
             ]
         return '<h3>{}</h3>'.format('<br>'.join(response))
+
+    def auth_done(self, state):
+        """
+        Call 'on_auth' with the chat id in the state of an auth response.
+        Chat ids are integers everywhere else in the bot, but they come back
+        from spotify as strings.
+        """
+        try:
+            chat_id = int(state)
+        except ValueError:
+            print('Invalid chat id in auth response: %s' % state)
+            return
+        self.on_auth(chat_id)
@@ -1,20 +1,33 @@
+import time
 import pickle
+import threading
 import logging
+import sqlite3
 from pathlib import Path
 from datetime import date
 
-import spotipy
-from spotipy import oauth2
-from spotipy.oauth2 import SpotifyClientCredentials
 from lyricfetch import Song
 
 from util import process
+from util import artist_key
 from util import chunks
 from util import is_value_invalid
 from logger import logger
+from index import track_index
+from metrics import METRICS
+from breaker import CircuitBreaker
+from breaker import CircuitOpen
+from ratelimit import backoff
+from ratelimit import RetryBudget
+from ratelimit import TokenBucket
 
 
 CACHE_DIR = Path('.cache')
+# Requests per second to the spotify API, shared by all threads
+RATE = 10
+MAX_RETRIES = 4
+# Seconds to keep artist ids in the shared store
+ARTIST_ID_TTL = 30 * 24 * 60 * 60
 replace_filename = {r'[\?\"\'<>\/\\,\-\!]': '', ':': ' ', ' {2,}': ' '}
 
 
@@ -32,6 +45,123 @@ def _set_release_date(album):
     album['release_date'] = date(*(map(int, release.split('-'))))
 
 
+class Album:
+    """
+    Compact record for an album in the discography cache.
+
+    Track names are stored in a tuple, and values can also be read with the
+    item syntax (`album['tracks']`), like in the old dictionary format.
+    """
+
+    __slots__ = ('id', 'release_date', 'tracks')
+
+    def __init__(self, id, release_date, tracks=()):
+        self.id = id
+        self.release_date = release_date
+        self.tracks = tuple(tracks)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __eq__(self, other):
+        if not isinstance(other, Album):
+            return NotImplemented
+        return (self.id, self.release_date, self.tracks) == (
+            other.id,
+            other.release_date,
+            other.tracks,
+        )
+
+    def __repr__(self):
+        return (
+            f'Album(id={self.id!r}, release_date={self.release_date!r}, '
+            f'tracks={self.tracks!r})'
+        )
+
+    def __getstate__(self):
+        return self.id, self.release_date, self.tracks
+
+    def __setstate__(self, state):
+        self.id, self.release_date, self.tracks = state
+
+
+class Discography(dict):
+    """
+    Albums of an artist by name, with the name of the artist as spotify
+    spells it in 'artist', since the cache is indexed by normalized names.
+    Discographies from older cache files don't have it, and it's None.
+    """
+
+    artist = None
+
+
+def compact_discography(discog, artist=None):
+    """
+    Convert a discography with albums stored as dictionaries, like the ones in
+    older cache files, to use Album records instead.
+
+    Track names that appear in more than one album (live albums, compilations,
+    remasters...) are deduplicated so that they are only stored once. The
+    artist's name is kept, unless a new one is given.
+    """
+    if not isinstance(discog, dict):
+        return discog
+    names = {}
+    compact = Discography()
+    compact.artist = artist or getattr(discog, 'artist', None)
+    for name, album in discog.items():
+        if isinstance(album, dict):
+            album = Album(**album)
+        album.tracks = tuple(names.setdefault(t, t) for t in album.tracks)
+        compact[name] = album
+    return compact
+
+
+def retry_after(headers, default=1):
+    """
+    Get the number of seconds to wait from the 'Retry-After' header of a
+    throttled response.
+    """
+    try:
+        return max(float(headers.get('Retry-After', default)), 0)
+    except (TypeError, ValueError):
+        return default
+
+
+def is_outage(error):
+    """
+    Tell if an error from a spotify request means that the API is unavailable,
+    rather than that there's something wrong with the request itself.
+    """
+    status = getattr(error, 'http_status', None)
+    return status is None or status == 429 or status >= 500
+
+
+def make_client(**kwargs):
+    """
+    Create a spotipy client that never retries requests by itself.
+
+    Spotipy's default session retries throttled (429) responses, and turns the
+    last one into an exception without any headers, so the 'Retry-After'
+    header never reaches `Spotify.call()`, which handles the retries instead.
+    """
+    import requests
+    import spotipy
+    from urllib3.util.retry import Retry
+
+    retry = Retry(
+        total=0, status=0, status_forcelist=(), raise_on_status=False
+    )
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return spotipy.Spotify(requests_session=session, **kwargs)
+
+
 def credentials(func):
     """
     Assert that the api is configured or raise with an error message.
@@ -46,22 +176,63 @@ def credentials(func):
 
 class Spotify:
     def __init__(self):
-        self.discography_cache = {}
-        self.load_cache()
+        self._discography_cache = None
+        self._cache_lock = threading.Lock()
         self.sp = None
 
+        # Optional shared backing store for the discography cache (see the
+        # `get_discography` and `save_discography` methods in the DB class)
+        self.store = None
+
+        # Spotify artist ids by normalized artist name, and the reverse
+        self.artist_ids = {}
+        self.artist_keys = {}
+
         self.scope = 'user-read-currently-playing'
         self.redirect_uri = 'http://46.101.110.129:7000/auth'
         self.sp_oauth = None
 
+        self.limiter = TokenBucket(RATE, capacity=2 * RATE)
+        self.retry_budget = RetryBudget()
+        self.breaker = CircuitBreaker('spotify', is_failure=is_outage)
+
+    @property
+    def discography_cache(self):
+        """
+        Dictionary of discographies indexed by normalized artist name (see
+        `artist_key()`). Loaded from the cache file the first time it's used.
+        """
+        if self._discography_cache is None:
+            # Handlers run in several threads, and only one must read the file
+            with self._cache_lock:
+                if self._discography_cache is None:
+                    self._discography_cache = self.read_cache()
+        return self._discography_cache
+
+    @discography_cache.setter
+    def discography_cache(self, value):
+        self._discography_cache = value
+
+    def share(self, processes):
+        """
+        Split the rate limit evenly between a number of processes, each with
+        its own client.
+        """
+        rate = RATE / processes
+        self.limiter = TokenBucket(rate, capacity=2 * rate)
+
     def configure(self, client_id, client_secret):
         """
         Set up spotify API client with the specified credentials.
         """
+        from spotipy import oauth2
+        from spotipy.oauth2 import SpotifyClientCredentials
+
         credentials = SpotifyClientCredentials(
             client_id=client_id, client_secret=client_secret
         )
-        self.sp = spotipy.Spotify(client_credentials_manager=credentials)
+        # Retries are handled by `call()`
+        self.sp = make_client(client_credentials_manager=credentials)
         self.sp.cache_path = None
         self.sp_oauth = oauth2.SpotifyOAuth(
             self.sp.client_credentials_manager.client_id,
@@ -70,6 +241,48 @@ class Spotify:
             scope=self.scope,
         )
 
+    def call(self, method, *args, **kwargs):
+        """
+        Call a method of a spotipy client, waiting for the shared rate limiter
+        first.
+
+        Requests that are throttled (429) or fail with a server error are
+        retried up to MAX_RETRIES times with jittered exponential backoff, as
+        long as the retry budget allows it. The 'Retry-After' header of
+        throttled requests pauses the rate limiter for every thread.
+
+        Raises `CircuitOpen` without calling the API if too many requests
+        failed recently (see the breaker module). Only the requests themselves
+        are timed by the breaker, not the waits for the rate limiter or the
+        backoff between retries.
+        """
+        from spotipy import SpotifyException
+
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise CircuitOpen('spotify')
+            waited = self.limiter.acquire()
+            METRICS.incr('spotify.requests')
+            METRICS.observe('spotify.wait', waited)
+            self.retry_budget.deposit()
+            try:
+                return self.breaker.measure(method, *args, **kwargs)
+            except SpotifyException as error:
+                status = error.http_status
+                if status != 429 and status < 500:
+                    raise
+                METRICS.incr(f'spotify.status.{status}')
+                if status == 429:
+                    self.limiter.pause(retry_after(error.headers))
+                if attempt >= MAX_RETRIES or not self.retry_budget.withdraw():
+                    METRICS.incr('spotify.failed')
+                    raise
+                attempt += 1
+                METRICS.incr('spotify.retries')
+                logger.warning('spotify returned %s, retrying', status)
+                time.sleep(backoff(attempt))
+
     def get_auth_url(self, chat_id):
         """
         Get the url that the user must open to authenticate with spotify.
@@ -90,17 +303,26 @@ class Spotify:
         Get the song that the user to whom this token belongs to is playing
         right now.
 
-        Returns None if they are not playing anything.
+        Returns None if they are not playing anything. The returned song also
+        has the spotify 'track_id' and the number of seconds 'remaining' until
+        the end of the track (0 if it's paused).
         """
-        client = spotipy.Spotify(auth=token)
+        client = make_client(auth=token)
         try:
-            song = client.currently_playing()['item']
+            playing = self.call(client.currently_playing)
+            song = playing['item']
             title = song['name']
             album = song['album']['name']
             artist = song['artists'][0]['name']
-            return Song(artist, title, album)
         except (KeyError, TypeError):
             return None
+        current = Song(artist, title, album)
+        current.track_id = song.get('id')
+        current.remaining = 0
+        if playing.get('is_playing') and playing.get('progress_ms'):
+            remaining = song.get('duration_ms', 0) - playing['progress_ms']
+            current.remaining = max(remaining, 0) / 1000
+        return current
 
     def save_cache(self):
         """
@@ -114,35 +336,103 @@ class Spotify:
 
     def load_cache(self):
         """
-        Return a list of files that are cached and can be ignored.
+        Add the discographies in the cache file to the discography cache.
+        """
+        self.discography_cache.update(self.read_cache())
+
+    def read_cache(self):
+        """
+        Read the discographies in the cache file, or an empty dictionary if
+        there is no cache file.
         """
         logger.info('reading cache')
         if not (CACHE_DIR / '.cache-spotify').is_file():
             logger.info('cache dir does not exist. quitting')
-            return
+            return {}
         with open(CACHE_DIR / '.cache-spotify', 'rb') as cache_file:
             logger.info('actually loading cache from file')
-            self.discography_cache.update(pickle.load(cache_file))
+            cache = pickle.load(cache_file)
+        return {
+            artist_key(k): compact_discography(v) for k, v in cache.items()
+        }
+
+    @credentials
+    def get_artist_id(self, artist, song_name):
+        """
+        Return the spotify id of an artist. The song name is only used to find
+        the right artist, and can be empty.
+
+        Ids are cached by normalized artist name, in memory and in the shared
+        store if there is one.
+        """
+        key = artist_key(artist)
+        if key in self.artist_ids:
+            return self.artist_ids[key]
+        artist_id = self._load_artist_id(key)
+        if artist_id is None:
+            query = f'artist:{artist}'
+            if song_name:
+                query += f' track:{song_name}'
+            query = self.call(self.sp.search, query, type='track')
+            artist_id = query['tracks']['items'][0]['artists'][0]['id']
+            self._save_artist_id(key, artist_id)
+        self.artist_ids[key] = artist_id
+        return artist_id
+
+    def _load_artist_id(self, key):
+        if self.store is None:
+            return None
+        try:
+            return self.store.get_cached(f'artist_id:{key}')
+        except sqlite3.Error as error:
+            logger.exception(error)
+            return None
+
+    def _save_artist_id(self, key, artist_id):
+        if self.store is None:
+            return
+        try:
+            key = f'artist_id:{key}'
+            self.store.save_cached(key, artist_id, ARTIST_ID_TTL)
+        except sqlite3.Error as error:
+            logger.exception(error)
 
     @credentials
     def get_discography(self, artist, song_name):
         """
-        Return the list of albums and their track names.
+        Return the list of albums and their track names. The song name is
+        only used to find the right artist, and can be empty.
+
+        If the discography of the same artist id is already cached under a
+        different name, that one is returned instead of fetching it again.
 
         Invalid albums (as decided by `is_value_invalid()`) are not included.
         Song names are preprocessed using `process()`.
 
-        The result is a dictionary indexed by album name and sorted by release
-        date.
+        The result is a dictionary of Album records indexed by album name and
+        sorted by release date.
         """
-        query = self.sp.search(
-            f'artist:{artist} track:{song_name}', type='track'
-        )
-        artist_id = query['tracks']['items'][0]['artists'][0]['id']
-        query = self.sp.artist_albums(artist_id, album_type='album')
+        artist_id = self.get_artist_id(artist, song_name)
+        known = self.artist_keys.get(artist_id)
+        if known in self.discography_cache:
+            logger.debug('found discography as %s', known)
+            return self.discography_cache[known]
+        self.artist_keys[artist_id] = artist_key(artist)
+        return self.get_artist_discography(artist_id)
+
+    @credentials
+    def get_artist_discography(self, artist_id):
+        """
+        Fetch the discography of an artist by id. See `get_discography()`.
+        """
+        query = self.call(self.sp.artist_albums, artist_id, album_type='album')
         artist_albums = {}
+        artist = None
         while query:
             for album in query['items']:
+                for credit in album.get('artists', ()):
+                    if credit.get('id') == artist_id:
+                        artist = credit.get('name')
                 name = process(album['name'], key='album')
                 name = name.lower()
                 if is_value_invalid(name, key='album'):
@@ -150,7 +440,9 @@ class Spotify:
                 _set_release_date(album)
                 elem = dict(id=album['id'], release_date=album['release_date'])
                 artist_albums[name] = elem
-            query = self.sp.next(query)
+            if not query.get('next'):
+                break
+            query = self.call(self.sp.next, query)
         sort = sorted(
             artist_albums.items(), key=lambda x: x[1]['release_date']
         )
@@ -158,7 +450,7 @@ class Spotify:
 
         album_ids = [album['id'] for album in artist_albums.values()]
         for albums, ids in chunks(artist_albums.values(), album_ids, 20):
-            query = self.sp.albums(ids)
+            query = self.call(self.sp.albums, ids)
 
             for album, response in zip(albums, query['albums']):
                 tracks = []
@@ -169,13 +461,16 @@ class Spotify:
                         process(t['name'], key='name').lower()
                         for t in response['items']
                     )
-                    response = self.sp.next(response)
+                    if not response.get('next'):
+                        break
+                    response = self.call(self.sp.next, response)
                 tracks = dict.fromkeys(tracks)
                 tracks.pop('Unknown', None)
                 album['tracks'] = list(tracks)
-        return {
-            k: v for k, v in artist_albums.items() if v.get('tracks', None)
-        }
+        return compact_discography(
+            {k: v for k, v in artist_albums.items() if v.get('tracks', None)},
+            artist,
+        )
 
     @credentials
     def fetch_discography(self, song):
@@ -184,33 +479,78 @@ class Spotify:
         the discography cache.
         """
         artist, title = song.artist, song.title
-        if artist in self.discography_cache:
+        key = artist_key(artist)
+        if key in self.discography_cache:
             logger.debug('found discography in cache')
             return
 
+        if self.load_shared(key):
+            logger.debug('found discography in shared cache')
+            return
+
         try:
             discog = self.get_discography(artist, title)
             logger.debug('got discography')
-            self.discography_cache[artist] = discog
+            self.discography_cache[key] = discog
+            self.save_shared(key, discog)
+        except CircuitOpen:
+            logger.info('spotify is unavailable, discography not fetched')
         except Exception as e:
             logger.exception(e)
             logger.debug('discography not found')
 
+    def load_shared(self, artist):
+        """
+        Load an artist's discography from the shared store into the local
+        cache. Returns True if it was found.
+        """
+        if self.store is None:
+            return False
+        try:
+            discog = self.store.get_discography(artist)
+        except sqlite3.Error as error:
+            logger.exception(error)
+            return False
+        if discog is None:
+            return False
+        self.discography_cache[artist] = compact_discography(discog)
+        return True
+
+    def save_shared(self, artist, discog):
+        """
+        Write an artist's discography to the shared store, if there is one.
+        """
+        if self.store is None:
+            return
+        try:
+            self.store.save_discography(artist, discog)
+        except sqlite3.Error as error:
+            logger.exception(error)
+
     @credentials
     def fetch_album(self, song):
         """
-        Get the name of the album for a song from spotify.
+        Get the name of the album for a song from spotify. If the title is not
+        in any album, the one with the most similar track is returned.
         """
-        artist, title = song.artist, song.title
+        artist, title = artist_key(song.artist), song.title
         self.fetch_discography(song)
         if not self.discography_cache.get(artist, ''):
             return 'Unknown'
 
         title = process(title, key='name')
-        for album_name, info in self.discography_cache[artist].items():
+        discog = self.discography_cache[artist]
+        for album_name, info in discog.items():
             if title.lower() in map(str.lower, info['tracks']):
                 return album_name
-        return 'Unknown'
+
+        # Fall back to the album with the most similar track name
+        best, best_score = 'Unknown', 0
+        for album_name, info in discog.items():
+            match = track_index(info['tracks']).search(title, k=1)
+            if match and match[0][1] > best_score:
+                best, best_score = album_name, match[0][1]
+        return best
 
     @credentials
     def get_album_tracks(self, song):
@@ -227,7 +567,8 @@ class Spotify:
         try:
             if not song.album or song.album == 'Unknown':
                 raise KeyError('Album not found')
-            return self.discography_cache[song.artist][song.album]['tracks']
+            discog = self.discography_cache[artist_key(song.artist)]
+            return discog[song.album]['tracks']
         except KeyError:
             msg = 'Spotify could not find the list of tracks for %s'
             logging.info(msg, song)
@@ -0,0 +1,61 @@
+"""
+Supersession of in-flight work.
+
+Every new unit of work for a key (like a chat id) supersedes the previous one,
+whose token is cancelled. The work itself has to check its token to find out
+that it's no longer needed.
+"""
+import threading
+
+
+class Token:
+    """
+    Cancellation token for a single unit of work.
+    """
+
+    def __init__(self):
+        self._cancelled = threading.Event()
+        self.finished = False
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+
+class Supersession:
+    """
+    Thread-safe registry of the token of the latest work for every key.
+    """
+
+    def __init__(self):
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def start(self, key, token):
+        """
+        Register the token of a new unit of work for a key, cancelling the
+        previous one. Returns True if that one had not finished yet.
+        """
+        with self._lock:
+            old = self._tokens.get(key)
+            self._tokens[key] = token
+            if old is None or old.finished:
+                return False
+        old.cancel()
+        return True
+
+    def finish(self, key, token):
+        """
+        Mark a unit of work as finished, and forget its token if it's still
+        the latest one for the key.
+        """
+        with self._lock:
+            token.finished = True
+            if self._tokens.get(key) is token:
+                del self._tokens[key]
+
+    def __len__(self):
+        return len(self._tokens)
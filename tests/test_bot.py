@@ -3,8 +3,11 @@ import json
 import time
 import sqlite3
 from tempfile import NamedTemporaryFile
+import threading
 from threading import Thread
 from functools import partial
+from urllib.error import HTTPError
+from urllib.error import URLError
 
 import pytest
 import telegram
@@ -22,6 +25,11 @@ from bot import parse_config
 from bot import send_message
 from conftest import Nothing
 from bot import Database
+from metrics import Metrics
+from spotify import Album
+from spotify import compact_discography
+from supersede import Token
+from util import split_message
 
 
 import bot as bot_module
@@ -44,6 +52,13 @@ class FakeBot:
         if text == 'raise error':
             raise_telegram_error()
         self.msg_log.append(text)
+        return Nothing(chat_id=kwargs['chat_id'], message_id=len(self.msg_log))
+
+    def edit_message_text(self, *args, **kwargs):
+        self.msg_log[kwargs['message_id'] - 1] = kwargs['text']
+
+    def delete_message(self, *args, **kwargs):
+        self.msg_log[kwargs['message_id'] - 1] = None
 
     def log_call(self, *args, **kwargs):
         self.call_log.append((*args, *kwargs.values()))
@@ -52,6 +67,37 @@ class FakeBot:
         self.log_call(*args, **kwargs)
 
 
+@pytest.fixture(autouse=True)
+def sender(monkeypatch):
+    """
+    Use a fresh message sender for every test, so that rate limits don't
+    carry over from one test to the next.
+    """
+    sender = bot_module.Sender(chat_burst=100)
+    monkeypatch.setattr(bot_module, 'SENDER', sender)
+    return sender
+
+
+@pytest.fixture(autouse=True)
+def replies(monkeypatch):
+    """
+    Don't share cached replies between tests.
+    """
+    replies = bot_module.LRUCache()
+    monkeypatch.setattr(bot_module, 'REPLIES', replies)
+    return replies
+
+
+@pytest.fixture(autouse=True)
+def tokens(monkeypatch):
+    """
+    Don't share cached spotify tokens between tests.
+    """
+    tokens = bot_module.LRUCache()
+    monkeypatch.setattr(bot_module, 'TOKENS', tokens)
+    return tokens
+
+
 @pytest.fixture
 def bot_arg():
     bot_arg = FakeBot()
@@ -106,7 +152,7 @@ def test_album_tracks_lastfm(monkeypatch, bot):
     song = Song('Sabaton', '1 6 4 8')
     with monkeypatch.context() as mkp:
         # An empty list should be returned if we can't find the album's name
-        mkp.setattr(song, 'fetch_album_name', lambda: None)
+        mkp.setattr(Song, 'fetch_album_name', lambda self: None)
         assert bot.get_album_tracks_lastfm(song) == []
 
     tracks = bot.get_album_tracks_lastfm(song)
@@ -197,6 +243,20 @@ def test_next_song_existing(bot, monkeypatch):
     assert bot._get_next_song('chat_id') == f'Searching for {song_next}'
 
 
+def test_next_song_fuzzy(bot, monkeypatch):
+    """
+    The title of the last song should be matched to the most similar one in
+    the track list if it's not exactly the same.
+    """
+    tracks = ['putrid fairy tale', 'war squids']
+    song_next = Song(fake_res['artist'], 'war squids', fake_res['album'])
+    bot.log_result('chat_id', fake_log)
+    monkeypatch.setattr(bot, 'get_album_tracks', lambda x: tracks)
+    monkeypatch.setattr(bot, 'get_lyrics', lambda s, c: f'Searching for {s}')
+
+    assert bot._get_next_song('chat_id') == f'Searching for {song_next}'
+
+
 def test_next_song(monkeypatch, bot, bot_arg, update):
     """
     Test the next_song function, in a similar manner to _get_next_song.
@@ -211,6 +271,48 @@ def test_next_song(monkeypatch, bot, bot_arg, update):
     assert bot_arg.msg_log[0] == f'Searching for {song_next}'
 
 
+def test_album(monkeypatch, bot, bot_arg, update):
+    """
+    Test getting the lyrics for a whole album. Replies should be sent in
+    track order, even if the songs are found in a different one.
+    """
+    tracks = ['orion', 'battery', 'damage inc']
+
+    def album_tracks(song):
+        song.album = 'master of puppets'
+        return tracks
+
+    def fetch_reply(song, sources):
+        time.sleep(0.1 * (len(tracks) - tracks.index(song.title)))
+        if song.title == 'damage inc':
+            return None, 'Not found'
+        source = Nothing(__name__='genius')
+        return Nothing(song=song, source=source), f'Lyrics: {song.title}'
+
+    monkeypatch.setattr(bot, 'get_album_tracks', album_tracks)
+    monkeypatch.setattr(bot, 'fetch_reply', fetch_reply)
+    context = Nothing(bot=bot_arg, args=[])
+    bot.album(update, context)
+    assert bot_arg.msg_log == ["You haven't searched for anything yet"]
+
+    context.args = ['metallica', '-', 'orion']
+    bot.album(update, context)
+    assert bot_arg.msg_log[1:] == [
+        'Looking for the lyrics of the 3 songs in Master Of Puppets',
+        'Lyrics: orion',
+        'Lyrics: battery',
+        'Not found',
+    ]
+    assert bot.DB.get_last_res(update.message.chat_id)['artist'] == 'metallica'
+
+    monkeypatch.setattr(bot, 'get_album_tracks', lambda song: [])
+    context.args = []
+    bot.album(update, context)
+    assert bot_arg.msg_log[-1] == (
+        'Could not find the album this song belongs to'
+    )
+
+
 def test_other_no_lastres(bot, bot_arg, update):
     """
     Test the 'other' function when there is no last result.
@@ -368,6 +470,171 @@ def test_find(monkeypatch, bot, bot_arg, update):
     assert bot_arg.msg_log[0] == 'here are your lyrics'
 
 
+@pytest.mark.parametrize('delay', [0, 0.2])
+def test_find_progressive(monkeypatch, bot, bot_arg, update, delay):
+    """
+    Slow searches should be acknowledged with a placeholder that is then
+    replaced by the first chunk of the lyrics.
+    """
+    lines = [f'line {i} ' + 'x' * 100 for i in range(60)]
+    text = '\n'.join(lines)
+    chunks = list(split_message(text, telegram.constants.MAX_MESSAGE_LENGTH))
+    assert len(chunks) == 2
+
+    def fake_getlyrics(*args, **kwargs):
+        time.sleep(delay)
+        return text
+
+    monkeypatch.setattr(bot, 'get_lyrics', fake_getlyrics)
+    monkeypatch.setattr(bot, 'PROGRESSIVE', True)
+    monkeypatch.setattr(bot, 'PLACEHOLDER_DELAY', 0.1)
+    sent = []
+    send = bot_arg.send_message
+
+    def send_message(**kwargs):
+        sent.append(kwargs['text'])
+        return send(**kwargs)
+
+    monkeypatch.setattr(bot_arg, 'send_message', send_message)
+
+    bot.find(update, Nothing(bot=bot_arg))
+    assert bot_arg.msg_log == chunks
+    if delay:
+        assert sent == [bot.PLACEHOLDER_MSG, chunks[1]]
+    else:
+        assert sent == chunks
+
+
+def test_find_progressive_superseded(monkeypatch, bot, bot_arg, update):
+    """
+    The placeholder of a superseded search should be removed.
+    """
+    token = Token()
+
+    def fake_getlyrics(*args, **kwargs):
+        time.sleep(0.2)
+        token.cancel()
+        return 'here are your lyrics'
+
+    monkeypatch.setattr(bot, 'get_lyrics', fake_getlyrics)
+    monkeypatch.setattr(bot, 'PROGRESSIVE', True)
+    monkeypatch.setattr(bot, 'PLACEHOLDER_DELAY', 0.1)
+    bot.CURRENT.token = token
+    try:
+        bot.find(update, Nothing(bot=bot_arg))
+    finally:
+        bot.CURRENT.token = None
+    assert bot_arg.msg_log == [None]
+
+
+def test_find_batch(monkeypatch, bot, bot_arg, update):
+    """
+    Test finding lyrics for several songs in the same message.
+    """
+    searched = []
+
+    def fetch_reply(song, sources):
+        searched.append(song.title)
+        time.sleep(0.05 if song.title == 'orion' else 0)
+        if song.title == 'one':
+            return None, 'Not found'
+        source = Nothing(__name__='genius')
+        return Nothing(song=song, source=source), f'Lyrics: {song.title}'
+
+    monkeypatch.setattr(bot, 'fetch_reply', fetch_reply)
+    monkeypatch.setattr(bot, 'BATCH_SIZE', 3)
+    update.message.text = (
+        'Metallica - Orion\n\nmetallica - one\nnonsense\n'
+        'Metallica - orion \nmetallica - battery\nmetallica - fuel'
+    )
+    bot.find(update, Nothing(bot=bot_arg))
+    assert bot_arg.msg_log == [
+        'Invalid format:\nnonsense',
+        'I can only look for 3 songs at a time, so I will skip the rest',
+        'Lyrics: Orion',
+        'Not found',
+        'Lyrics: battery',
+    ]
+    assert sorted(searched) == ['Orion', 'battery', 'one']
+    assert bot.DB.get_last_res(update.message.chat_id)['title'] == 'battery'
+    assert len(bot.DB.get_song_counts()) == 2
+
+
+def test_search(bot, bot_arg, update):
+    """
+    Test searching for songs by their lyrics.
+    """
+    bot.DB.save_lyrics('queen', 'bohemian rhapsody', 'genius', 'mama')
+    context = Nothing(bot=bot_arg, args=[])
+    bot.search(update, context)
+    assert bot_arg.msg_log[0].startswith('Tell me some of the lyrics')
+
+    context.args = ['Mama']
+    bot.search(update, context)
+    assert bot_arg.msg_log[1] == (
+        'These songs match your search:\n1. Queen - Bohemian Rhapsody'
+    )
+
+    context.args = ['galileo']
+    bot.search(update, context)
+    assert bot_arg.msg_log[2] == "I don't know any songs with those lyrics"
+
+
+def test_inline_query(bot, monkeypatch):
+    """
+    Test suggesting songs from the log and the cached discographies.
+    """
+    insert = 'insert into log (chat_id, artist, title) values (?, ?, ?)'
+    for chat_id in range(2):
+        bot.DB._execute(insert, (chat_id, 'Motorhead', "We're motorhead"))
+    bot.DB._execute(insert, (0, 'motorhead', 'ace of spades'))
+    discog = {'overkill': Album('id', '1979', ('overkill', 'damage case'))}
+    monkeypatch.setattr(bot.SP, 'discography_cache', {'motorhead': discog})
+    monkeypatch.setattr(bot, 'SUGGESTIONS', bot.build_suggestions())
+    monkeypatch.setattr(bot, 'SUGGESTIONS_BUILT', time.monotonic())
+
+    answers = []
+    update = Nothing(inline_query=Nothing(query='motorhead - '))
+    update.inline_query.answer = lambda results, **kw: answers.append(results)
+    bot.inline_query(update, None)
+    assert [result.title for result in answers[0]] == [
+        "Motorhead - We're Motorhead",
+        'Motorhead - Ace Of Spades',
+        'Motorhead - Damage Case',
+        'Motorhead - Overkill',
+    ]
+    assert answers[0][0].input_message_content.message_text == (
+        "Motorhead - We're Motorhead"
+    )
+
+    update.inline_query.query = 'Dam'
+    bot.inline_query(update, None)
+    assert [result.title for result in answers[1]] == [
+        'Motorhead - Damage Case'
+    ]
+
+
+def test_suggestions_artist_names(monkeypatch, database):
+    """
+    Songs from the cached discographies should be suggested with the artist's
+    name as spotify spells it, not the normalized name they are cached by.
+    """
+    monkeypatch.setattr(bot_module, 'DB', database)
+    acdc = {'back in black': Album('id', '1980', ('hells bells',))}
+    motorhead = {'overkill': Album('id', '1979', ('overkill',))}
+    monkeypatch.setattr(
+        bot_module.SP,
+        'discography_cache',
+        {
+            'acdc': compact_discography(acdc, 'AC/DC'),
+            'motorhead': compact_discography(motorhead),
+        },
+    )
+    suggestions = bot_module.build_suggestions()
+    assert suggestions.search('hells') == ['AC/DC - Hells Bells']
+    assert suggestions.search('over') == ['Motorhead - Overkill']
+
+
 def test_unknown(bot_arg, update):
     """
     Test the 'unknown' function.
@@ -407,11 +674,109 @@ def test_now(bot, monkeypatch, bot_arg, update):
     song = Song('Orphaned land', 'ornaments of gold')
     lyrics = 'The light of the dark is the morning of the dawn'
     monkeypatch.setattr(bot.SP, 'currently_playing', lambda x: song)
-    monkeypatch.setattr(bot, 'get_lyrics', lambda x, y: lyrics)
+    monkeypatch.setattr(bot, 'find_lyrics', lambda x, y: (None, lyrics))
     bot.now(bot_arg, update)
     assert bot_arg.msg_log[3] == lyrics
 
 
+def test_now_login_timeout(bot, monkeypatch, bot_arg, update):
+    """
+    The login should only be waited for up to LOGIN_WAIT seconds.
+    """
+    monkeypatch.setattr(bot, 'LOGIN_WAIT', 0)
+    monkeypatch.setattr(bot, 'get_sp_token', lambda x: None)
+    monkeypatch.setattr(bot.DB, 'get_sp_token', lambda x: None)
+    monkeypatch.setattr(bot.SP, 'get_auth_url', lambda x: 'url')
+    bot.now(update, Nothing(bot=bot_arg))
+    assert bot_arg.msg_log == [
+        'Please open this link to log in to Spotify',
+        'url',
+        'Send /now again once you have logged in',
+    ]
+
+
+def test_now_cached(bot, monkeypatch, bot_arg, update):
+    """
+    Repeated calls to /now while the same track is playing should reuse the
+    last reply.
+    """
+    monkeypatch.setattr(bot, 'NOW_PLAYING', bot.LRUCache())
+    monkeypatch.setattr(bot, 'get_sp_token', lambda x: 'token')
+    calls = {'spotify': 0, 'lyrics': 0}
+    now = [1000]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+
+    def currently_playing(token):
+        calls['spotify'] += 1
+        song = Song('Orphaned land', 'ornaments of gold')
+        song.track_id = 'ornaments' if now[0] < 2000 else 'sapari'
+        song.remaining = 20
+        return song
+
+    def find_lyrics(song, chat_id):
+        calls['lyrics'] += 1
+        reply = bot.Reply.render(f'lyrics for {song.track_id}', 4096)
+        return Nothing(song=song, source=fake_log.source), reply
+
+    monkeypatch.setattr(bot.SP, 'currently_playing', currently_playing)
+    monkeypatch.setattr(bot, 'find_lyrics', find_lyrics)
+    context = Nothing(bot=bot_arg)
+
+    bot.now(update, context)
+    bot.now(update, context)
+    assert calls == {'spotify': 1, 'lyrics': 1}
+
+    # Spotify is asked again after the ttl, but the lyrics are not searched
+    # again if the track is the same
+    now[0] += 21
+    bot.now(update, context)
+    assert calls == {'spotify': 2, 'lyrics': 1}
+
+    now[0] = 2000
+    bot.now(update, context)
+    assert calls == {'spotify': 3, 'lyrics': 2}
+    assert bot_arg.msg_log == ['lyrics for ornaments'] * 3 + [
+        'lyrics for sapari'
+    ]
+
+
+def test_now_cached_logged(bot, monkeypatch, bot_arg, update):
+    """
+    A reused reply to /now should become the last result again, so that /next
+    after /now, /next and /now goes on from the song that is playing.
+    """
+    monkeypatch.setattr(bot, 'NOW_PLAYING', bot.LRUCache())
+    monkeypatch.setattr(bot, 'get_sp_token', lambda x: 'token')
+    playing = Song('orphaned land', 'ornaments of gold')
+    playing.track_id = 'ornaments'
+    playing.remaining = 20
+    monkeypatch.setattr(bot.SP, 'currently_playing', lambda token: playing)
+
+    def fetch_reply(song, sources):
+        song.lyrics = f'lyrics for {song.title}'
+        reply = bot.Reply.render(song.lyrics, 4096)
+        return Nothing(song=song, source=fake_log.source), reply
+
+    def find_next_song(song):
+        return Song(song.artist, 'sapari', song.album)
+
+    monkeypatch.setattr(bot, 'fetch_reply', fetch_reply)
+    monkeypatch.setattr(bot, 'find_next_song', find_next_song)
+    context = Nothing(bot=bot_arg)
+    chat_id = update.message.chat_id
+
+    bot.now(update, context)
+    bot.next_song(update, context)
+    assert bot.DB.get_last_res(chat_id)['title'] == 'sapari'
+    bot.now(update, context)
+    assert bot.DB.get_last_res(chat_id)['title'] == 'ornaments of gold'
+    assert bot_arg.msg_log == [
+        'lyrics for ornaments of gold',
+        'lyrics for sapari',
+        'lyrics for ornaments of gold',
+    ]
+
+
 def test_text(bot, bot_arg, update, monkeypatch):
     """
     Test the generic text command.
@@ -421,12 +786,16 @@ def test_text(bot, bot_arg, update, monkeypatch):
     log_as_handler = partial(bot_arg.log_call, source='handler')
 
     monkeypatch.setattr(bot, 'find', log_find)
-    bot.HANDLERS[chat_id].append(log_as_handler)
+    monkeypatch.setattr(bot, 'HANDLERS', bot.ConversationStore())
+    bot.HANDLERS.push(chat_id, log_as_handler)
     bot.text(bot_arg, update)
     bot.text(bot_arg, update)
     assert bot_arg.call_log[0] == (bot_arg, update, 'handler')
     assert bot_arg.call_log[1] == (bot_arg, update, 'find')
 
+    # Chats without handlers don't take any space
+    assert len(bot.HANDLERS) == 0
+
 
 @pytest.mark.parametrize(
     'content',
@@ -491,4 +860,427 @@ def test_send_message_not_fitting_parragraphs(bot_arg, monkeypatch):
     msg = 'hello\n\nworld, this is a message'
     send_message(msg, bot_arg, 1)
     assert bot_arg.msg_log[0] == 'hello'
-    assert bot_arg.msg_log[1].strip() == 'world, this is a message'
+    assert bot_arg.msg_log[1] == 'world, this is a'
+    assert bot_arg.msg_log[2] == 'message'
+
+
+def test_send_message_chunks(bot_arg):
+    """
+    Test sending a message that has already been split in chunks.
+    """
+    send_message(('hello', 'world'), bot_arg, 1)
+    assert bot_arg.msg_log == ['hello', 'world']
+
+
+def test_queued(monkeypatch, bot_arg, update):
+    """
+    Test that queued handlers run in the scheduler, and that the user is told
+    to wait when the queue is full.
+    """
+    log = []
+    context = Nothing(bot=bot_arg)
+    scheduler = bot_module.ChatScheduler(workers=1, max_pending=1)
+    monkeypatch.setattr(bot_module, 'SCHEDULER', scheduler)
+    handler = bot_module.queued(lambda u, c: log.append((u, c)))
+
+    scheduler.submit(update.message.chat_id, time.sleep, 0.2)
+    while scheduler.pending():
+        time.sleep(0.01)
+    handler(update, context)
+    handler(update, context)
+    scheduler.stop()
+
+    assert log == [(update, context)]
+    assert bot_arg.msg_log == [bot_module.BUSY_MSG]
+
+
+def test_queued_supersedes(monkeypatch, bot_arg, update):
+    """
+    Test that a new search cancels the ones that are still queued or running
+    in the same chat, which don't send any replies.
+    """
+    started = []
+    release = threading.Event()
+
+    def search(update, context):
+        started.append(update.message.text)
+        if update.message.text == 'first':
+            release.wait(5)
+        send_message(f'reply to {update.message.text}', bot_arg, 'chat_id')
+
+    context = Nothing(bot=bot_arg)
+    scheduler = bot_module.ChatScheduler(workers=1)
+    monkeypatch.setattr(bot_module, 'SCHEDULER', scheduler)
+    monkeypatch.setattr(bot_module, 'SEARCHES', bot_module.Supersession())
+    metrics = Metrics()
+    monkeypatch.setattr(bot_module, 'METRICS', metrics)
+    handler = bot_module.queued(search, supersedes=True)
+
+    for text in ('first', 'second', 'third'):
+        message = Nothing(chat_id='chat_id', text=text)
+        handler(Nothing(message=message), context)
+        while text == 'first' and not started:
+            time.sleep(0.01)
+    release.set()
+    scheduler.stop()
+
+    assert started == ['first', 'third']
+    assert bot_arg.msg_log == ['reply to third']
+    assert len(bot_module.SEARCHES) == 0
+    assert metrics.get('searches.superseded') == 2
+    assert metrics.get('searches.skipped') == 1
+    assert metrics.get('searches.discarded') == 1
+
+
+def test_queued_finished(monkeypatch, bot_arg, update):
+    """
+    Searches that finish before the handler returns, or that can't be queued
+    at all, should not be left registered as the chat's current search.
+    """
+
+    class Scheduler:
+        busy = False
+
+        def submit(self, chat_id, func, *args):
+            if self.busy:
+                return False
+            func(*args)
+            return True
+
+    def search(update, context):
+        send_message('reply', bot_arg, 'chat_id')
+
+    scheduler = Scheduler()
+    monkeypatch.setattr(bot_module, 'SCHEDULER', scheduler)
+    monkeypatch.setattr(bot_module, 'SEARCHES', bot_module.Supersession())
+    metrics = Metrics()
+    monkeypatch.setattr(bot_module, 'METRICS', metrics)
+    handler = bot_module.queued(search, supersedes=True)
+    context = Nothing(bot=bot_arg)
+
+    handler(update, context)
+    handler(update, context)
+    assert len(bot_module.SEARCHES) == 0
+    assert metrics.get('searches.superseded') == 0
+
+    scheduler.busy = True
+    handler(update, context)
+    assert len(bot_module.SEARCHES) == 0
+    assert bot_arg.msg_log == ['reply', 'reply', bot_module.BUSY_MSG]
+
+
+def test_fetch_replies_superseded(monkeypatch):
+    """
+    Songs of a superseded album or batch that didn't start yet should be
+    cancelled.
+    """
+    release = threading.Event()
+    pool = bot_module.ThreadPoolExecutor(1)
+    monkeypatch.setattr(bot_module, 'LYRICS_POOL', pool)
+    fetched = []
+    running = threading.Event()
+
+    def fetch_reply(song, sources):
+        if song.title != 'one':
+            running.set()
+            release.wait(5)
+        fetched.append(song.title)
+        return None, song.title
+
+    monkeypatch.setattr(bot_module, 'fetch_reply', fetch_reply)
+    metrics = Metrics()
+    monkeypatch.setattr(bot_module, 'METRICS', metrics)
+    token = bot_module.Token()
+    monkeypatch.setattr(bot_module.CURRENT, 'token', token, raising=False)
+
+    songs = [Song('metallica', title) for title in ('one', 'two', 'three')]
+    replies = bot_module.fetch_replies(songs, [])
+    assert next(replies) == (None, 'one')
+    assert running.wait(5)
+    token.cancel()
+    release.set()
+    assert list(replies) == []
+    pool.shutdown()
+    assert fetched == ['one', 'two']
+    assert metrics.get('searches.cancelled_songs') == 1
+
+
+def test_get_lyrics_cached(monkeypatch, database, replies):
+    """
+    Repeated searches for the same song should be answered from the cache of
+    rendered replies, and still be logged as the last result.
+    """
+    calls = []
+
+    def fake_get_lyrics_threaded(song, sources):
+        calls.append(song)
+        song.lyrics = 'lyrics'
+        return Nothing(song=song, source=fake_log.source)
+
+    monkeypatch.setattr(bot_module, 'DB', database)
+    monkeypatch.setattr(
+        bot_module, 'get_lyrics_threaded', fake_get_lyrics_threaded
+    )
+    msg = get_lyrics('obituary - ten thousand ways to die', 1)
+    assert 'Ten Thousand Ways To Die' in msg
+    assert msg.chunks == (msg,)
+
+    again = get_lyrics('Obituary - Ten Thousand Ways to Die ', 2)
+    assert again is msg
+    assert len(calls) == 1
+    assert database.get_last_res(2)['title'] == 'ten thousand ways to die'
+
+    # Searching with a different list of sources is a different request
+    get_lyrics('obituary - ten thousand ways to die', 1, sources=[])
+    assert len(calls) == 2
+
+
+def test_album_tracks_lastfm_cached(monkeypatch, database):
+    """
+    Lastfm album and track list lookups should only be requested once for
+    every song, regardless of how it's spelled.
+    """
+    calls = []
+
+    def fake_get_lastfm(method, **kwargs):
+        calls.append(method)
+        tracks = [{'name': 'Ghost Division'}, {'name': 'The Art of War'}]
+        return {'album': {'tracks': {'track': tracks}}}
+
+    def fetch_album_name(song):
+        calls.append('track.getInfo')
+        song.album = 'The Art of War'
+
+    monkeypatch.setattr(bot_module, 'DB', database)
+    monkeypatch.setattr(bot_module, 'get_lastfm', fake_get_lastfm)
+    monkeypatch.setattr(Song, 'fetch_album_name', fetch_album_name)
+
+    expect = ['ghost division', 'the art of war']
+    song = Song('Sabaton', 'Ghost Division')
+    assert bot_module.get_album_tracks_lastfm(song) == expect
+    assert calls == ['track.getInfo', 'album.getInfo']
+
+    song = Song('sabaton ', 'ghost division')
+    assert bot_module.get_album_tracks_lastfm(song) == expect
+    assert song.album == 'The Art of War'
+    assert calls == ['track.getInfo', 'album.getInfo']
+
+
+def test_album_tracks_lastfm_missing(monkeypatch, database):
+    """
+    The song's own album shouldn't be cached as lastfm's when lastfm doesn't
+    know it.
+    """
+    monkeypatch.setattr(bot_module, 'DB', database)
+    monkeypatch.setattr(bot_module, 'get_lastfm', lambda *a, **k: None)
+    monkeypatch.setattr(Song, 'fetch_album_name', lambda self: None)
+
+    song = Song('Metallica', 'One', album='Spotify Album Name')
+    assert bot_module.get_album_tracks_lastfm(song) == []
+    assert song.album == 'Spotify Album Name'
+    assert database.get_cached('lastfm:album:metallica:one') is None
+
+
+def test_album_tracks_parallel(monkeypatch):
+    """
+    Both album providers should be searched at the same time, and the song's
+    album updated with the one from the provider that answered.
+    """
+
+    def slow(tracks, album, delay):
+        def lookup(song):
+            time.sleep(delay)
+            song.album = album
+            return tracks
+
+        return lookup
+
+    song = Song('sabaton', 'ghost division')
+    monkeypatch.setattr(
+        bot_module, 'get_album_tracks_spotify', slow(['sp'], 'sp', 0.3)
+    )
+    monkeypatch.setattr(
+        bot_module, 'get_album_tracks_lastfm', slow(['fm'], 'fm', 0.3)
+    )
+    start = time.monotonic()
+    assert bot_module.get_album_tracks(song) == ['sp']
+    assert time.monotonic() - start < 0.5
+    assert song.album == 'sp'
+
+    # Spotify is preferred, even if lastfm is faster
+    monkeypatch.setattr(
+        bot_module, 'get_album_tracks_lastfm', slow(['fm'], 'fm', 0)
+    )
+    assert bot_module.get_album_tracks(song) == ['sp']
+
+    # Unless it doesn't answer before the deadline
+    monkeypatch.setattr(bot_module, 'ALBUM_DEADLINE', 0.1)
+    assert bot_module.get_album_tracks(song) == ['fm']
+    assert song.album == 'fm'
+
+
+def test_album_tracks_errors(monkeypatch):
+    """
+    Errors in one of the providers shouldn't affect the other one.
+    """
+    song = Song('sabaton', 'ghost division')
+    monkeypatch.setattr(
+        bot_module, 'get_album_tracks_spotify', raise_sqlite_error
+    )
+    monkeypatch.setattr(bot_module, 'get_album_tracks_lastfm', lambda s: [])
+    assert bot_module.get_album_tracks(song) == []
+
+    monkeypatch.setattr(bot_module, 'get_album_tracks_lastfm', lambda s: ['a'])
+    assert bot_module.get_album_tracks(song) == ['a']
+
+
+def test_prefetch_next(monkeypatch, database):
+    """
+    With prefetching enabled, the lyrics for the next song in the album
+    should be cached right after a search, so that /next is served from the
+    cache.
+    """
+    searched = []
+
+    def fake_get_lyrics_threaded(song, sources):
+        searched.append(song.title)
+        song.lyrics = f'lyrics for {song.title}'
+        return Nothing(song=song, source=fake_log.source)
+
+    tracks = [fake_res['title'], 'war squids']
+    pool = bot_module.ThreadPoolExecutor()
+    monkeypatch.setattr(bot_module, 'DB', database)
+    monkeypatch.setattr(bot_module, 'PREFETCH', True)
+    monkeypatch.setattr(bot_module, 'PREFETCH_POOL', pool)
+    monkeypatch.setattr(bot_module, 'get_album_tracks', lambda x: tracks)
+    monkeypatch.setattr(
+        bot_module, 'get_lyrics_threaded', fake_get_lyrics_threaded
+    )
+
+    song = Song(fake_res['artist'], fake_res['title'], fake_res['album'])
+    get_lyrics(song, 'chat_id')
+    pool.shutdown(wait=True)
+    assert searched == [fake_res['title'], 'war squids']
+
+    monkeypatch.setattr(bot_module, 'PREFETCH', False)
+    msg = bot_module._get_next_song('chat_id')
+    assert 'lyrics for war squids' in msg
+    assert searched == [fake_res['title'], 'war squids']
+
+
+def test_prefetch_next_disabled(monkeypatch):
+    """
+    Nothing should be prefetched if the feature is disabled, the album is
+    unknown or the prefetch budget has been used up.
+    """
+    submitted = []
+    pool = Nothing(submit=lambda *args: submitted.append(args))
+    monkeypatch.setattr(bot_module, 'PREFETCH_POOL', pool)
+
+    song = Song('slugdge', 'crop killer', 'esoteric malacology')
+    bot_module.prefetch_next(song)
+    assert not submitted
+
+    monkeypatch.setattr(bot_module, 'PREFETCH', True)
+    bot_module.prefetch_next(Song('slugdge', 'crop killer', 'Unknown'))
+    bot_module.prefetch_next(Song('slugdge', 'crop killer'))
+    assert not submitted
+
+    slots = bot_module.threading.BoundedSemaphore(1)
+    slots.acquire()
+    monkeypatch.setattr(bot_module, 'PREFETCH_SLOTS', slots)
+    bot_module.prefetch_next(song)
+    assert not submitted
+
+
+def test_fetch_reply_breakers(monkeypatch, database):
+    """
+    Sources whose circuit breaker is open should not be searched.
+    """
+    searched = []
+
+    def fake_get_lyrics_threaded(song, sources):
+        searched.append([source.__name__ for source in sources])
+        song.lyrics = 'lyrics'
+        return Nothing(song=song, source=sources[0])
+
+    breakers = bot_module.Breakers(min_calls=1, metrics=Metrics())
+    monkeypatch.setattr(bot_module, 'DB', database)
+    monkeypatch.setattr(bot_module, 'BREAKERS', breakers)
+    monkeypatch.setattr(
+        bot_module, 'get_lyrics_threaded', fake_get_lyrics_threaded
+    )
+    sources = [lyricfetch.scraping.azlyrics, lyricfetch.scraping.genius]
+    breakers['azlyrics'].record(True)
+    song = Song('obituary', 'slowly we rot')
+    res, msg = bot_module.fetch_reply(song, sources)
+    assert searched == [['genius']]
+    assert res.source is lyricfetch.scraping.genius
+
+    breakers['genius'].record(True)
+    song = Song('obituary', 'cause of death')
+    res, msg = bot_module.fetch_reply(song, sources)
+    assert res is None
+    assert 'not responding' in msg
+    assert len(searched) == 1
+
+
+def test_guard_sources(monkeypatch):
+    """
+    Errors that mean a source is down should open its breaker, but pages that
+    don't exist should not.
+    """
+
+    def down(song):
+        raise URLError('timed out')
+
+    def missing(song):
+        raise HTTPError('url', 404, 'Not Found', {}, None)
+
+    breakers = bot_module.Breakers(
+        min_calls=2, is_failure=bot_module.is_unavailable, metrics=Metrics()
+    )
+    monkeypatch.setattr(bot_module, 'BREAKERS', breakers)
+    for _ in range(2):
+        guarded = bot_module.guard_sources([down, missing])
+        assert [source.__wrapped__ for source in guarded] == [down, missing]
+        for source in guarded:
+            with pytest.raises(URLError):
+                source(Song('obituary', 'slowly we rot'))
+
+    guarded = bot_module.guard_sources([down, missing])
+    assert [source.__name__ for source in guarded] == ['missing']
+
+
+def test_fetch_reply_saved(monkeypatch, database):
+    """
+    Lyrics that were found should be saved to the database, and used for
+    later searches from the same sources.
+    """
+    searched = []
+
+    def fake_get_lyrics_threaded(song, sources):
+        searched.append(song)
+        song.lyrics = 'lyrics'
+        return Nothing(song=song, source=fake_log.source)
+
+    monkeypatch.setattr(bot_module, 'DB', database)
+    monkeypatch.setattr(
+        bot_module, 'get_lyrics_threaded', fake_get_lyrics_threaded
+    )
+    sources = lyricfetch.sources
+    song = Song('obituary', 'slowly we rot')
+    res, msg = bot_module.fetch_reply(song, sources)
+    assert len(searched) == 1
+
+    bot_module.REPLIES.clear()
+    again = Song('Obituary', 'Slowly We Rot')
+    saved, saved_msg = bot_module.fetch_reply(again, sources)
+    assert len(searched) == 1
+    assert saved.source is fake_log.source
+    assert saved.song.lyrics == 'lyrics'
+    assert saved_msg == msg
+
+    # Only use saved lyrics from the requested sources
+    bot_module.fetch_reply(song, sources[1:])
+    assert len(searched) == 2
@@ -0,0 +1,139 @@
+import sys
+
+import pytest
+
+sys.path.append('.')
+from breaker import Breakers
+from breaker import CircuitBreaker
+from breaker import CircuitOpen
+from breaker import CLOSED
+from breaker import HALF_OPEN
+from breaker import OPEN
+from metrics import Metrics
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def make_breaker(**kwargs):
+    clock = Clock()
+    breaker = CircuitBreaker(
+        'test',
+        min_calls=4,
+        window=10,
+        cooldown=5,
+        clock=clock,
+        metrics=Metrics(),
+        **kwargs,
+    )
+    return breaker, clock
+
+
+def test_breaker_opens():
+    """
+    The breaker should open once enough of the calls in the window failed.
+    """
+    breaker, clock = make_breaker()
+    for failed in (True, False, True):
+        assert breaker.allow()
+        breaker.record(failed)
+    assert breaker.state == CLOSED
+
+    breaker.record(True)
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    assert breaker.metrics.get('breaker.test.state') == 2
+    assert breaker.metrics.get('breaker.test.opened') == 1
+    assert breaker.metrics.get('breaker.test.rejected') == 1
+
+
+def test_breaker_window():
+    """
+    Only the calls in the window should count towards the failure rate.
+    """
+    breaker, clock = make_breaker()
+    for _ in range(3):
+        breaker.record(True)
+    clock.now = 11
+    for _ in range(3):
+        breaker.record(False)
+    breaker.record(True)
+    assert breaker.state == CLOSED
+
+
+def test_breaker_half_open():
+    """
+    After the cooldown, a single trial call should be allowed, which closes
+    the breaker again if it works.
+    """
+    breaker, clock = make_breaker()
+    for _ in range(4):
+        breaker.record(True)
+    clock.now = 5
+    assert breaker.state == HALF_OPEN
+    assert breaker.metrics.get('breaker.test.state') == 1
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    # A trial that never reports back is replaced after another cooldown
+    clock.now = 10
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.state == CLOSED
+    assert breaker.allow()
+    assert breaker.metrics.get('breaker.test.state') == 0
+
+
+def test_breaker_half_open_failure():
+    breaker, clock = make_breaker()
+    for _ in range(4):
+        breaker.record(True)
+    clock.now = 5
+    assert breaker.allow()
+    breaker.record(True)
+    assert breaker.state == OPEN
+    clock.now = 9
+    assert not breaker.allow()
+    clock.now = 10
+    assert breaker.allow()
+
+
+def test_breaker_call():
+    """
+    Slow calls and the errors chosen by 'is_failure' should count as
+    failures.
+    """
+
+    def is_failure(error):
+        return not isinstance(error, KeyError)
+
+    breaker, clock = make_breaker(slow=1, is_failure=is_failure)
+
+    def slow():
+        clock.now += 2
+        return 'result'
+
+    def fail(error):
+        raise error
+
+    assert breaker.call(slow) == 'result'
+    for _ in range(2):
+        with pytest.raises(KeyError):
+            breaker.call(fail, KeyError())
+    with pytest.raises(ValueError):
+        breaker.call(fail, ValueError())
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpen):
+        breaker.call(slow)
+
+
+def test_breakers():
+    breakers = Breakers(cooldown=5, metrics=Metrics())
+    assert breakers['genius'] is breakers['genius']
+    assert breakers['genius'] is not breakers['azlyrics']
+    assert breakers['azlyrics'].cooldown == 5
@@ -0,0 +1,64 @@
+import sys
+
+sys.path.append('.')
+from cache import LRUCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_get_set():
+    cache = LRUCache()
+    assert cache.get('key') is None
+    assert cache.get('key', 'default') == 'default'
+    cache.set('key', 'value')
+    assert cache.get('key') == 'value'
+    assert 'key' in cache
+    assert len(cache) == 1
+
+
+def test_eviction():
+    """
+    The least recently used items should be evicted when the cache is full.
+    """
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert 'c' in cache
+    assert len(cache) == 2
+
+
+def test_expiration():
+    clock = Clock()
+    cache = LRUCache(ttl=10, clock=clock)
+    cache.set('default', 1)
+    cache.set('short', 2, ttl=1)
+    cache.set('long', 3, ttl=100)
+
+    clock.now = 5
+    assert cache.get('short') is None
+    assert cache.get('default') == 1
+
+    clock.now = 50
+    assert cache.get('default') is None
+    assert cache.pop('long') == 3
+    assert 'long' not in cache
+
+
+def test_pop_clear():
+    cache = LRUCache()
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.pop('a') == 1
+    assert cache.pop('a', 'missing') == 'missing'
+    cache.clear()
+    assert len(cache) == 0
@@ -0,0 +1,108 @@
+import sys
+
+import pytest
+
+sys.path.append('.')
+from conversation import ConversationStore
+
+
+def first(update, context):
+    pass
+
+
+def second(update, context):
+    pass
+
+
+def test_push_pop():
+    handlers = ConversationStore()
+    assert handlers.pop('chat') is None
+    assert 'chat' not in handlers
+    assert len(handlers) == 0
+
+    handlers.push('chat', first)
+    handlers.push('chat', second)
+    assert 'chat' in handlers
+    assert 'other' not in handlers
+    assert handlers.pop('chat') is second
+    assert handlers.pop('chat') is first
+    assert handlers.pop('chat') is None
+    assert len(handlers) == 0
+
+
+def test_bounded():
+    """
+    The least recently used chats are dropped when the store is full.
+    """
+    handlers = ConversationStore(maxsize=2)
+    for chat_id in range(5):
+        handlers.push(chat_id, first)
+    assert len(handlers) == 2
+    assert handlers.pop(0) is None
+    assert handlers.pop(4) is first
+
+
+def test_expiration():
+    now = [0]
+    handlers = ConversationStore(ttl=10, clock=lambda: now[0])
+    handlers.push('chat', first)
+    now[0] = 11
+    assert handlers.pop('chat') is None
+
+
+def test_persistence(database):
+    """
+    Handler stacks are restored from the persistent store after they have
+    been dropped from memory.
+    """
+    handlers = ConversationStore(store=database)
+    handlers.register(first)
+    handlers.register(second)
+    with pytest.raises(ValueError):
+        handlers.push('chat', test_persistence)
+
+    handlers.push('chat', first)
+    handlers.push('chat', second)
+    handlers.clear()
+    assert len(handlers) == 0
+
+    restarted = ConversationStore(store=database)
+    restarted.register(first)
+    restarted.register(second)
+    assert restarted.pop('chat') is second
+    assert handlers.pop('chat') is first
+    assert handlers.pop('chat') is None
+    assert database.get_cached('handlers:chat') is None
+
+
+def test_persistence_misses(database):
+    """
+    Chats without handlers in the persistent store are only looked up once.
+    """
+
+    class Store:
+        def __init__(self):
+            self.lookups = 0
+
+        def get_cached(self, key):
+            self.lookups += 1
+            return database.get_cached(key)
+
+        def save_cached(self, key, value, ttl):
+            database.save_cached(key, value, ttl)
+
+        def delete_cached(self, key):
+            database.delete_cached(key)
+
+    store = Store()
+    handlers = ConversationStore(store=store)
+    handlers.register(first)
+    for _ in range(3):
+        assert handlers.pop('chat') is None
+    assert store.lookups == 1
+
+    handlers.push('chat', first)
+    handlers.clear()
+    assert handlers.pop('chat') is first
+    assert handlers.pop('chat') is None
+    assert store.lookups == 2
@@ -5,6 +5,7 @@ import sqlite3
 from lyricfetch import Song
 
 from conftest import Nothing
+import db
 
 
 def test_config(database):
@@ -126,3 +127,230 @@ def test_get_last_res(database):
 @pytest.mark.parametrize('param, expect', [(1, '1'), ("'hello'", "''hello''")])
 def test_sanitize(database, param, expect):
     assert database.sanitize(param) == expect
+
+
+def test_discography(database):
+    """
+    Test storing and retrieving a discography from the shared cache.
+    """
+    artist = "guns n' roses"
+    assert database.get_discography(artist) is None
+
+    discog = {'appetite for destruction': {'tracks': ['mr brownstone']}}
+    database.save_discography(artist, discog)
+    assert database.get_discography(artist) == discog
+
+    discog['use your illusion'] = {'tracks': ['november rain']}
+    database.save_discography(artist, discog)
+    assert database.get_discography(artist) == discog
+
+
+def test_cache(database, monkeypatch):
+    """
+    Test storing and retrieving values from the persistent cache.
+    """
+    assert database.get_cached('key') is None
+    database.save_cached('key', ["it's", 'a', 'list'], ttl=10)
+    assert database.get_cached('key') == ["it's", 'a', 'list']
+
+    database.save_cached('key', {'a': 'dict'}, ttl=10)
+    assert database.get_cached('key') == {'a': 'dict'}
+
+    # Expired values are not returned, and get purged on the next write
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 11)
+    assert database.get_cached('key') is None
+    database.save_cached('other', 'value', ttl=10)
+    count = database._execute('SELECT COUNT(*) AS count FROM cache')
+    assert count == {'count': 1}
+
+    database.delete_cached('other')
+    assert database.get_cached('other') is None
+
+
+def test_get_top_songs(database):
+    insert = 'insert into log (chat_id, artist, title) values (?, ?, ?)'
+    for chat_id in range(3):
+        database._execute(insert, (chat_id, 'motorhead', 'ace of spades'))
+    for chat_id in range(2):
+        database._execute(insert, (chat_id, 'motorhead', "we're motorhead"))
+    database._execute(insert, (1, 'motorhead', 'overkill'))
+
+    assert database.get_top_songs(2) == [
+        {'artist': 'motorhead', 'title': 'ace of spades'},
+        {'artist': 'motorhead', 'title': "we're motorhead"},
+    ]
+
+
+def test_lyrics(database):
+    """
+    Test saving and retrieving lyrics from the database.
+    """
+    artist, title = 'motorhead', "we're motorhead"
+    lyrics = "We are the road crew\nWe're motorhead"
+    assert database.get_lyrics(artist, title, ['genius']) is None
+
+    database.save_lyrics(artist, title, 'genius', lyrics)
+    assert database.get_lyrics(artist, title, ['azlyrics']) is None
+    assert database.get_lyrics(artist, title, []) is None
+    assert database.get_lyrics(artist, title, ['azlyrics', 'genius']) == {
+        'source': 'genius',
+        'lyrics': lyrics,
+    }
+
+
+def test_word_pairs():
+    assert db.words("Don't stop_me NOW!") == ['don', 't', 'stop', 'me', 'now']
+    assert db.word_pairs('Is this the real life?') == (
+        'is_this this_the the_real real_life'
+    )
+    assert db.word_pairs('mama') == ''
+
+
+def test_search_lyrics(database, monkeypatch):
+    """
+    Test finding songs by a snippet of their lyrics.
+    """
+    rhapsody = 'Is this the real life? Is this just fantasy?'
+    database.save_lyrics('queen', 'bohemian rhapsody', 'azlyrics', rhapsody)
+    database.save_lyrics('queen', 'bohemian rhapsody', 'genius', rhapsody)
+    database.save_lyrics(
+        'queen', "don't stop me now", 'genius', "I'm having a real good time"
+    )
+    rhapsody = {'artist': 'queen', 'title': 'bohemian rhapsody'}
+    dont_stop = {'artist': 'queen', 'title': "don't stop me now"}
+
+    # Songs saved from more than one source only appear once
+    assert database.search_lyrics('is this the REAL life', 10) == [rhapsody]
+    found = database.search_lyrics('real', 10)
+    assert sorted(found, key=str) == sorted([rhapsody, dont_stop], key=str)
+    assert len(database.search_lyrics('real', 1)) == 1
+    with monkeypatch.context() as mkp:
+        mkp.setattr(db, 'RANK_LIMIT', 1)
+        found = database.search_lyrics('real', 10)
+        assert sorted(found, key=str) == sorted([rhapsody, dont_stop], key=str)
+    assert database.search_lyrics('"fant\u00e0sy" *', 10) == [rhapsody]
+    assert database.search_lyrics('?!', 10) == []
+
+    # Replaced lyrics are removed from the index
+    database.save_lyrics('queen', "don't stop me now", 'genius', 'la la la')
+    assert database.search_lyrics('good time', 10) == []
+    assert database.search_lyrics('la', 10) == [dont_stop]
+
+
+def test_search_lyrics_existing(database):
+    """
+    Lyrics saved before the index existed should be indexed on startup.
+    """
+    database.save_lyrics('queen', 'bohemian rhapsody', 'genius', 'mama')
+    database._execute('DROP TABLE lyrics_fts')
+    database.config()
+    assert database.search_lyrics('mama', 10) == [
+        {'artist': 'queen', 'title': 'bohemian rhapsody'}
+    ]
+
+
+def test_lyrics_dedup(database):
+    """
+    Test that songs with the same lyrics share a single copy of them.
+    """
+    lyrics = 'Is this the real life?\nIs this just fantasy?'
+    database.save_lyrics('queen', 'bohemian rhapsody', 'genius', lyrics)
+    database.save_lyrics(
+        'queen', 'bohemian rhapsody', 'azlyrics', lyrics.replace('\n', ' \n')
+    )
+    database.save_lyrics('queen', 'bohemian rhapsody live', 'genius', lyrics)
+    texts = 'SELECT refs FROM lyrics_text'
+    assert database._execute(texts, fetchall=True) == [{'refs': 3}]
+    assert database.get_lyrics(
+        'queen', 'bohemian rhapsody live', ['genius']
+    ) == {'source': 'genius', 'lyrics': lyrics}
+
+    # Saving the same lyrics again doesn't add references
+    database.save_lyrics('queen', 'bohemian rhapsody', 'genius', lyrics)
+    assert database._execute(texts, fetchall=True) == [{'refs': 3}]
+
+    # Lyrics are deleted along with their last reference
+    for title in ('bohemian rhapsody', 'bohemian rhapsody live'):
+        database.save_lyrics('queen', title, 'genius', 'mama')
+    assert database._execute(texts, fetchall=True) == [
+        {'refs': 1},
+        {'refs': 2},
+    ]
+    database.save_lyrics('queen', 'bohemian rhapsody', 'azlyrics', 'mama')
+    assert database._execute(texts, fetchall=True) == [{'refs': 3}]
+    assert database.search_lyrics('real life', 10) == []
+
+
+def test_lyrics_dictionary(database, monkeypatch):
+    """
+    Test that a compression dictionary is trained once there are enough saved
+    lyrics, and that lyrics compressed with any dictionary can be read.
+    """
+    monkeypatch.setattr(db, 'DICT_SAMPLES', 3)
+    chorus = 'We are the road crew\nWe are the road crew'
+    database.save_lyrics('motorhead', 'a', 'genius', 'Verse one\n' + chorus)
+    database.save_lyrics('motorhead', 'b', 'genius', 'Verse two\n' + chorus)
+    assert database._dictionary is None
+    database.save_lyrics('motorhead', 'c', 'genius', 'Verse 3\n' + chorus)
+    assert b'We are the road crew' in database._dictionary[1]
+
+    database.save_lyrics('motorhead', 'd', 'genius', 'Verse 4\n' + chorus)
+    row = database._execute('SELECT dictionary FROM lyrics_text WHERE refs=1')
+    assert row['dictionary'] is None
+    database._dictionaries.clear()
+    for title, verse in zip('abcd', ('one', 'two', '3', '4')):
+        saved = database.get_lyrics('motorhead', title, ['genius'])
+        assert saved['lyrics'] == f'Verse {verse}\n{chorus}'
+
+
+def test_train_dictionary():
+    texts = ['oh yeah baby\nla la la', 'oh yeah baby\nna na', 'la la la']
+    dictionary = db.train_dictionary(texts)
+    assert dictionary.endswith(b'\nyeah baby\noh yeah baby\n')
+    assert b'la la la\n' in dictionary
+    assert b'na na' not in dictionary
+    assert db.train_dictionary(['unique words', 'other words']) == b''
+    assert db.train_dictionary(texts, size=15) == b'oh yeah baby\n'
+
+    text = 'oh yeah baby, something else\nla la la'
+    data = db.compress(text, dictionary)
+    assert len(data) < len(db.compress(text))
+    assert db.decompress(data, dictionary) == text
+
+
+def test_log_results(database):
+    chat_id = 'chat_id'
+    source = Nothing(__name__='genius')
+    songs = [
+        Song('sabaton', 'primo victoria', 'primo victoria'),
+        Song('sabaton', "cliffs of gallipoli"),
+        Song("guns n' roses", 'estranged', 'use your illusion ii'),
+    ]
+    database.log_result(chat_id, Nothing(song=songs[1], source=source))
+    results = [Nothing(song=song, source=source) for song in songs]
+    songs[1].album = 'the art of war'
+    database.log_results(chat_id, results)
+
+    rows = database._execute(
+        'SELECT artist, title, album FROM log ORDER BY date', fetchall=True
+    )
+    assert [row['title'] for row in rows] == [
+        'primo victoria',
+        'cliffs of gallipoli',
+        'estranged',
+    ]
+    assert rows[1]['album'] == 'the art of war'
+    assert database.get_last_res(chat_id) == {
+        'artist': "guns n' roses",
+        'title': 'estranged',
+        'album': 'use your illusion ii',
+        'source': 'genius',
+    }
+    database.log_results(chat_id, [])
+
+    # A single result logged in the same second is still the last one
+    database.log_result(chat_id, results[0])
+    assert database.get_last_res(chat_id)['title'] == 'primo victoria'
+    dates = database._execute('SELECT date FROM log', fetchall=True)
+    assert all(isinstance(row['date'], float) for row in dates)
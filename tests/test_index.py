@@ -0,0 +1,82 @@
+import sys
+
+sys.path.append('.')
+from index import trigrams
+from index import TrigramIndex
+from index import track_index
+from index import PrefixIndex
+
+
+def test_trigrams():
+    assert trigrams('Abc') == {'  a', ' ab', 'abc', 'bc '}
+    assert trigrams('a b') == {'  a', ' a ', 'a b', ' b '}
+
+
+def test_search():
+    index = TrigramIndex(
+        ['battery', 'master of puppets', 'the thing that should not be']
+    )
+    [(value, score)] = index.search('master of puppet')
+    assert value == 'master of puppets'
+    assert 0.6 < score < 1
+    assert index.search('master of puppets')[0] == ('master of puppets', 1)
+    assert index.search('orion') == []
+    assert index.best('the thing that shouldnt be') == (
+        'the thing that should not be'
+    )
+    assert index.best('batery') == 'battery'
+    assert index.best('disposable heroes') is None
+
+
+def test_search_top_k():
+    index = TrigramIndex(['one', 'one two', 'one two three'], threshold=0)
+    assert [v for v, _ in index.search('one two', k=2)] == [
+        'one two',
+        'one two three',
+    ]
+    scores = [s for _, s in index.search('one two', k=3)]
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_track_index():
+    tracks = ['battery', 'orion']
+    assert track_index(tracks) is track_index(tuple(tracks))
+    assert len(track_index(tracks)) == 2
+
+
+def test_prefix_index():
+    index = PrefixIndex(
+        [
+            ('Metallica - Battery', 'Metallica - Battery', 1),
+            ('Battery', 'Metallica - Battery', 1),
+            ('Metallica - Orion', 'Metallica - Orion', 5),
+            ('Orion', 'Metallica - Orion', 5),
+            ('Megadeth - Tornado of Souls', 'Megadeth - Tornado of Souls', 0),
+        ]
+    )
+    assert len(index) == 5
+    assert index.search('metallica  -') == [
+        'Metallica - Orion',
+        'Metallica - Battery',
+    ]
+    assert index.search('ME') == [
+        'Metallica - Orion',
+        'Metallica - Battery',
+        'Megadeth - Tornado of Souls',
+    ]
+    assert index.search('bat') == ['Metallica - Battery']
+    assert index.search('') == index.search('m')
+    assert index.search('', k=1) == ['Metallica - Orion']
+    assert index.search('slayer') == []
+
+
+def test_prefix_index_scan():
+    """
+    Prefixes that match more keys than the index scans should still return
+    the heaviest values.
+    """
+    entries = [(f'song {i}', f'song {i}', i % 7) for i in range(100)]
+    index = PrefixIndex(entries, scan=10)
+    assert index.search('song', k=3) == ['song 13', 'song 20', 'song 27']
+    assert index.search('song 1', k=2) == ['song 13', 'song 12']
+    assert index.search('song 9', k=2) == ['song 90', 'song 97']
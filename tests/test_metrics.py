@@ -0,0 +1,39 @@
+import sys
+from threading import Thread
+
+sys.path.append('.')
+from metrics import Metrics
+
+
+def test_metrics():
+    metrics = Metrics()
+    assert metrics.get('missing') == 0
+    metrics.incr('requests')
+    metrics.incr('requests', 2)
+    metrics.observe('wait', 0.5)
+    metrics.observe('wait', 1.5)
+    metrics.set('state', 2)
+    metrics.set('state', 1)
+    assert metrics.snapshot() == {
+        'requests': 3,
+        'state': 1,
+        'wait.count': 2,
+        'wait.total': 2.0,
+    }
+    metrics.reset()
+    assert metrics.snapshot() == {}
+
+
+def test_metrics_threads():
+    metrics = Metrics()
+
+    def work():
+        for _ in range(1000):
+            metrics.incr('count')
+
+    threads = [Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert metrics.get('count') == 4000
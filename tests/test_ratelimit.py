@@ -0,0 +1,97 @@
+import sys
+
+import pytest
+
+sys.path.append('.')
+from ratelimit import TokenBucket
+from ratelimit import RetryBudget
+from ratelimit import backoff
+
+
+class Clock:
+    """
+    Fake monotonic clock that only moves when told to.
+    """
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def test_bucket_burst(clock):
+    """
+    Tokens up to the bucket's capacity should be available immediately.
+    """
+    bucket = TokenBucket(rate=2, capacity=3, clock=clock)
+    assert [bucket.reserve() for _ in range(3)] == [0, 0, 0]
+    assert bucket.reserve() == pytest.approx(0.5)
+    assert bucket.reserve() == pytest.approx(1)
+
+
+def test_bucket_refill(clock):
+    bucket = TokenBucket(rate=2, capacity=2, clock=clock)
+    bucket.reserve(2)
+    clock.sleep(0.5)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.5)
+
+    # The bucket never holds more than its capacity
+    clock.sleep(100)
+    assert bucket.full()
+    assert bucket.reserve(2) == 0
+    assert bucket.reserve() == pytest.approx(0.5)
+
+
+def test_bucket_acquire(clock):
+    bucket = TokenBucket(rate=10, capacity=1, clock=clock)
+    start = clock()
+    for _ in range(11):
+        bucket.acquire(sleep=clock.sleep)
+    assert clock() - start == pytest.approx(1)
+
+
+def test_bucket_pause(clock):
+    """
+    No tokens should be handed out while the bucket is paused.
+    """
+    bucket = TokenBucket(rate=1, capacity=5, clock=clock)
+    bucket.pause(3)
+    assert bucket.reserve() == pytest.approx(3)
+    bucket.pause(1)
+    assert bucket.reserve() == pytest.approx(3)
+    clock.sleep(3)
+    assert bucket.reserve() == 0
+
+
+def test_retry_budget():
+    budget = RetryBudget(ratio=0.5, capacity=2)
+    assert budget.withdraw()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+
+    # Two requests earn a retry
+    budget.deposit()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert budget.withdraw()
+
+    for _ in range(10):
+        budget.deposit()
+    assert budget.tokens == 2
+
+
+def test_backoff():
+    assert backoff(1, base=1, random=lambda: 1) == 2
+    assert backoff(3, base=1, random=lambda: 0.5) == 4
+    assert backoff(10, base=1, cap=30, random=lambda: 1) == 30
+    assert 0 <= backoff(2) <= 2
@@ -0,0 +1,117 @@
+import sys
+import time
+import threading
+
+sys.path.append('.')
+from scheduler import ChatScheduler
+
+
+def test_submit_runs():
+    """
+    Check that submitted work gets run with the right arguments.
+    """
+    done = threading.Event()
+    result = []
+
+    def work(*args, **kwargs):
+        result.append((args, kwargs))
+        done.set()
+
+    scheduler = ChatScheduler(workers=2)
+    assert scheduler.submit('chat', work, 1, 2, key='value')
+    assert done.wait(5)
+    scheduler.stop()
+    assert result == [((1, 2), {'key': 'value'})]
+
+
+def test_per_chat_order():
+    """
+    Work items from the same chat must run one at a time and in order, even
+    if there are more worker threads available.
+    """
+    log = []
+    running = []
+
+    def work(i):
+        running.append(i)
+        assert len(running) == 1
+        time.sleep(0.01)
+        log.append(i)
+        running.remove(i)
+
+    scheduler = ChatScheduler(workers=4, max_pending=10)
+    for i in range(5):
+        assert scheduler.submit('chat', work, i)
+    scheduler.stop()
+    assert log == list(range(5))
+
+
+def test_max_inflight():
+    """
+    Check that more than one item per chat can run at the same time if the
+    scheduler is configured to allow it.
+    """
+    barrier = threading.Barrier(2, timeout=5)
+    scheduler = ChatScheduler(workers=2, max_inflight=2)
+    scheduler.submit('chat', barrier.wait)
+    scheduler.submit('chat', barrier.wait)
+    scheduler.stop()
+    assert not barrier.broken
+
+
+def test_fair_queuing():
+    """
+    A chat with a long queue must not delay the work of other chats until it
+    has been processed completely.
+    """
+    log = []
+    release = threading.Event()
+    scheduler = ChatScheduler(workers=1, max_pending=10)
+
+    scheduler.submit('blocker', release.wait)
+    while scheduler.pending():
+        time.sleep(0.01)
+    for i in range(5):
+        scheduler.submit('busy', log.append, f'busy {i}')
+    scheduler.submit('quiet', log.append, 'quiet')
+    release.set()
+    scheduler.stop()
+    assert log.index('quiet') == 1
+
+
+def test_load_shedding():
+    """
+    Work should be rejected when the per chat or global queues are full.
+    """
+    release = threading.Event()
+    scheduler = ChatScheduler(workers=1, max_pending=2, max_total=3)
+    assert scheduler.submit('chat', release.wait)
+    while scheduler.pending():
+        time.sleep(0.01)
+
+    assert scheduler.submit('chat', str)
+    assert scheduler.submit('chat', str)
+    assert not scheduler.submit('chat', str)
+    assert scheduler.pending('chat') == 2
+
+    assert scheduler.submit('other', str)
+    assert not scheduler.submit('another', str)
+    assert scheduler.pending() == 3
+    assert scheduler.pending('another') == 0
+
+    release.set()
+    scheduler.stop()
+    assert scheduler.pending() == 0
+
+
+def test_error_handling(caplog):
+    """
+    An exception in a work item should be logged and not affect the rest.
+    """
+    log = []
+    scheduler = ChatScheduler(workers=1)
+    scheduler.submit('chat', lambda: 1 / 0)
+    scheduler.submit('chat', log.append, 'ok')
+    scheduler.stop()
+    assert log == ['ok']
+    assert 'ZeroDivisionError' in caplog.text
@@ -0,0 +1,115 @@
+import sys
+
+import pytest
+import telegram
+
+sys.path.append('.')
+from sender import Sender
+from conftest import Nothing
+
+
+class FloodBot:
+    """
+    Fake bot that raises flood control errors a number of times before
+    accepting any message.
+    """
+
+    def __init__(self, floods=0):
+        self.floods = floods
+        self.msg_log = []
+
+    def send_message(self, chat_id, text, parse_mode=None):
+        if self.floods:
+            self.floods -= 1
+            raise telegram.error.RetryAfter(0.01)
+        self.msg_log.append((chat_id, text, parse_mode))
+        return len(self.msg_log)
+
+    def edit_message_text(self, chat_id, message_id, text, parse_mode=None):
+        if self.floods:
+            self.floods -= 1
+            raise telegram.error.RetryAfter(0.01)
+        self.msg_log[message_id - 1] = (chat_id, text, parse_mode)
+        return message_id
+
+
+def test_send_chunks():
+    bot = FloodBot()
+    sender = Sender()
+    sent = sender.send(bot, 1, ['hello', 'world'], parse_mode='Markdown')
+    assert sent == [1, 2]
+    assert bot.msg_log == [(1, 'hello', 'Markdown'), (1, 'world', 'Markdown')]
+
+
+def test_send_retry_after():
+    """
+    Messages should be sent again after flood control errors.
+    """
+    bot = FloodBot(floods=2)
+    sender = Sender(retries=2)
+    sender.send(bot, 1, ['hello'])
+    assert bot.msg_log == [(1, 'hello', None)]
+
+
+def test_send_retry_after_give_up():
+    bot = FloodBot(floods=3)
+    sender = Sender(retries=2)
+    with pytest.raises(telegram.error.RetryAfter):
+        sender.send(bot, 1, ['hello'])
+    assert bot.msg_log == []
+
+
+def test_edit():
+    """
+    Edits should be retried after flood control errors too.
+    """
+    bot = FloodBot()
+    sender = Sender(retries=2)
+    sender.send(bot, 1, ['hello', 'world'])
+    bot.floods = 1
+    message = Nothing(chat_id=1, message_id=1)
+    assert sender.edit(bot, message, 'goodbye', parse_mode='Markdown') == 1
+    assert bot.msg_log == [(1, 'goodbye', 'Markdown'), (1, 'world', None)]
+
+
+def test_send_chat_rate(monkeypatch):
+    """
+    Check that messages to a single chat are throttled once the chat's burst
+    allowance has been used.
+    """
+    waits = []
+    monkeypatch.setattr('ratelimit.time.sleep', waits.append)
+    bot = FloodBot()
+    sender = Sender(chat_rate=1, chat_burst=2)
+    sender.send(bot, 1, ['a', 'b', 'c'])
+    sender.send(bot, 2, ['d'])
+    assert len(bot.msg_log) == 4
+    assert len(waits) == 1
+    assert waits[0] == pytest.approx(1, abs=0.1)
+
+
+def test_prune_chats():
+    """
+    Idle chats should be forgotten when there are too many of them.
+    """
+    now = [0]
+    bot = FloodBot()
+    sender = Sender(max_chats=2, clock=lambda: now[0])
+    sender.send(bot, 1, ['hello'])
+    sender.send(bot, 2, ['hello'])
+    sender.send(bot, 3, ['hello'])
+    assert len(sender._chats) == 3
+
+    now[0] += 10
+    sender.send(bot, 4, ['hello'])
+    assert list(sender._chats) == [4]
+
+
+def test_share():
+    """
+    Every process should get an even share of the global rate limit.
+    """
+    sender = Sender(rate=30)
+    sender.share(4)
+    assert sender.bucket.rate == 7.5
+    assert sender.rate == 30
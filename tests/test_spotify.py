@@ -1,14 +1,27 @@
 import sys
+import json
+import time
 import pickle
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
 from datetime import date
 
+import pytest
 import requests
 import spotipy
 from lyricfetch import Song
 
 sys.path.append('.')
 import spotify
+from spotify import Spotify
+from spotify import Album
+from spotify import compact_discography
 from spotify import _set_release_date
+from spotify import retry_after
+from metrics import Metrics
+from breaker import CircuitBreaker
+from breaker import CircuitOpen
 
 
 def test_set_release_date():
@@ -75,6 +88,110 @@ def test_spotify_load_cache(sp_client, tmp_path, monkeypatch):
     assert sp_client.discography_cache == cache
 
 
+def test_spotify_load_cache_once(monkeypatch):
+    """
+    The cache file should only be read once, even if several threads need the
+    discography cache at the same time.
+    """
+    client = Spotify()
+    reads = []
+
+    def read_cache():
+        reads.append(1)
+        time.sleep(0.1)
+        return {'sabaton': {}}
+
+    monkeypatch.setattr(client, 'read_cache', read_cache)
+    caches = []
+    threads = [
+        threading.Thread(
+            target=lambda: caches.append(client.discography_cache)
+        )
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(reads) == 1
+    assert caches == [{'sabaton': {}}] * 4
+
+
+def test_album():
+    album = Album('id', date(2019, 1, 1), ['intro', 'outro'])
+    assert album.tracks == ('intro', 'outro')
+    assert album['tracks'] is album.tracks
+    assert album['release_date'] == date(2019, 1, 1)
+    assert not hasattr(album, '__dict__')
+    with pytest.raises(KeyError):
+        album['name']
+
+    other = Album('id2', date(2019, 1, 1), ['intro'])
+    assert pickle.loads(pickle.dumps(album)) == album
+    assert album != other
+
+
+def test_compact_discography():
+    """
+    Test converting a discography in the old dictionary format.
+    """
+    old = {
+        'reign in blood': {
+            'id': 'id',
+            'release_date': date(1986, 10, 7),
+            'tracks': ['angel of death', 'raining blood'],
+        }
+    }
+    new = compact_discography(old)
+    assert new == {
+        'reign in blood': Album(
+            'id', date(1986, 10, 7), ('angel of death', 'raining blood')
+        )
+    }
+    assert compact_discography(new) == new
+
+
+def test_compact_discography_dedup():
+    """
+    Test that track names repeated across albums are only stored once.
+    """
+    old = {
+        'reign in blood': {
+            'id': 'id',
+            'release_date': date(1986, 10, 7),
+            'tracks': [''.join(['raining ', 'blood'])],
+        },
+        'decade of aggression': {
+            'id': 'id2',
+            'release_date': date(1991, 10, 22),
+            'tracks': [''.join(['raining', ' blood'])],
+        },
+    }
+    assert (
+        old['reign in blood']['tracks'][0]
+        is not old['decade of aggression']['tracks'][0]
+    )
+    new = compact_discography(old)
+    first, second = new.values()
+    assert first.tracks == second.tracks
+    assert first.tracks[0] is second.tracks[0]
+    assert compact_discography('not a discography') == 'not a discography'
+
+
+def test_spotify_load_cache_compact(sp_client, tmp_path, monkeypatch):
+    """
+    Discographies from old cache files should be converted when loaded.
+    """
+    monkeypatch.setattr(spotify, 'CACHE_DIR', tmp_path)
+    album = {'id': 'id', 'release_date': date(2019, 1, 1), 'tracks': ['a']}
+    with open(tmp_path / '.cache-spotify', 'wb') as f:
+        pickle.dump({'artist': {'album': album}}, f)
+
+    sp_client.discography_cache = {}
+    sp_client.load_cache()
+    assert sp_client.discography_cache == {'artist': {'album': Album(**album)}}
+
+
 def test_spotify_get_discography(sp_client):
     """
     Get an artist's discography and assert that everything is in the right
@@ -84,7 +201,7 @@ def test_spotify_get_discography(sp_client):
     albums = list(discog.values())
     assert discog
     assert len(discog) >= 2
-    for key, klass in [('id', str), ('release_date', date), ('tracks', list)]:
+    for key, klass in [('id', str), ('release_date', date), ('tracks', tuple)]:
         assert all(isinstance(e[key], klass) for e in albums)
 
     dates = [e['release_date'] for e in albums]
@@ -128,6 +245,79 @@ def test_spotify_fetch_discography(sp_client, monkeypatch):
     assert log == [(song.artist, song.title)]
 
 
+class FakeSpotipy:
+    """
+    Fake spotipy client for a single artist with a single album, which counts
+    the calls made to it.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def search(self, query, type):
+        self.calls.append('search')
+        return {'tracks': {'items': [{'artists': [{'id': 'metallica'}]}]}}
+
+    def artist_albums(self, artist_id, album_type):
+        self.calls.append('artist_albums')
+        album = {
+            'id': 'master',
+            'name': 'Master of Puppets',
+            'release_date': '1986',
+            'release_date_precision': 'year',
+            'artists': [{'id': 'metallica', 'name': 'Metallica'}],
+        }
+        return {'items': [album], 'next': None}
+
+    def albums(self, ids):
+        self.calls.append('albums')
+        tracks = [{'name': 'Battery'}, {'name': 'Master of Puppets'}]
+        return {'albums': [{'tracks': {'items': tracks, 'next': None}}]}
+
+
+def test_spotify_fetch_discography_spellings(monkeypatch):
+    """
+    Every artist's discography should be fetched only once, regardless of how
+    their name is spelled.
+    """
+    client = Spotify()
+    client.discography_cache = {}
+    client.sp = FakeSpotipy()
+    monkeypatch.setattr(client.limiter, 'acquire', lambda: 0)
+    for artist in ['Metallica', 'metallica', 'METALLICA ']:
+        client.fetch_discography(Song(artist, 'battery'))
+    assert client.sp.calls == ['search', 'artist_albums', 'albums']
+    assert list(client.discography_cache) == ['metallica']
+
+    # A different name for the same artist only needs to find the id
+    client.fetch_discography(Song('Metalica', 'battery'))
+    assert client.sp.calls == ['search', 'artist_albums', 'albums', 'search']
+    discog = client.discography_cache['metalica']
+    assert discog is client.discography_cache['metallica']
+    assert discog.artist == 'Metallica'
+    assert client.get_album_tracks(Song('METALLICA', 'battery')) == (
+        'battery',
+        'master of puppets',
+    )
+
+
+def test_spotify_artist_id_shared(database, monkeypatch):
+    """
+    Artist ids should be saved to the shared store.
+    """
+    first = Spotify()
+    first.sp = FakeSpotipy()
+    first.store = database
+    monkeypatch.setattr(first.limiter, 'acquire', lambda: 0)
+    assert first.get_artist_id('Metallica', '') == 'metallica'
+
+    second = Spotify()
+    second.sp = FakeSpotipy()
+    second.store = database
+    assert second.get_artist_id('metallica', '') == 'metallica'
+    assert second.sp.calls == []
+
+
 def test_spotify_fetch_album_nodiscog(sp_client, monkeypatch):
     """
     Test that the fetch album method returns unknown when we can't find the
@@ -165,6 +355,24 @@ def test_spotify_fetch_album_found(sp_client, monkeypatch):
     assert sp_client.fetch_album(song) == song.album
 
 
+def test_spotify_fetch_album_fuzzy(sp_client, monkeypatch):
+    """
+    Test that the fetch album method returns the album with the most similar
+    track when the title is not found exactly.
+    """
+    song = Song('children of bodom', 'toward dead end')
+    sp_client.discography_cache = {
+        song.artist: {
+            'hatebreeder': {'tracks': ['towards dead end', 'warheart']},
+            'follow the reaper': {'tracks': ['hate me', 'every time i die']},
+        }
+    }
+    monkeypatch.setattr(sp_client, 'fetch_discography', lambda x: True)
+    assert sp_client.fetch_album(song) == 'hatebreeder'
+    song.title = 'bed of razors'
+    assert sp_client.fetch_album(song) == 'Unknown'
+
+
 def test_spotify_get_album_tracks_noalbum(sp_client, monkeypatch):
     """
     Test getting the list of album tracks when the given song already has an
@@ -221,6 +429,179 @@ def test_spotify_get_auth_url(sp_client):
     requests.get(url).raise_for_status()
 
 
+def test_retry_after():
+    assert retry_after({'Retry-After': '3'}) == 3
+    assert retry_after({}) == 1
+    assert retry_after({'Retry-After': 'tomorrow'}) == 1
+
+
+def test_spotify_share():
+    client = Spotify()
+    client.share(4)
+    assert client.limiter.rate == spotify.RATE / 4
+    assert client.limiter.capacity == spotify.RATE / 2
+
+
+def test_spotify_call_retries(monkeypatch):
+    """
+    Throttled requests should be retried, pausing the rate limiter, until
+    they succeed or run out of retries.
+    """
+    monkeypatch.setattr(spotify.time, 'sleep', lambda x: None)
+    monkeypatch.setattr(spotify, 'METRICS', Metrics())
+    client = Spotify()
+    # Keep the breaker closed, every attempt counts towards it
+    client.breaker = CircuitBreaker('spotify', min_calls=100)
+    pauses = []
+    monkeypatch.setattr(client.limiter, 'acquire', lambda: 0)
+    monkeypatch.setattr(client.limiter, 'pause', pauses.append)
+    responses = [
+        spotipy.SpotifyException(429, -1, 'slow down', headers={}),
+        spotipy.SpotifyException(
+            429, -1, 'slow down', headers={'Retry-After': '5'}
+        ),
+        spotipy.SpotifyException(503, -1, 'unavailable'),
+        'result',
+    ]
+
+    def request():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    assert client.call(request) == 'result'
+    assert pauses == [1, 5]
+    assert spotify.METRICS.get('spotify.retries') == 3
+    assert spotify.METRICS.get('spotify.requests') == 4
+
+    # Client errors are not retried
+    responses = [spotipy.SpotifyException(404, -1, 'not found')]
+    with pytest.raises(spotipy.SpotifyException):
+        client.call(request)
+
+    # Nor are throttled requests once the retry budget is exhausted
+    client.retry_budget.tokens = 0
+    responses = [spotipy.SpotifyException(429, -1, 'slow down')] * 2
+    with pytest.raises(spotipy.SpotifyException):
+        client.call(request)
+    assert spotify.METRICS.get('spotify.failed') == 1
+    assert len(responses) == 1
+
+
+def test_spotify_call_retry_after(monkeypatch):
+    """
+    The 'Retry-After' header of a real throttled response should reach the
+    rate limiter, instead of spotipy retrying the request by itself.
+    """
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.path)
+            if len(requests) == 1:
+                self.send_response(429)
+                self.send_header('Retry-After', '7')
+                body = b'{}'
+            else:
+                self.send_response(200)
+                body = json.dumps({'name': 'roadside'}).encode()
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        monkeypatch.setattr(spotify.time, 'sleep', lambda x: None)
+        monkeypatch.setattr(spotify, 'METRICS', Metrics())
+        client = Spotify()
+        pauses = []
+        monkeypatch.setattr(client.limiter, 'acquire', lambda: 0)
+        monkeypatch.setattr(client.limiter, 'pause', pauses.append)
+        sp = spotify.make_client(auth='token')
+        sp.prefix = f'http://127.0.0.1:{server.server_port}/'
+        assert client.call(sp.track, 'abc') == {'name': 'roadside'}
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert requests == ['/tracks/abc', '/tracks/abc']
+    assert pauses == [7]
+
+
+def test_spotify_call_breaker(monkeypatch):
+    """
+    Requests should not be made while the API keeps failing, but client
+    errors should not count as failures.
+    """
+    monkeypatch.setattr(spotify.time, 'sleep', lambda x: None)
+    client = Spotify()
+    client.retry_budget.tokens = 0
+    client.breaker = CircuitBreaker(
+        'spotify', min_calls=2, is_failure=spotify.is_outage, metrics=Metrics()
+    )
+    monkeypatch.setattr(client.limiter, 'acquire', lambda: 0)
+    calls = []
+
+    def request(status):
+        calls.append(status)
+        raise spotipy.SpotifyException(status, -1, 'error')
+
+    for status in (404, 404, 500):
+        with pytest.raises(spotipy.SpotifyException):
+            client.call(request, status)
+    assert client.breaker.state == 'closed'
+    with pytest.raises(spotipy.SpotifyException):
+        client.call(request, 503)
+    with pytest.raises(CircuitOpen):
+        client.call(request, 404)
+    assert calls == [404, 404, 500, 503]
+
+
+def test_spotify_call_breaker_waits(monkeypatch):
+    """
+    Waiting for the rate limiter or between retries should not make requests
+    count as slow.
+    """
+    now = [0]
+
+    def acquire():
+        now[0] += 11
+        return 11
+
+    def sleep(seconds):
+        now[0] += seconds
+
+    monkeypatch.setattr(spotify.time, 'sleep', sleep)
+    monkeypatch.setattr(spotify, 'backoff', lambda attempt: 20)
+    client = Spotify()
+    client.breaker = CircuitBreaker(
+        'spotify',
+        min_calls=100,
+        is_failure=spotify.is_outage,
+        clock=lambda: now[0],
+        metrics=Metrics(),
+    )
+    monkeypatch.setattr(client.limiter, 'acquire', acquire)
+    responses = [spotipy.SpotifyException(503, -1, 'unavailable'), 'result']
+
+    def request():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    assert client.call(request) == 'result'
+    assert now[0] == 42
+    # Every attempt is recorded, and only the server error is a failure
+    assert [failed for _, failed in client.breaker._calls] == [True, False]
+
+
 def test_spotify_currently_playing(monkeypatch, sp_client):
     response = {
         'timestamp': 1559294488309,
@@ -260,6 +641,37 @@ def test_spotify_currently_playing(monkeypatch, sp_client):
         def currently_playing(self):
             return response
 
-    monkeypatch.setattr(spotify.spotipy, 'Spotify', Client)
+    monkeypatch.setattr(spotipy, 'Spotify', Client)
     expect = Song('Rise Against', 'Roadside', 'The Sufferer & The Witness')
-    assert sp_client.currently_playing(token='some token') == expect
+    current = sp_client.currently_playing(token='some token')
+    assert current == expect
+    assert current.track_id == '2YJvYVpOF8Z9Yf8QHpOMsz'
+    assert current.remaining == (201026 - 16268) / 1000
+
+
+def test_spotify_fetch_discography_shared(database, monkeypatch):
+    """
+    Check that discographies are read from and written to the shared store,
+    so that other processes don't have to fetch them again.
+    """
+    log = []
+
+    def fake_get_discography(artist, title):
+        log.append(artist)
+        return {'dawn of victory': Album('id', date(2000, 1, 1), [title])}
+
+    song = Song('rhapsody', 'the village of dwarves')
+    first = Spotify()
+    first.discography_cache.clear()
+    first.sp = first.store = database
+    monkeypatch.setattr(first, 'get_discography', fake_get_discography)
+    first.fetch_discography(song)
+    assert log == [song.artist]
+
+    second = Spotify()
+    second.discography_cache.clear()
+    second.sp = second.store = database
+    monkeypatch.setattr(second, 'get_discography', fake_get_discography)
+    second.fetch_discography(song)
+    assert log == [song.artist]
+    assert second.discography_cache == first.discography_cache
@@ -0,0 +1,64 @@
+import os
+import re
+import sys
+import subprocess
+
+import pytest
+
+# Modules that are only needed to actually run the bot, and should not be
+# imported just by importing the bot module
+DEFERRED = ['flask', 'spotipy', 'telegram.ext', 'tornado', 'server']
+
+
+def importtime(module):
+    """
+    Import a module in a new interpreter and return a dictionary with the
+    cumulative import time in microseconds of every module it imported.
+    """
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    times = {}
+    regex = re.compile(r'import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)')
+    for line in proc.stderr.splitlines():
+        match = regex.match(line)
+        if match:
+            times[match.group(3)] = int(match.group(1))
+    return times
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 7), reason='-X importtime needs python 3.7'
+)
+def test_import_time():
+    """
+    Check that the heavy dependencies are not imported with the bot module
+    and print a report of the slowest imports.
+    """
+    times = importtime('bot')
+    print(f'\nimport bot: {times["bot"] / 1000:.1f}ms')
+    slowest = sorted(times.items(), key=lambda x: -x[1])[1:11]
+    for module, elapsed in slowest:
+        print(f'  {module:40} {elapsed / 1000:8.1f}ms')
+
+    imported = [mod for mod in DEFERRED if mod in times]
+    assert not imported
+
+
+def test_lazy_singletons(tmp_path):
+    """
+    Importing the bot should not read the spotify cache or create the log
+    file.
+    """
+    code = (
+        f'import sys; sys.path.insert(0, {repr(os.path.abspath("."))}); '
+        'import bot, logger; '
+        'assert bot.SP._discography_cache is None; '
+        'assert logger.file_handler.stream is None'
+    )
+    subprocess.run([sys.executable, '-c', code], cwd=tmp_path, check=True)
+    assert not (tmp_path / 'lyrics-bot.log').exists()
@@ -0,0 +1,32 @@
+import sys
+
+sys.path.append('.')
+from supersede import Supersession
+from supersede import Token
+
+
+def test_supersession():
+    searches = Supersession()
+    first = Token()
+    assert not searches.start('chat', first)
+    assert not first.cancelled
+
+    # Other keys are independent
+    other = Token()
+    assert not searches.start('other chat', other)
+
+    second = Token()
+    assert searches.start('chat', second)
+    assert first.cancelled
+    assert not second.cancelled
+    assert not other.cancelled
+
+    # Finished work is not cancelled, or counted as superseded
+    searches.finish('chat', second)
+    assert len(searches) == 1
+    assert not searches.start('chat', Token())
+    assert not second.cancelled
+
+    # Finishing a superseded token doesn't forget the latest one
+    searches.finish('chat', first)
+    assert len(searches) == 2
@@ -1,8 +1,12 @@
 import sys
 import time
+from queue import Queue
+
+import pytest
 
 sys.path.append('.')
 import bot
+from server import Server
 
 
 SAMPLE_TOKEN = dict(
@@ -12,6 +16,16 @@ SAMPLE_TOKEN = dict(
 )
 
 
+@pytest.fixture(autouse=True)
+def tokens(monkeypatch):
+    """
+    Don't share cached tokens between tests.
+    """
+    tokens = bot.LRUCache()
+    monkeypatch.setattr(bot, 'TOKENS', tokens)
+    return tokens
+
+
 def test_get_sp_token_db(database):
     """
     Test getting a saved token from the database.
@@ -113,3 +127,51 @@ def test_get_sp_token_expired(monkeypatch, database):
     }
     assert database.get_sp_token(chat_id) == expect
     assert got == refreshed['access_token']
+
+
+def test_get_sp_token_cached(monkeypatch, database):
+    """
+    Only the first lookup for a chat should go to the database, and refreshed
+    tokens should be written through to it.
+    """
+    chat_id = '1'
+    monkeypatch.setattr(bot, 'DB', database)
+    database.save_sp_token(chat_id=chat_id, **SAMPLE_TOKEN)
+    reads = []
+    get_sp_token = database.get_sp_token
+    monkeypatch.setattr(
+        database,
+        'get_sp_token',
+        lambda x: reads.append(x) or get_sp_token(x),
+    )
+    refreshed = {
+        'access_token': 'new token',
+        'refresh_token': 'new refresh',
+        'expires_at': int(time.time()) + 1000,
+    }
+    monkeypatch.setattr(bot.SP, 'refresh_access_token', lambda x: refreshed)
+
+    assert bot.get_sp_token(chat_id) == 'new token'
+    assert bot.get_sp_token(chat_id) == 'new token'
+    assert reads == [chat_id]
+    assert get_sp_token(chat_id)['token'] == 'new token'
+
+
+def test_invalidate_sp_token(monkeypatch, database):
+    """
+    Tokens received by the auth server should replace the cached ones, even
+    though the chat id comes back from spotify as a string.
+    """
+    chat_id = 1
+    monkeypatch.setattr(bot, 'DB', database)
+    token = dict(SAMPLE_TOKEN, expires=None)
+    bot.save_sp_token(chat_id, **token)
+    assert bot.get_sp_token(chat_id) == token['token']
+
+    events = Queue()
+    server = Server(dict(filename=database._filename), on_auth=events.put)
+    client = server.app.test_client()
+    client.get('/auth', query_string={'code': 'code', 'state': str(chat_id)})
+    events.put(None)
+    bot.watch_auth(events)
+    assert bot.get_sp_token(chat_id) == 'code'
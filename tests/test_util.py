@@ -1,10 +1,19 @@
+import re
 import sys
 
 import pytest
+from hypothesis import given
+from hypothesis import settings
+from hypothesis import strategies as st
 
 sys.path.append('.')
 from util import capwords
 from util import process
+from util import markdown_entities
+from util import split_message
+from util import song_key
+from util import Reply
+from lyricfetch import Song
 
 
 @pytest.mark.parametrize(
@@ -86,3 +95,94 @@ def test_capwords(words, expect):
 )
 def test_process(name, expect):
     assert process(name, key='name') == expect
+
+
+@pytest.mark.parametrize(
+    'msg, expect',
+    [
+        ('plain text', []),
+        ('*bold* text', [(0, 6, '*')]),
+        ('some _italic_ and `code`', [(5, 13, '_'), (18, 24, '`')]),
+        ('```pre * _```', [(0, 13, '```')]),
+        ('a [link](http://a.b) here', [(2, 20, '')]),
+        ('stray * and _ markers', []),
+        (r'escaped \*not bold*', []),
+    ],
+)
+def test_markdown_entities(msg, expect):
+    assert markdown_entities(msg) == expect
+
+
+@pytest.mark.parametrize(
+    'msg, size, expect',
+    [
+        ('', 10, ()),
+        ('short', 10, ('short',)),
+        ('helloworld', 5, ('hello', 'world')),
+        ('one two three', 9, ('one two', 'three')),
+        ('first\nsecond\n\nthird', 14, ('first\nsecond', 'third')),
+        ('ab *bold text* cd', 12, ('ab', '*bold text*', 'cd')),
+        ('*' + 'x' * 12 + '*', 8, ('*xxxxxx*', '*xxxxxx*')),
+    ],
+)
+def test_split_message(msg, size, expect):
+    assert split_message(msg, size) == expect
+
+
+paragraph = st.lists(
+    st.text(alphabet='abc \n*_', min_size=1, max_size=200), max_size=5
+).map(' '.join)
+message = st.lists(paragraph, min_size=1, max_size=300).map('\n\n'.join)
+
+
+def squash(value):
+    return re.sub(r'\s+', '', value)
+
+
+@settings(max_examples=50, deadline=None)
+@given(message, st.integers(min_value=7, max_value=5000))
+def test_split_message_properties(msg, size):
+    """
+    No chunk can be longer than the limit, no text can be lost and, unless
+    they don't fit in a chunk, Markdown entities can't be split.
+    """
+    chunks = split_message(msg, size)
+    assert all(0 < len(chunk) <= size for chunk in chunks)
+
+    entities = markdown_entities(msg)
+    if all(end - start <= size for start, end, _ in entities):
+        assert squash(''.join(chunks)) == squash(msg)
+        entities = [msg[start:end] for start, end, _ in entities]
+        chunk_entities = [
+            chunk[start:end]
+            for chunk in chunks
+            for start, end, _ in markdown_entities(chunk)
+        ]
+        assert chunk_entities == entities
+
+
+def test_split_message_large():
+    """
+    Split a huge message with very few break points.
+    """
+    msg = ('word ' * 1000 + '\n') * 500
+    chunks = split_message(msg, 4096)
+    assert all(len(chunk) <= 4096 for chunk in chunks)
+    assert squash(''.join(chunks)) == squash(msg)
+
+
+def test_song_key():
+    """
+    Different spellings of the same song should have the same key.
+    """
+    key = song_key(Song('Metallica', 'Fade to Black'))
+    assert key == ('metallica', 'fade to black')
+    assert song_key(Song('METALLICA ', 'fade to black - Remastered')) == key
+    assert song_key(Song('Metallica', 'Fade to Black (Live)')) != key
+
+
+def test_reply():
+    reply = Reply.render('hello\n\nworld', 8)
+    assert reply == 'hello\n\nworld'
+    assert isinstance(reply, str)
+    assert reply.chunks == ('hello', 'world')
@@ -0,0 +1,66 @@
+import sys
+
+import pytest
+from lyricfetch import Song
+
+sys.path.append('.')
+import warmup
+from warmup import parse_args
+from warmup import parse_songs
+
+
+def test_parse_args():
+    args = parse_args(['--top', '10', '-j', '2'])
+    assert args.top == 10
+    assert args.jobs == 2
+    assert not args.no_lyrics
+
+    with pytest.raises(SystemExit):
+        parse_args([])
+
+
+def test_parse_songs():
+    lines = [
+        'Metallica - One\n',
+        '\n',
+        'metallica - one',
+        'Megadeth',
+        'Slayer - Angel of Death',
+    ]
+    assert parse_songs(lines) == [
+        Song('Metallica', 'One'),
+        Song('Megadeth'),
+        Song('Slayer', 'Angel of Death'),
+    ]
+
+
+def test_warmup(monkeypatch, caplog):
+    """
+    Check that all the songs are warmed up, and that the discography is
+    fetched even for songs without a title.
+    """
+    discographies = []
+    searched = []
+
+    def fetch_reply(song, sources):
+        searched.append(song.title)
+        return (song if song.title != 'missing' else None), 'reply'
+
+    monkeypatch.setattr(warmup.bot.SP, 'sp', True)
+    monkeypatch.setattr(
+        warmup.bot.SP, 'fetch_discography', discographies.append
+    )
+    monkeypatch.setattr(warmup.bot, 'fetch_reply', fetch_reply)
+
+    songs = [Song('a', 'b'), Song('c', 'missing'), Song('e')]
+    caplog.set_level('INFO')
+    assert warmup.warmup(songs, jobs=2, rate=100) == 1
+    assert discographies == songs
+    assert sorted(searched) == ['b', 'missing']
+    assert 'Warmed up 3/3 songs (1 found)' in caplog.text
+
+    discographies.clear()
+    searched.clear()
+    assert warmup.warmup(songs, jobs=2, rate=100, lyrics=False) == 0
+    assert discographies == songs
+    assert searched == []
@@ -0,0 +1,80 @@
+import sys
+from multiprocessing import Queue
+
+import pytest
+
+sys.path.append('.')
+from workers import shard
+from workers import update_key
+from workers import Worker
+from workers import WorkerPool
+from conftest import Nothing
+
+
+@pytest.mark.parametrize(
+    'key, workers, expect',
+    [(0, 4, 0), (5, 4, 1), (-3, 4, 1), ('10', 3, 1), (7, 1, 0)],
+)
+def test_shard(key, workers, expect):
+    assert shard(key, workers) == expect
+
+
+def test_shard_string_key():
+    """
+    Non numeric keys should be consistently sharded too.
+    """
+    assert shard('abc', 4) == shard('abc', 4)
+    assert 0 <= shard('abc', 4) < 4
+
+
+def test_update_key():
+    chat = Nothing(id=1)
+    user = Nothing(id=2)
+    assert update_key(Nothing(effective_chat=chat, effective_user=user)) == 1
+    assert update_key(Nothing(effective_chat=None, effective_user=user)) == 2
+    assert update_key(Nothing(effective_chat=None, effective_user=None)) == 0
+
+
+class EchoWorker(Worker):
+    """
+    Worker that reports every update it handles back to the test process.
+    """
+
+    results = Queue()
+
+    def setup(self):
+        pass
+
+    def handle(self, data):
+        self.results.put((self.name, data['chat_id']))
+
+    def teardown(self):
+        pass
+
+
+class FakeUpdate:
+    def __init__(self, chat_id):
+        self.effective_chat = Nothing(id=chat_id)
+
+    def to_dict(self):
+        return {'chat_id': self.effective_chat.id}
+
+
+def test_worker_pool():
+    """
+    Check that every update is processed, and that all the updates for a
+    given chat are handled by the same worker in order.
+    """
+    pool = WorkerPool({}, 3, worker_class=EchoWorker)
+    pool.start()
+    chats = [1, 2, 3, 4, 1, 1, 5, 2]
+    for chat_id in chats:
+        pool.dispatch(FakeUpdate(chat_id))
+    pool.terminate()
+
+    results = [EchoWorker.results.get(timeout=5) for _ in chats]
+    assert sorted(c for _, c in results) == sorted(chats)
+    owners = {}
+    for worker, chat_id in results:
+        assert owners.setdefault(chat_id, worker) == worker
+    assert [c for _, c in results if c == 1] == [1, 1, 1]
@@ -1,4 +1,5 @@
 import re
+import bisect
 import string
 import unidecode
 
@@ -126,3 +127,161 @@ def process(value, key, invalid=True, junk=True):
             value = old_value
 
     return value.strip()
+
+
+def artist_key(artist):
+    """
+    Return the normalized name of an artist, suitable for use as a cache key.
+    Different spellings of the same name ('Metallica', 'METALLICA ') should
+    have the same key.
+    """
+    return process(artist, key='name', invalid=False, junk=False)
+
+
+def song_key(song):
+    """
+    Return a normalized (artist, title) tuple for a song, suitable for use as
+    a cache key. Different spellings of the same song should have the same key.
+    """
+    artist = artist_key(song.artist)
+    title = process(song.title, key='name', invalid=False)
+    return artist, title
+
+
+class Reply(str):
+    """
+    A message that is ready to be sent, along with the chunks it has to be
+    split in.
+    """
+
+    @classmethod
+    def render(cls, text, size):
+        reply = cls(text)
+        reply.chunks = split_message(text, size)
+        return reply
+
+
+MARKDOWN_MARKERS = ('```', '`', '*', '_')
+
+
+def markdown_entities(msg):
+    """
+    Find all the entities in a message with Telegram's Markdown syntax.
+
+    Returns a sorted list of non-overlapping (start, end, marker) tuples,
+    where 'marker' is the string that opens and closes the entity, or an empty
+    string for links. Markers without a closing pair are not entities.
+    """
+    entities = []
+    exhausted = set()
+    special = re.compile(r'[\\\[`*_]')
+    i = 0
+    while True:
+        match = special.search(msg, i)
+        if not match:
+            break
+        i = match.start()
+        char = msg[i]
+        if char == '\\':
+            i += 2
+            continue
+
+        end = -1
+        if char == '[' and '[' not in exhausted:
+            close = msg.find('](', i + 1)
+            if close != -1:
+                end = msg.find(')', close + 2)
+            if end == -1:
+                exhausted.add('[')
+            else:
+                entities.append((i, end + 1, ''))
+                i = end + 1
+                continue
+
+        for marker in MARKDOWN_MARKERS:
+            if marker in exhausted or not msg.startswith(marker, i):
+                continue
+            end = msg.find(marker, i + len(marker))
+            if end == -1:
+                exhausted.add(marker)
+                continue
+            end += len(marker)
+            entities.append((i, end, marker))
+            break
+
+        i = end if end != -1 else i + 1
+    return entities
+
+
+def _last_break(breaks, start, limit, entity_at):
+    """
+    Return the last position in the sorted 'breaks' list that is between
+    'start' and 'limit' and not inside an entity, or None if there isn't one.
+    """
+    i = bisect.bisect_right(breaks, limit) - 1
+    while i >= 0 and breaks[i] > start:
+        entity = entity_at(breaks[i])
+        if not entity:
+            return breaks[i]
+        i = bisect.bisect_right(breaks, entity[0]) - 1
+    return None
+
+
+def split_message(msg, size):
+    """
+    Split a message in chunks of at most 'size' characters.
+
+    Messages are preferably split between paragraphs, then between lines or
+    words, and only cut at an arbitrary point when there is no other choice.
+    The whitespace at the split points is not included in the chunks. Markdown
+    entities are never split, unless they are too long to fit in a single
+    chunk, in which case they are closed at the end of the chunk and opened
+    again at the start of the next one.
+
+    The result is a tuple, so it can be cached along with the message.
+    """
+    if len(msg) <= size:
+        return (msg,) if msg else ()
+
+    paragraphs = [m.start() for m in re.finditer('\n\n', msg)]
+    lines = [m.start() for m in re.finditer('\n', msg)]
+    words = [m.start() for m in re.finditer(' ', msg)]
+    entities = markdown_entities(msg)
+    starts = [entity[0] for entity in entities]
+
+    def entity_at(pos):
+        i = bisect.bisect_left(starts, pos) - 1
+        if i >= 0 and entities[i][1] > pos:
+            return entities[i]
+        return None
+
+    chunks = []
+    start = 0
+    prefix = ''
+    while len(prefix) + len(msg) - start > size:
+        limit = start + size - len(prefix)
+        suffix = ''
+        for breaks in (paragraphs, lines, words):
+            cut = _last_break(breaks, start, limit, entity_at)
+            if cut is not None:
+                break
+        else:
+            cut = limit
+            entity = entity_at(cut)
+            if entity and entity[0] > start:
+                cut = entity[0]
+            elif entity and entity[2] and size > 2 * len(entity[2]):
+                suffix = entity[2]
+                cut = limit - len(suffix)
+
+        chunks.append(prefix + msg[start:cut] + suffix)
+        prefix = suffix
+        start = cut
+
+        # Telegram ignores leading whitespace, so don't waste any space on it
+        while start < len(msg) and msg[start].isspace():
+            start += 1
+
+    if start < len(msg):
+        chunks.append(prefix + msg[start:])
+    return tuple(chunks)
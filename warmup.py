@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Warm up the bot's caches.
+
+Fetches the discographies and lyrics for a list of songs and saves them to the
+database, so that the first users to ask for them after a deploy don't have to
+wait for the whole search.
+
+Songs are read from a file with one `Artist - Title` per line (or just an
+artist name to fetch only their discography), or taken from the most popular
+searches in the log table.
+"""
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import lyricfetch
+from lyricfetch import Song
+
+import bot
+from logger import logger
+from ratelimit import TokenBucket
+from util import song_key
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        'file',
+        nargs='?',
+        type=argparse.FileType('r'),
+        help='File with a list of songs or artists, one per line',
+    )
+    parser.add_argument(
+        '-t',
+        '--top',
+        type=int,
+        default=0,
+        help='Warm up the N most searched songs in the log',
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=4, help='Number of parallel jobs'
+    )
+    parser.add_argument(
+        '-r',
+        '--rate',
+        type=float,
+        default=2,
+        help='Maximum number of songs to start per second',
+    )
+    parser.add_argument(
+        '--no-lyrics',
+        action='store_true',
+        help='Only fetch discographies, not lyrics',
+    )
+    args = parser.parse_args(args)
+    if not args.file and not args.top:
+        parser.error('Either a file or --top is required')
+    return args
+
+
+def unique(songs):
+    """
+    Remove duplicate songs from a list, keeping the original order.
+    """
+    seen = {}
+    for song in songs:
+        seen.setdefault(song_key(song), song)
+    return list(seen.values())
+
+
+def parse_songs(lines):
+    """
+    Parse a list of `Artist - Title` or `Artist` lines into Song objects.
+    Empty lines and duplicates are skipped.
+    """
+    songs = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if '-' in line:
+            song = Song.from_string(line)
+        else:
+            song = Song(artist=line)
+        if song:
+            songs.append(song)
+    return unique(songs)
+
+
+def warm(song, bucket, lyrics=True):
+    """
+    Fetch the discography and lyrics for a single song. Returns True if the
+    lyrics were found.
+    """
+    bucket.acquire()
+    if bot.SP.sp:
+        bot.SP.fetch_discography(song)
+    if not lyrics or not song.title:
+        return False
+    res, _ = bot.fetch_reply(song, lyricfetch.sources)
+    return res is not None
+
+
+def warmup(songs, jobs=4, rate=2, lyrics=True, report=5):
+    """
+    Warm up the caches for a list of songs in parallel. Progress is logged
+    every 'report' seconds. Returns the number of songs whose lyrics were
+    found.
+    """
+    bucket = TokenBucket(rate)
+    start = last_report = time.monotonic()
+    found = done = 0
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(warm, song, bucket, lyrics) for song in songs]
+        for future in as_completed(futures):
+            done += 1
+            try:
+                found += future.result()
+            except Exception as error:
+                logger.exception(error)
+
+            now = time.monotonic()
+            if now - last_report >= report or done == len(songs):
+                last_report = now
+                logger.info(
+                    'Warmed up %d/%d songs (%d found) at %.2f songs/s',
+                    done,
+                    len(songs),
+                    found,
+                    done / max(now - start, 1e-9),
+                )
+    return found
+
+
+def main(args=None):
+    args = parse_args(args)
+    config = bot.parse_config()
+    if not bot.configure(config):
+        return 2
+
+    songs = []
+    if args.file:
+        songs.extend(parse_songs(args.file))
+    if args.top:
+        top = bot.DB.get_top_songs(args.top)
+        songs.extend(Song(row['artist'], row['title']) for row in top)
+    songs = unique(songs)
+
+    logger.info('Warming up %d songs', len(songs))
+    warmup(songs, args.jobs, args.rate, lyrics=not args.no_lyrics)
+    bot.SP.save_cache()
+    bot.DB.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
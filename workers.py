@@ -0,0 +1,136 @@
+"""
+Multi-process deployment mode.
+
+Incoming updates are sharded by chat id across a pool of worker processes,
+each of which runs its own dispatcher with the full set of bot handlers. Every
+chat is always served by the same worker, so per-chat state never needs to
+cross process boundaries, while the database and the discography cache are
+shared through the SQLite file.
+"""
+import zlib
+from multiprocessing import Process, Queue
+
+from logger import logger
+
+
+def shard(key, workers):
+    """
+    Return the index of the worker that owns this chat (or user) id.
+    """
+    try:
+        key = int(key)
+    except (TypeError, ValueError):
+        key = zlib.crc32(str(key).encode())
+    return key % workers
+
+
+def update_key(update):
+    """
+    Get the id that an update should be sharded by. Updates that don't belong
+    to any chat (like inline queries) are sharded by user instead.
+    """
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return 0
+
+
+class Worker(Process):
+    """
+    Worker process. Reads serialized updates from its queue and feeds them to
+    a private dispatcher until it receives a None sentinel.
+
+    Tuples in the queue are calls to a function in the bot module, as a
+    (name, args) pair.
+    """
+
+    def __init__(self, config, queue_size=1000, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.config = config
+        self.queue = Queue(maxsize=queue_size)
+        self.dispatcher = None
+
+    def setup(self):
+        """
+        Configure the bot module for this process and build the dispatcher.
+        """
+        # Imported here to avoid a circular import, since the bot module
+        # imports this one to start the pool
+        import bot
+        from telegram import Bot
+        from telegram.ext import Dispatcher
+
+        if not bot.configure(self.config):
+            raise RuntimeError('Could not configure the database')
+        self.dispatcher = Dispatcher(
+            Bot(self.config['token']), None, workers=0, use_context=True
+        )
+        bot.add_handlers(self.dispatcher)
+
+    def handle(self, data):
+        """
+        Process a single serialized update.
+        """
+        from telegram import Update
+
+        if isinstance(data, tuple):
+            import bot
+
+            name, args = data
+            getattr(bot, name)(*args)
+            return
+        update = Update.de_json(data, self.dispatcher.bot)
+        self.dispatcher.process_update(update)
+
+    def teardown(self):
+        import bot
+
+        bot.SCHEDULER.stop()
+        bot.DB.close()
+
+    def run(self):
+        self.setup()
+        for data in iter(self.queue.get, None):
+            try:
+                self.handle(data)
+            except Exception as error:
+                logger.exception(error)
+        self.teardown()
+
+
+class WorkerPool:
+    """
+    A fixed set of worker processes with an update dispatching function that
+    can be registered as a handler in the main process.
+    """
+
+    def __init__(self, config, workers, worker_class=Worker):
+        self.workers = [worker_class(config) for _ in range(workers)]
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def dispatch(self, update, context=None):
+        """
+        Send an update to the worker that owns its chat.
+        """
+        index = shard(update_key(update), len(self.workers))
+        self.workers[index].queue.put(update.to_dict())
+
+    def invalidate_sp_token(self, chat_id):
+        """
+        Drop the cached spotify token for a chat in the worker that owns it.
+        """
+        index = shard(chat_id, len(self.workers))
+        self.workers[index].queue.put(('invalidate_sp_token', (chat_id,)))
+
+    def terminate(self):
+        """
+        Stop all the workers after they have processed their pending updates.
+        """
+        for worker in self.workers:
+            worker.queue.put(None)
+        for worker in self.workers:
+            worker.join()